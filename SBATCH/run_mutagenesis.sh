@@ -14,6 +14,10 @@
 
 # Then to get most accurate mutagenesis you can average these matrices
 # and visualize them with src.analysis.mutagenesis_plot.plot_sequence
+#
+# Without --mutations a full saturation is run with one Modeller worker per cpu 
+# (--num_workers), finished cells are saved as they complete so resubmitting 
+# the same job after a timeout resumes where it left off.
 ROOT_DIR="/lustre06/project/6069023"
 OUT_DIR="${ROOT_DIR}/jyaacoub/MutDTA/SBATCH/outs/mutagenesis_tests" # this is used for outputs
 BIN_DIR="${ROOT_DIR}/jyaacoub/bin" # for modeller
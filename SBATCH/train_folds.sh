@@ -15,6 +15,8 @@
 #SBATCH --output=./outs/%x_%a.out
 
 # we want to run across all 5 folds at once
+# (alternatively drop the array and pass `--all_folds 5` to train all folds in a single task 
+#  sharing one copy of the dataset)
 #SBATCH --array=0-4
 module load StdEnv/2020 && module load gcc/9.3.0 && module load arrow/12.0.1
 
@@ -0,0 +1,388 @@
+"""
+Performance benchmarks for MutDTA. Each subcommand benchmarks a single component and prints
+a json summary of its results.
+
+e.g.:
+    python benchmark.py server --url http://127.0.0.1:8765 -m davis_DG -pdb a.pdb b.pdb -ls "CCO"
+"""
+import json, argparse
+
+parser = argparse.ArgumentParser(description='Performance benchmarks for MutDTA.')
+subparsers = parser.add_subparsers(dest='cmd', required=True)
+
+# Inference server
+p = subparsers.add_parser('server', help='Latency and throughput of a running inference_server.py under concurrent load.')
+p.add_argument('--url', type=str, default='http://127.0.0.1:8765')
+p.add_argument('-m', '--model_opt', type=str, default='davis_DG')
+p.add_argument('-f', '--fold', type=int, default=1)
+p.add_argument('-pdb', '--pdb_files', type=str, nargs='+', required=True)
+g = p.add_mutually_exclusive_group(required=True)
+g.add_argument('-ls', '--ligand_smiles', type=str)
+g.add_argument('-sdf', '--ligand_sdf', type=str)
+p.add_argument('-n', '--n_requests', type=int, default=64)
+p.add_argument('-c', '--concurrency', type=int, nargs='+', default=[1, 4, 16])
+
+# Precomputed GCN normalization
+p = subparsers.add_parser('gcn_norm', help='Checks that precomputed GCN normalization gives the same outputs '+\
+                          'and compares training throughput with and without it.')
+p.add_argument('-m', '--model_opt', type=str, default='davis_DG', 
+               help='Tuned config to get the model architecture and dataset from.')
+p.add_argument('-bs', '--batch_size', type=int, default=None, help='Defaults to batch size of tuned config.')
+p.add_argument('-n', '--n_steps', type=int, default=50)
+p.add_argument('--atol', type=float, default=1e-5)
+
+# Compact node features
+p = subparsers.add_parser('compact', help='Checks that compact node features decode exactly and reports '+\
+                          'the size reduction of the saved protein and ligand graphs.')
+p.add_argument('-m', '--model_opt', type=str, default='davis_DG', 
+               help='Tuned config to get the dataset options from.')
+p.add_argument('-s', '--subset', type=str, default='full')
+p.add_argument('-n', '--n_items', type=int, default=1000, help='Items to time __getitem__ over.')
+
+# Modeller mutations
+p = subparsers.add_parser('modeller', help='Per-mutation latency of run_modeller vs a persistent ModellerMutator.')
+p.add_argument('-pdb', '--pdb_file', type=str, required=True)
+p.add_argument('-c', '--chain', type=str, default='A')
+p.add_argument('-n', '--n_mutations', type=int, default=10)
+p.add_argument('--n_attempts', type=int, default=5)
+
+# Incremental protein features
+p = subparsers.add_parser('featurize', help='Checks incremental mutant featurization against get_protein_features '+\
+                          'and compares their per-mutant latency.')
+p.add_argument('-pdb', '--pdb_file', type=str, required=True, help='Wild-type structure.')
+p.add_argument('-mut', '--mutant_pdbs', type=str, nargs='+', required=True, 
+               help='Point mutant structures of --pdb_file (e.g.: from run_modeller).')
+p.add_argument('-f', '--feature_opt', type=str, default='nomsa')
+p.add_argument('-e', '--edge_opt', type=str, default='binary')
+
+# CPU data-parallel training
+p = subparsers.add_parser('ddp_cpu', help='Training throughput scaling of gloo data-parallel training over '+\
+                          'local cpu processes, runs the same `launch_cpu` training as train_test_local_DDP.py.')
+p.add_argument('-m', '--model_opt', type=str, nargs='+', default=['davis_DG', 'davis_gvpl'],
+               help='Tuned configs to get the model architectures and datasets from.')
+p.add_argument('-np', '--nprocs', type=int, nargs='+', default=[1, 2, 4, 8])
+p.add_argument('-bs', '--batch_size', type=int, default=32, help='Per process batch size.')
+p.add_argument('-n', '--n_steps', type=int, default=30, help='Training batches per epoch.')
+p.add_argument('--epochs', type=int, default=2, help='Epochs per run, the first one is treated as warmup.')
+p.add_argument('-p', '--port', type=int, default=29512)
+
+# DataLoader throughput
+p = subparsers.add_parser('loader', help='DataLoader batches/s and collate time for each dataset and feature '+\
+                          'option under different loader settings (no model involved).')
+p.add_argument('-d', '--data_opt', type=str, nargs='+', default=['davis'])
+p.add_argument('-f', '--feature_opt', type=str, nargs='+', default=['nomsa'])
+p.add_argument('-e', '--edge_opt', type=str, default='binary')
+p.add_argument('-lf', '--ligand_feature_opt', type=str, default='original')
+p.add_argument('-le', '--ligand_edge_opt', type=str, default='binary')
+p.add_argument('-s', '--subset', type=str, default='full')
+p.add_argument('-bs', '--batch_size', type=int, default=128)
+p.add_argument('-n', '--n_batches', type=int, default=100)
+p.add_argument('-nw', '--num_workers', type=int, nargs='+', default=[0, 2, 4, 8])
+p.add_argument('--epochs', type=int, default=2, help='Epochs per setting, shows the cost of restarting workers.')
+p.add_argument('--pin_memory', action='store_true')
+p.add_argument('--mmap', action='store_true')
+
+args = parser.parse_args()
+
+
+def _strip_gcn_norm(batch):
+    batch = batch.clone()
+    for k in ['gcn_edge_index', 'gcn_edge_weight']:
+        if k in batch: del batch[k]
+    return batch
+
+def _time_train_steps(model, loader, device, n_steps:int, transform=lambda b: b) -> float:
+    """Returns the training throughput in samples/sec for `n_steps` steps"""
+    import time, torch
+    model.train()
+    optimizer = torch.optim.Adam(model.parameters(), lr=1e-4)
+    criterion = torch.nn.MSELoss()
+    n_samples, step, t0 = 0, 0, None
+    while step < n_steps:
+        for data in loader:
+            if step == 1: # first step is warmup
+                if device.type == 'cuda': torch.cuda.synchronize()
+                t0, n_samples = time.perf_counter(), 0
+            pro, lig = transform(data['protein']).to(device), transform(data['ligand']).to(device)
+            y = data['y'].reshape(-1, 1).float().to(device)
+            optimizer.zero_grad()
+            loss = criterion(model(pro, lig), y)
+            loss.backward()
+            optimizer.step()
+            n_samples += len(y)
+            step += 1
+            if step >= n_steps: break
+    if device.type == 'cuda': torch.cuda.synchronize()
+    return n_samples / (time.perf_counter() - t0)
+
+
+def bench_server(args):
+    from src.utils.serving import benchmark_server
+    return [benchmark_server(args.url, args.model_opt, args.fold, args.pdb_files,
+                             args.ligand_smiles, args.ligand_sdf,
+                             n_requests=args.n_requests, concurrency=c)
+            for c in args.concurrency]
+
+
+def _check_masked_gcn_norm(atol:float, n_nodes:int=50, n_edges:int=200) -> float:
+    """
+    Synthetic check that `gcn_conv` on a pocket masked graph (`mask_graph`) matches a plain 
+    GCNConv, i.e.: that the precomputed normalization of the full graph is not reused.
+    """
+    import torch
+    from torch_geometric.data import Data
+    from torch_geometric.nn import GCNConv
+    from src.data_prep.datasets import BaseDataset
+    from src.models.utils import gcn_conv
+    from src.utils.pocket_alignment import mask_graph
+    g = torch.Generator().manual_seed(0)
+    data = Data(x=torch.rand(n_nodes, 8, generator=g), 
+                edge_index=torch.randint(0, n_nodes, (2, n_edges), generator=g),
+                edge_weight=torch.rand(n_edges, generator=g))
+    BaseDataset.add_gcn_norm({'g': data})
+    data = mask_graph(data, (torch.rand(n_nodes, generator=g) > 0.3).tolist())
+    
+    conv = GCNConv(8, 4).eval()
+    with torch.no_grad():
+        out = gcn_conv(conv, data.x, data, data.edge_index, data.edge_weight)
+        ref = conv(data.x, data.edge_index, data.edge_weight)
+    max_diff = (out - ref).abs().max().item()
+    assert max_diff <= atol, f'gcn_conv on masked graph differs by {max_diff} > {atol}'
+    return max_diff
+
+def bench_gcn_norm(args):
+    import torch
+    from src import TUNED_MODEL_CONFIGS
+    from src.utils.loader import Loader
+    device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
+    params = TUNED_MODEL_CONFIGS[args.model_opt]
+    
+    loader = Loader.load_DataLoaders(data=params['dataset'], pro_feature=params['feature_opt'],
+                                     edge_opt=params['edge_opt'], ligand_feature=params['lig_feat_opt'],
+                                     ligand_edge=params['lig_edge_opt'], datasets=['val'],
+                                     batch_train=args.batch_size or params['batch_size'],
+                                     gcn_norm=True)['val']
+    model = Loader.init_model(model=params['model'], pro_feature=params['feature_opt'],
+                              pro_edge=params['edge_opt'], **params['architecture_kwargs']).to(device)
+    
+    # numerical equivalence (eval mode so that dropout doesnt change the graph)
+    model.eval()
+    max_diff = 0.0
+    with torch.no_grad():
+        for i, data in enumerate(loader):
+            if i >= 10: break
+            pro, lig = data['protein'].to(device), data['ligand'].to(device)
+            out = model(pro, lig)
+            ref = model(_strip_gcn_norm(pro), _strip_gcn_norm(lig))
+            max_diff = max(max_diff, (out - ref).abs().max().item())
+    assert max_diff <= args.atol, f'Precomputed gcn_norm output differs by {max_diff} > {args.atol}'
+    
+    return {'model_opt': args.model_opt, 'max_abs_diff': max_diff,
+            'masked_max_abs_diff': _check_masked_gcn_norm(args.atol),
+            'train_samples_per_sec': {
+                'precomputed': _time_train_steps(model, loader, device, args.n_steps),
+                'recomputed': _time_train_steps(model, loader, device, args.n_steps, 
+                                                transform=_strip_gcn_norm)}}
+
+
+def bench_compact(args):
+    import io, copy, time, torch
+    from src import TUNED_MODEL_CONFIGS
+    from src.utils.loader import Loader
+    from src.data_prep.feature_extraction.compact import decode_graph
+    params = TUNED_MODEL_CONFIGS[args.model_opt]
+    
+    dataset = Loader.load_dataset(data=params['dataset'], pro_feature=params['feature_opt'],
+                                  edge_opt=params['edge_opt'], ligand_feature=params['lig_feat_opt'],
+                                  ligand_edge=params['lig_edge_opt'], subset=args.subset)
+    dense = {'proteins': copy.copy(dataset._data_pro), 'ligands': copy.copy(dataset._data_mol)}
+    dataset._compact_graphs(dataset._data_pro, dataset._data_mol)
+    compact = {'proteins': dataset._data_pro, 'ligands': dataset._data_mol}
+    
+    def nbytes(graphs):
+        buf = io.BytesIO()
+        torch.save(graphs, buf)
+        return buf.tell()
+    
+    results = {'model_opt': args.model_opt, 'subset': args.subset}
+    for k in dense:
+        n_compact = sum('x' not in g for g in compact[k].values())
+        for key, g in dense[k].items():
+            assert torch.equal(decode_graph(compact[k][key]).x, g.x), f'Mismatch for {k} - {key}'
+        results[k] = {'n_graphs': len(dense[k]), 'n_compact': n_compact,
+                      'dense_MB': nbytes(dense[k]) / 1024**2, 'compact_MB': nbytes(compact[k]) / 1024**2}
+    
+    # cost of decode_graph on every __getitem__
+    def getitem_us(graphs):
+        dataset._data_pro, dataset._data_mol = graphs['proteins'], graphs['ligands']
+        n = min(len(dataset), args.n_items)
+        t0 = time.perf_counter()
+        for i in range(n):
+            dataset[i]
+        return (time.perf_counter() - t0) / n * 1e6
+    results['getitem_us'] = {'dense': getitem_us(dense), 'compact': getitem_us(compact)}
+    return results
+
+
+def bench_modeller(args):
+    import os, time, tempfile, shutil
+    import numpy as np
+    from src.utils.mutate_model import run_modeller, ModellerMutator
+    from src.utils.residue import Chain, ResInfo
+    seq = Chain(args.pdb_file).sequence
+    # same set of (position, residue) mutations for both
+    rng = np.random.default_rng(0)
+    mutations = []
+    for j in rng.choice(len(seq), size=min(args.n_mutations, len(seq)), replace=False):
+        AA = rng.choice([a for a in ResInfo.amino_acids[:-1] if a != seq[j]])
+        mutations.append((int(j)+1, ResInfo.code_to_pep[AA]))
+    
+    out_dir = tempfile.mkdtemp(prefix='bench_modeller_')
+    def timed(fn):
+        times = []
+        for respos, restyp in mutations:
+            t0 = time.perf_counter()
+            fn(respos, restyp, os.path.join(out_dir, f'{restyp}_{respos}.pdb'))
+            times.append(time.perf_counter() - t0)
+        return {'mean_s': float(np.mean(times)), 'median_s': float(np.median(times)),
+                'first_s': times[0], 'total_s': float(np.sum(times))}
+    
+    results = {'pdb_file': args.pdb_file, 'n_mutations': len(mutations)}
+    try:
+        results['run_modeller'] = timed(lambda p, r, o: run_modeller(args.pdb_file, p, r, args.chain, out_fp=o,
+                                                                     n_attempts=args.n_attempts))
+        with ModellerMutator(args.pdb_file, chain=args.chain, n_attempts=args.n_attempts) as mutator:
+            results['mutator'] = timed(mutator.mutate)
+    finally:
+        shutil.rmtree(out_dir, ignore_errors=True)
+    results['speedup'] = results['run_modeller']['mean_s'] / results['mutator']['mean_s']
+    return results
+
+
+def bench_featurize(args):
+    import time, torch
+    import numpy as np
+    from src.data_prep.quick_prep import get_protein_features, IncrementalProteinFeatures
+    featurizer = IncrementalProteinFeatures(args.pdb_file, args.feature_opt, args.edge_opt)
+    
+    t_full, t_inc = [], []
+    for fp in args.mutant_pdbs:
+        t0 = time.perf_counter()
+        ref, _ = get_protein_features(fp, args.feature_opt, args.edge_opt)
+        t_full.append(time.perf_counter() - t0)
+        
+        t0 = time.perf_counter()
+        pro, _ = featurizer(fp)
+        t_inc.append(time.perf_counter() - t0)
+        
+        assert torch.equal(pro.x, ref.x), f'Node features differ for {fp}'
+        assert torch.equal(pro.edge_index, ref.edge_index), f'Edges differ for {fp}'
+        assert pro.pro_seq == ref.pro_seq, f'Sequence differs for {fp}'
+    
+    return {'pdb_file': args.pdb_file, 'n_mutants': len(args.mutant_pdbs), 'seq_len': len(featurizer.seq),
+            'mean_changed_residues': float(np.mean(featurizer.n_changed)),
+            'full_ms': 1000 * float(np.mean(t_full)), 'incremental_ms': 1000 * float(np.mean(t_inc)),
+            'speedup': float(np.mean(t_full) / np.mean(t_inc))}
+
+
+def bench_ddp_cpu(args):
+    import os, json, argparse, tempfile
+    from src import TUNED_MODEL_CONFIGS
+    from src.utils.arg_parse import (add_model_args, add_dataset_args, add_hyperparam_args, 
+                                     add_local_dist_args, process_unknown_args)
+    from src.train_test.distributed import launch_cpu
+    parser = argparse.ArgumentParser()
+    for add_args in [add_model_args, add_dataset_args, add_hyperparam_args, add_local_dist_args]:
+        add_args(parser)
+    
+    results, port = {}, args.port
+    out_dir = tempfile.mkdtemp(prefix='bench_ddp_cpu_')
+    for m in args.model_opt:
+        params = {k: getattr(v, 'value', v) for k, v in TUNED_MODEL_CONFIGS[m].items()} # enums to str
+        # architecture kwargs that _dtrain already passes to init_model need their own flags
+        arch_argv = []
+        for k, v in params['architecture_kwargs'].items():
+            flag = {'dropout': '-do', 'dropout_prot': '-dop', 'pro_emb_dim': '-embP'}.get(k, f'--{k}')
+            arch_argv += [flag, str(v)]
+        results[m] = {}
+        for n in args.nprocs:
+            logs_out = os.path.join(out_dir, f'{m}_{n}.json')
+            argv = ['-m', params['model'], '-d', params['dataset'], '-f', params['feature_opt'],
+                    '-e', params['edge_opt'], '-lf', params['lig_feat_opt'], '-le', params['lig_edge_opt'],
+                    '-bs', str(args.batch_size), '-ne', str(args.epochs), '-np', str(n), '-p', str(port), 
+                    '-ms', str(args.n_steps), '-lo', logs_out] + arch_argv
+            run_args, unknown_args = parser.parse_known_args(argv)
+            launch_cpu(run_args, process_unknown_args(unknown_args))
+            port += 1 # avoid reusing a port still in TIME_WAIT
+            
+            with open(logs_out) as f:
+                logs = json.load(f)
+            # ranks step in lockstep so the total is rank 0 throughput x world size
+            results[m][n] = {'samples_per_sec': logs['samples_per_s'][-1] * n,
+                             'samples_per_sec_per_epoch': [s * n for s in logs['samples_per_s']]}
+        base = results[m][args.nprocs[0]]['samples_per_sec'] / args.nprocs[0]
+        for n, r in results[m].items():
+            r['speedup'] = r['samples_per_sec'] / (base * args.nprocs[0])
+            r['efficiency'] = r['samples_per_sec'] / (base * n)
+    return {'batch_size_per_proc': args.batch_size, 'n_steps': args.n_steps, 'epochs': args.epochs,
+            'results': results}
+
+
+def bench_loader(args):
+    import time, itertools
+    import numpy as np
+    from torch_geometric.loader import DataLoader
+    from src.utils.loader import Loader
+    results = []
+    for data, feature in itertools.product(args.data_opt, args.feature_opt):
+        t0 = time.perf_counter()
+        dataset = Loader.load_dataset(data=data, pro_feature=feature, edge_opt=args.edge_opt,
+                                      ligand_feature=args.ligand_feature_opt, ligand_edge=args.ligand_edge_opt,
+                                      subset=args.subset, mmap=args.mmap)
+        res = {'data': data, 'feature_opt': feature, 'n_samples': len(dataset), 'mmap': args.mmap,
+               'load_s': time.perf_counter() - t0}
+        
+        # collate time in isolation (samples already fetched)
+        loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True)
+        rng = np.random.default_rng(0)
+        collate_s, getitem_s = [], []
+        for _ in range(min(args.n_batches, 20)):
+            idxs = rng.choice(len(dataset), size=min(args.batch_size, len(dataset)), replace=False)
+            t0 = time.perf_counter()
+            samples = [dataset[int(i)] for i in idxs]
+            t1 = time.perf_counter()
+            loader.collate_fn(samples)
+            getitem_s.append(t1 - t0)
+            collate_s.append(time.perf_counter() - t1)
+        res['getitem_ms_per_batch'] = 1000 * float(np.mean(getitem_s))
+        res['collate_ms_per_batch'] = 1000 * float(np.mean(collate_s))
+        
+        for nw, persistent in itertools.product(args.num_workers, [False, True]):
+            if nw == 0 and persistent: continue
+            loader = DataLoader(dataset, batch_size=args.batch_size, shuffle=True,
+                                **Loader.dataloader_kwargs(nw, persistent, pin_memory=args.pin_memory))
+            epoch_bps = []
+            for _ in range(args.epochs):
+                t0, n = time.perf_counter(), 0
+                for _ in itertools.islice(loader, args.n_batches):
+                    n += 1
+                epoch_bps.append(n / (time.perf_counter() - t0))
+            res[f'workers={nw}' + (',persistent' if persistent else '')] = {
+                'batches_per_s': epoch_bps, 'samples_per_s': [b * args.batch_size for b in epoch_bps]}
+            del loader
+        results.append(res)
+    return results
+
+
+BENCHMARKS = {
+    'server': bench_server,
+    'gcn_norm': bench_gcn_norm,
+    'compact': bench_compact,
+    'modeller': bench_modeller,
+    'featurize': bench_featurize,
+    'ddp_cpu': bench_ddp_cpu,
+    'loader': bench_loader,
+}
+
+if __name__ == '__main__':
+    print(json.dumps(BENCHMARKS[args.cmd](args), indent=2))
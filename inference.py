@@ -10,7 +10,10 @@ parser.add_argument('-pdb','--pdb_files', type=str, nargs='+', required=True,
                         'NOTE: file name is used for protein ID in csv output')
 parser.add_argument('-o','--csv_out', type=str, default='./predicted_pkd_values.csv', 
                     help='Output csv to save the predicted pkd values with the following columns: \n'+\
-                        'TIMESTAMP, model, fold, pdb_file, ligand_id, pred_pkd, SMILES, pro_seq')
+                        'TIMESTAMP, model, fold, pdb_file, ligand_id, pred_pkd, SMILES, pro_seq. '+\
+                        'Rows are appended with a file lock so concurrent runs can share a csv. Any path not '+\
+                        'ending in .csv is written as a parquet dataset directory partitioned by model/fold '+\
+                        '(compact with `python -m src.utils.predictions compact <dir>`).')
 
 parser.add_argument('-m','--model_opt', type=str, default='davis_DG', 
                     choices=['davis_DG',    'davis_gvpl',   'davis_esm', 
@@ -27,15 +30,20 @@ parser.add_argument('-li','--ligand_id', type=str, default='',
 parser.add_argument('-bs','--batch_size', type=int, default=8, 
                     help='Batch size for processing the PDB files. Default is set to a conservative 8 batch size '+\
                          'since that is the max a100s can comfortably support for our largest models (ESM models).')
+parser.add_argument('-nw','--num_workers', type=int, default=min(4, os.cpu_count()), 
+                    help='Number of processes for building protein graphs in parallel with the model, 0 to build them '+\
+                        'serially. Default is min(4, cpu count).')
+parser.add_argument('-pf','--prefetch', type=int, default=2, 
+                    help='Number of batches to featurize ahead of the one running through the model. Default is 2.')
 parser.add_argument("-D", "--only_download", help="for downloading esm models if the are missing", default=False, action="store_true")
+parser.add_argument('--server', type=str, default=None,
+                    help='URL of a running inference_server.py (e.g.: http://127.0.0.1:8765). If set, this script '+\
+                        'acts as a thin client and skips loading the model and heavy imports.')
 args = parser.parse_args()
 
 # Assign variables
 LIGAND_SMILES = args.ligand_smiles
 LIGAND_SDF = args.ligand_sdf
-if LIGAND_SDF:
-    from rdkit import Chem
-    LIGAND_SMILES = Chem.MolToSmiles(Chem.MolFromMolFile(LIGAND_SDF))
 
 LIGAND_ID = args.ligand_id
 PDB_FILES = args.pdb_files
@@ -43,6 +51,8 @@ CSV_OUT = args.csv_out
 MODEL_OPT = args.model_opt
 FOLD = args.fold
 BATCH_SIZE = args.batch_size
+NUM_WORKERS = args.num_workers
+PREFETCH = args.prefetch
 ONLY_DOWNLOAD = args.only_download
 
 print("#"*50)
@@ -54,18 +64,56 @@ print(f"OUT_PATH: {CSV_OUT}")
 print(f"MODEL_OPT: {MODEL_OPT}")
 print(f"FOLD: {FOLD}")
 print(f"BATCH_SIZE: {BATCH_SIZE}")
+print(f"NUM_WORKERS: {NUM_WORKERS}")
+print(f"PREFETCH: {PREFETCH}")
 print(f"ONLY_DOWNLOAD: {ONLY_DOWNLOAD}")
+print(f"SERVER: {args.server}")
 print("#"*50, end="\n\n")
 if ONLY_DOWNLOAD: logging.warning("ONLY_DOWNLOAD option set")
 
 import pandas as pd
+
+from src.utils.predictions import PredictionWriter
+
+def save_results(results):
+    # appends only the new rows (locked csv append or a new parquet file)
+    out = PredictionWriter(CSV_OUT).write(results)
+    print(f"{len(results)} results saved to {out}")
+
+##################################################
+### Thin client mode                           ###
+##################################################
+if args.server:
+    from src.utils.serving import InferenceClient
+    # the server converts the sdf to SMILES so that rdkit is not needed here
+    response = InferenceClient(args.server).predict(MODEL_OPT, FOLD, PDB_FILES, 
+                                                    ligand_smiles=LIGAND_SMILES, ligand_sdf=LIGAND_SDF)
+    LIGAND_SMILES = response['SMILES']
+    time_stamp = pd.Timestamp("now")
+    save_results([{
+            'TIMESTAMP': time_stamp,
+            'model':MODEL_OPT,
+            'fold': FOLD,
+            'pdb_file': os.path.basename(r['pdb_file']).split('.pdb')[0],
+            'ligand_id': LIGAND_ID,
+            'pred_pkd': round(r['pred_pkd'], 3),
+            'SMILES': LIGAND_SMILES,
+            'pro_seq': r['pro_seq']
+        } for r in response['results']])
+    exit()
+
+import time
 import torch
 from torch_geometric.data import Batch
 from tqdm import tqdm
 
 from src import TUNED_MODEL_CONFIGS
 from src.utils.loader import Loader
-from src.data_prep.quick_prep import get_ligand_features, get_protein_features
+from src.data_prep.quick_prep import get_ligand_features, iter_protein_batches
+
+if LIGAND_SDF:
+    from rdkit import Chem
+    LIGAND_SMILES = Chem.MolToSmiles(Chem.MolFromMolFile(LIGAND_SDF))
 
 print(f"Module imports completed")
 logging.getLogger().setLevel(logging.DEBUG)
@@ -73,6 +121,13 @@ logging.getLogger().setLevel(logging.DEBUG)
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 MODEL_PARAMS = TUNED_MODEL_CONFIGS[MODEL_OPT]
 
+# Start featurizing before loading the model so the first batches are ready by the time it is loaded
+# (also ensures the featurization workers are forked before cuda is initialized)
+t_start = time.perf_counter()
+protein_batches = iter_protein_batches(PDB_FILES, MODEL_PARAMS['feature_opt'], MODEL_PARAMS['edge_opt'],
+                                       BATCH_SIZE, num_workers=0 if ONLY_DOWNLOAD else NUM_WORKERS, 
+                                       prefetch=PREFETCH)
+
 ##################################################
 ### Loading the model                          ###
 ##################################################
@@ -90,68 +145,65 @@ lig_data = get_ligand_features(LIGAND_SMILES, MODEL_PARAMS['lig_feat_opt'],
 
 # Prepare to collect results
 results = []
+timings = {'featurize_cpu': 0.0, 'featurize_wait': 0.0, 'forward': 0.0, 'write': 0.0}
 
 # Process PDB files in batches
 num_pdb_files = len(PDB_FILES)
 num_batches = (num_pdb_files + BATCH_SIZE - 1) // BATCH_SIZE  # Ceiling division
 
-for batch_idx in tqdm(range(num_batches), desc="Running inference on PDB file(s)"):
-    start_idx = batch_idx * BATCH_SIZE
-    end_idx = min((batch_idx + 1) * BATCH_SIZE, num_pdb_files)
-    batch_pdb_files = PDB_FILES[start_idx:end_idx]
-    batch_pdb_file_names = [os.path.basename(pdb_file).split('.pdb')[0] for pdb_file in batch_pdb_files]
-
-    tqdm.write(f"Processing batch {batch_idx + 1}/{num_batches} with {len(batch_pdb_files)} PDB files.")
-
-    # Build protein graphs for the current batch
-    pro_list = []
-    for PDB_FILE in batch_pdb_files:
-        pro, _ = get_protein_features(PDB_FILE, MODEL_PARAMS['feature_opt'], MODEL_PARAMS['edge_opt'])
-        pro_list.append(pro)
-
-    # Replicate ligand data for the current batch size
-    lig_list = [lig_data] * len(pro_list)
-
-    # Batch the protein and ligand data
-    pro_batch = Batch.from_data_list(pro_list)
-    lig_batch = Batch.from_data_list(lig_list)
-
-    # Move data to device
-    pro_batch = pro_batch.to(DEVICE)
-    lig_batch = lig_batch.to(DEVICE)
-
-    # Run the model on the batched data
-    with torch.no_grad():
-        predicted_pkd = MODEL(pro_batch, lig_batch)
-
-    # Collect results
-    predicted_pkd = predicted_pkd.cpu().numpy().flatten()
-    time_stamp = pd.Timestamp("now")
-    for pdb_file_name, pkd_value, sq in zip(batch_pdb_file_names, predicted_pkd, pro_batch.pro_seq):
-        results.append({
-            'TIMESTAMP': time_stamp,
-            'model':MODEL_OPT,
-            'fold': FOLD,
-            'pdb_file': pdb_file_name,
-            'ligand_id': LIGAND_ID,
-            'pred_pkd': round(pkd_value, 3),
-            'SMILES': LIGAND_SMILES,
-            'pro_seq': sq
-        })
-
-# Prepare output DataFrame
-df_new = pd.DataFrame(results)
-
-# Check if CSV file exists
-if os.path.exists(CSV_OUT):
-    # Read existing data
-    df_existing = pd.read_csv(CSV_OUT)
-    # Combine new and existing data
-    df_combined = pd.concat([df_existing, df_new], ignore_index=True)
-    # Write the combined data back to CSV
-    df_combined.to_csv(CSV_OUT, index=False)
-    print(f"Results appended to {CSV_OUT}")
-else:
-    # If CSV does not exist, write new data
-    df_new.to_csv(CSV_OUT, index=False)
-    print(f"Results saved to {CSV_OUT}")
\ No newline at end of file
+with tqdm(total=num_batches, desc="Running inference on PDB file(s)") as pbar:
+    while True:
+        # Build protein graphs for the current batch (already prefetched if using workers)
+        t0 = time.perf_counter()
+        try:
+            batch_pdb_files, pro_list, t_feat = next(protein_batches)
+        except StopIteration:
+            break
+        timings['featurize_wait'] += time.perf_counter() - t0
+        timings['featurize_cpu'] += t_feat
+        batch_pdb_file_names = [os.path.basename(pdb_file).split('.pdb')[0] for pdb_file in batch_pdb_files]
+
+        t0 = time.perf_counter()
+        # Replicate ligand data for the current batch size
+        lig_list = [lig_data] * len(pro_list)
+
+        # Batch the protein and ligand data
+        pro_batch = Batch.from_data_list(pro_list)
+        lig_batch = Batch.from_data_list(lig_list)
+
+        # Move data to device
+        pro_batch = pro_batch.to(DEVICE)
+        lig_batch = lig_batch.to(DEVICE)
+
+        # Run the model on the batched data
+        with torch.no_grad():
+            predicted_pkd = MODEL(pro_batch, lig_batch)
+
+        # Collect results
+        predicted_pkd = predicted_pkd.cpu().numpy().flatten()
+        timings['forward'] += time.perf_counter() - t0
+        
+        time_stamp = pd.Timestamp("now")
+        for pdb_file_name, pkd_value, sq in zip(batch_pdb_file_names, predicted_pkd, pro_batch.pro_seq):
+            results.append({
+                'TIMESTAMP': time_stamp,
+                'model':MODEL_OPT,
+                'fold': FOLD,
+                'pdb_file': pdb_file_name,
+                'ligand_id': LIGAND_ID,
+                'pred_pkd': round(pkd_value, 3),
+                'SMILES': LIGAND_SMILES,
+                'pro_seq': sq
+            })
+        pbar.update(1)
+
+t0 = time.perf_counter()
+save_results(results)
+timings['write'] = time.perf_counter() - t0
+
+total = time.perf_counter() - t_start
+print(f"\nTiming for {num_pdb_files} PDB file(s) in {total:.2f}s ({num_pdb_files/total:.2f} files/s):")
+print(f"  featurize: {timings['featurize_cpu']:.2f}s cpu over {NUM_WORKERS} worker(s), "+\
+      f"{timings['featurize_wait']:.2f}s waiting on it")
+print(f"    forward: {timings['forward']:.2f}s")
+print(f"      write: {timings['write']:.2f}s")
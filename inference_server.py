@@ -0,0 +1,28 @@
+import logging, argparse
+parser = argparse.ArgumentParser(description='Starts a long-running local inference server that keeps tuned models '+\
+                                 'resident and coalesces concurrent requests into micro-batches. '+\
+                                 'Use `inference.py --server <URL>` as a client.')
+parser.add_argument('--host', type=str, default='127.0.0.1', help='Interface to bind to (default localhost only).')
+parser.add_argument('--port', type=int, default=8765, help='Port to listen on.')
+parser.add_argument('-m', '--preload', type=str, nargs='*', default=[],
+                    help='Models to load at startup in the format <model_opt>:<fold> (e.g.: davis_DG:1). '+\
+                        'Other models are loaded on first request.')
+parser.add_argument('-bs', '--max_batch_size', type=int, default=8,
+                    help='Max number of requests to coalesce into a single forward pass.')
+parser.add_argument('-lat', '--max_latency_ms', type=float, default=20.0,
+                    help='Max time a request waits for other requests to batch with.')
+parser.add_argument('--cache_size', type=int, default=512,
+                    help='Number of protein and ligand graphs to keep in the feature cache.')
+args = parser.parse_args()
+
+from src.utils.serving import serve, FeatureCache
+logging.getLogger().setLevel(logging.INFO)
+
+preload = []
+for p in args.preload:
+    model_opt, fold = p.split(':') if ':' in p else (p, 1)
+    preload.append((model_opt, int(fold)))
+
+serve(host=args.host, port=args.port, preload=preload,
+      features=FeatureCache(args.cache_size, args.cache_size),
+      max_batch_size=args.max_batch_size, max_latency_ms=args.max_latency_ms)
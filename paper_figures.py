@@ -335,44 +335,42 @@ def Platinum_run_inference():
 
     model_opts = MODEL_OPTS
     for model_opt in model_opts:
-        loader = None
-        for fold in range(5):
-            print(f"{model_opt}-{fold}")
-            out_csv = f"./results/platinum_predictions/{model_opt}_{fold}.csv"
-            if os.path.exists(out_csv):
-                print('\t Predictions already exists')
-                continue
-            
-            MODEL_PARAMS = TUNED_MODEL_CONFIGS[model_opt]
-            MODEL, model_kwargs =  Loader.load_tuned_model(model_opt, fold=fold, device=DEVICE)
-            MODEL.eval()
-            print("\t Model loaded")
-
-            if loader is None: # caches loader if already created for this model_opt
-                loader = Loader.load_DataLoaders(
-                                data=cfg.DATA_OPT.platinum,
-                                datasets=['full'],
-                                pro_feature=MODEL_PARAMS['feature_opt'],
-                                edge_opt=MODEL_PARAMS['edge_opt'],
-                                ligand_feature=MODEL_PARAMS['lig_feat_opt'],
-                                ligand_edge=MODEL_PARAMS['lig_edge_opt'],
-                                )['full']
-            print("\t Dataset loaded")
-
-
-            PREDICTIONS = defaultdict(list)
-            for batch in tqdm(loader, desc="\t running inference", ncols=100):    
-                PREDICTIONS['code'].extend(batch['code'])
-                PREDICTIONS['y'].extend(batch['y'].tolist())
-                y_pred = MODEL(batch['protein'].to(DEVICE), batch['ligand'].to(DEVICE))
-                PREDICTIONS['y_pred'].extend(y_pred[:,0].tolist())
-                
-                
-
-            df = pd.DataFrame.from_dict(PREDICTIONS)
+        out_csvs = {fold: f"./results/platinum_predictions/{model_opt}_{fold}.csv" for fold in range(5)}
+        folds = [fold for fold, out_csv in out_csvs.items() if not os.path.exists(out_csv)]
+        print(f"{model_opt}-{folds}")
+        if len(folds) == 0:
+            print('\t Predictions already exists')
+            continue
+        
+        # all folds are run together in a single pass
+        MODEL_PARAMS = TUNED_MODEL_CONFIGS[model_opt]
+        MODEL, model_kwargs =  Loader.load_tuned_ensemble(model_opt, folds=folds, device=DEVICE)
+        print("\t Model loaded")
+
+        loader = Loader.load_DataLoaders(
+                        data=cfg.DATA_OPT.platinum,
+                        datasets=['full'],
+                        pro_feature=MODEL_PARAMS['feature_opt'],
+                        edge_opt=MODEL_PARAMS['edge_opt'],
+                        ligand_feature=MODEL_PARAMS['lig_feat_opt'],
+                        ligand_edge=MODEL_PARAMS['lig_edge_opt'],
+                        **model_kwargs['loader_kwargs'],
+                        )['full']
+        print("\t Dataset loaded")
+
+        PREDICTIONS = {fold: defaultdict(list) for fold in folds}
+        for batch in tqdm(loader, desc="\t running inference", ncols=100):
+            _, _, y_pred = MODEL.predict(batch['protein'].to(DEVICE), batch['ligand'].to(DEVICE))
+            for i, fold in enumerate(folds):
+                PREDICTIONS[fold]['code'].extend(batch['code'])
+                PREDICTIONS[fold]['y'].extend(batch['y'].tolist())
+                PREDICTIONS[fold]['y_pred'].extend(y_pred[i,:,0].tolist())
+
+        for fold in folds:
+            df = pd.DataFrame.from_dict(PREDICTIONS[fold])
             df.set_index('code', inplace=True)
             df.sort_index(key = lambda x: x.str.split("_").str[0].astype(int), inplace=True)
-            df.to_csv(out_csv)
+            df.to_csv(out_csvs[fold])
 
     print("DONE!")
 
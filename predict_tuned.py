@@ -12,6 +12,7 @@ from src import TUNED_MODEL_CONFIGS
 from src.utils.loader import Loader
 from src.models.utils import BaseModel
 from src.data_prep.init_dataset import create_datasets
+from src.utils.predictions import PredictionWriter
 
 def get_check_p(params, fold=0):
     key = Loader.get_model_key(params['model'], params['dataset'], params['feature_opt'], 
@@ -75,7 +76,8 @@ for t in targets:
                                         params['edge_opt'], 
                                         ligand_feature=params['lig_feat_opt'], 
                                         ligand_edge=params['lig_edge_opt'], 
-                                        datasets=['test'])['test']
+                                        datasets=['test'], batch_test=128,
+                                        **Loader.tuned_loader_kwargs(t))['test']
             sample = next(iter(dl))
         except Exception:
             print('FAILED TO LOAD DATA FOR', t)
@@ -89,17 +91,20 @@ for t in targets:
             "seq_len": [],
         }
         m.eval()
-        for d in tqdm(dl):
-            df_dict['pred'].append(m(d['protein'], d['ligand']).item())
-            df_dict['actual'].append(d['y'].item())
-            df_dict['prot_id'].append(d['prot_id'][0])
-            
-            df_dict['lig_seq'].append(d['ligand'].lig_seq[0] if 'lig_seq' in d['ligand'] else None)
-            df_dict['seq_len'].append(len(d['protein'].pro_seq[0]))
+        with torch.inference_mode():
+            for d in tqdm(dl):
+                pred = m(d['protein'].to(device), d['ligand'].to(device))
+                df_dict['pred'].extend(pred.flatten().tolist())
+                df_dict['actual'].extend(d['y'].flatten().tolist())
+                df_dict['prot_id'].extend(d['prot_id'])
+                
+                n = len(d['prot_id'])
+                df_dict['lig_seq'].extend(d['ligand'].lig_seq if 'lig_seq' in d['ligand'] else [None]*n)
+                df_dict['seq_len'].extend([len(s) for s in d['protein'].pro_seq])
             
         # build df and output to csv
         df = pd.DataFrame.from_dict(df_dict, orient='columns')
-        df.to_csv(f'/cluster/home/t122995uhn/projects/data/predictions/{key}.csv')
+        PredictionWriter(f'/cluster/home/t122995uhn/projects/data/predictions/{key}.csv').write(df, index=True)
 print('DONE!')
 exit()
 
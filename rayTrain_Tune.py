@@ -8,18 +8,28 @@
        use_gpu=True,  
        resources_per_worker={"CPU": 2, "GPU": 1},
     - 
+ 
+ The train/val datasets are processed once by the driver and every trial memory maps the saved 
+ graphs (`mmap=True`) so that all trials on a node share the same page cache instead of each 
+ holding its own copy (see `prepare_shared_datasets` for what is still copied per trial).
+ Trials report their val loss every epoch so that the ASHA scheduler can stop bad trials early.
+ 
+ Interrupted searches can be resumed with:
+    python rayTrain_Tune.py --resume --name <experiment name>
 """
 
 import random
 import os
+import argparse
 import tempfile
 
 import torch
 
 import ray
 from ray.air import session # this session just comes from train._internal.session._session
-from ray.train import ScalingConfig, Checkpoint
+from ray.train import ScalingConfig, Checkpoint, RunConfig, CheckpointConfig
 from ray.train.torch import TorchCheckpoint, TorchTrainer
+from ray.tune.schedulers import ASHAScheduler
 from ray.tune.search.optuna import OptunaSearch
 
 
@@ -27,6 +37,48 @@ from src.utils.loader import Loader
 from src.train_test.simple import simple_train, simple_eval
 from src.utils import config as cfg
 
+# models without an ESM branch are small enough to share a GPU (or run on CPU) with other trials
+SMALL_MODELS = [cfg.MODEL_OPT.DG, cfg.MODEL_OPT.GVPL, cfg.MODEL_OPT.GVPL_RNG]
+
+def get_scaling_config(model:str, use_gpu:bool) -> ScalingConfig:
+    """
+    Small models get a single worker with a fraction of a GPU (or just cpus) so that multiple 
+    trials are packed onto the same node, larger models are distributed with DDP across GPUs.
+    """
+    if model in SMALL_MODELS:
+        resources = {"CPU": 2, "GPU": 0.25} if use_gpu else {"CPU": 2}
+        return ScalingConfig(num_workers=1, use_gpu=use_gpu, 
+                             resources_per_worker=resources,
+                             placement_strategy="PACK")
+    
+    # WARNING: SBATCH GPU directive should match num_workers*GPU_per_worker
+    # same for cpu-per-task directive
+    return ScalingConfig(num_workers=4, # number of ray actors to launch to distribute compute across
+                         use_gpu=use_gpu,  # default is for each worker to have 1 GPU (overrided by resources per worker)
+                         resources_per_worker={"CPU": 2, "GPU": 1} if use_gpu else {"CPU": 2},
+                         )
+
+
+def prepare_shared_datasets(config:dict):
+    """
+    Makes sure the train/val datasets are processed (once, by the driver) so that trials only 
+    memory map them with `mmap=True`. 
+    
+    Graph tensors are then shared read-only through the OS page cache, each trial still keeps a 
+    private copy of the XY.csv dataframe and of the python `Data` objects that wrap the mapped 
+    tensors (small compared to the tensors). The datasets are not put in the ray object store 
+    since tensors are pickled there, so every trial would get a full private copy on `ray.get`.
+    """
+    Loader.load_datasets(data=config['dataset'], pro_feature=config['feature_opt'], 
+                         edge_opt=config['edge_opt'], 
+                         ligand_feature=config['lig_feat_opt'],
+                         ligand_edge=config['lig_edge_opt'],
+                         path=cfg.DATA_ROOT, 
+                         subsets=['train', 'val'],
+                         training_fold=config['fold_selection'],
+                         mmap=True)
+
+
 def train_func(config):
     # ============ Init Model ==============
     model = Loader.init_model(model=config["model"], pro_feature=config["feature_opt"],
@@ -40,7 +92,7 @@ def train_func(config):
                                           parallel_strategy_kwargs={'find_unused_parameters':True})
     
     # ============ Load dataset ==============
-    print("Loading Dataset")
+    print("Loading Dataset (memory mapped)")
     loaders = Loader.load_DataLoaders(data=config['dataset'], pro_feature=config['feature_opt'], 
                                       edge_opt=config['edge_opt'], 
                                       ligand_feature=config['lig_feat_opt'],
@@ -48,7 +100,8 @@ def train_func(config):
                                       path=cfg.DATA_ROOT, 
                                       batch_train=config['batch_size'],
                                       datasets=['train', 'val'],
-                                      training_fold=config['fold_selection'])
+                                      training_fold=config['fold_selection'],
+                                      mmap=True)
     
     # prepare dataloaders with rayTrain (adds DistributedSampler and moves to correct device)
     for k in loaders.keys():
@@ -59,10 +112,21 @@ def train_func(config):
     optimizer = torch.optim.Adam(model.parameters(), lr=config["lr"])
     save_checkpoint = config.get("save_checkpoint", False)
     
-    for _ in range(config['epochs']):            
+    # resuming trial (e.g.: after Tuner.restore or an ASHA paused trial)
+    start_epoch = 0
+    checkpoint = ray.train.get_checkpoint()
+    if checkpoint:
+        with checkpoint.as_directory() as checkpoint_dir:
+            state = torch.load(os.path.join(checkpoint_dir, "model.checkpoint"), map_location='cpu')
+            model.load_state_dict(state['model'])
+            optimizer.load_state_dict(state['optimizer'])
+            start_epoch = state['epoch'] + 1
+    
+    for epoch in range(start_epoch, config['epochs']):
         try:
             # NOTE: no need to pass in device, rayTrain will handle that for us
-            simple_train(model, optimizer, loaders['train'], epochs=1)  # Train the model
+            simple_train(model, optimizer, loaders['train'], epochs=1,  # Train the model
+                         accum_steps=config.get('accum_steps', 1), start_epoch=epoch)
             loss = simple_eval(model, loaders['val'])  # Compute test accuracy
         except RuntimeError as e: # potential memory error
             print("RuntimeError:", e)
@@ -70,18 +134,28 @@ def train_func(config):
             break
         
             
-        # Report metrics (and possibly a checkpoint) to ray        
-        checkpoint = None
+        # Report metrics (and possibly a checkpoint) to ray every epoch for the scheduler
+        metrics = {"loss": loss, "epoch": epoch}
         if save_checkpoint:
-            checkpoint_dir = tempfile.gettempdir()
-            checkpoint_path = checkpoint_dir + "/model.checkpoint"
-            torch.save(model.state_dict(), checkpoint_path)
-            checkpoint = Checkpoint.from_directory(checkpoint_dir)
-            
-        ray.train.report({"loss": loss}, checkpoint=checkpoint)
+            with tempfile.TemporaryDirectory() as checkpoint_dir:
+                torch.save({'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 
+                            'epoch': epoch}, os.path.join(checkpoint_dir, "model.checkpoint"))
+                ray.train.report(metrics, checkpoint=Checkpoint.from_directory(checkpoint_dir))
+        else:
+            ray.train.report(metrics)
     
     
 if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Ray Tune hyperparameter search.')
+    parser.add_argument('--name', type=str, default=None, 
+                        help='Experiment name (default: {model}_{dataset}{fold}), used to resume.')
+    parser.add_argument('--storage_path', type=str, default=f'{cfg.RESULTS_PATH}/ray_results')
+    parser.add_argument('--resume', action='store_true', help='Resume the interrupted search --name.')
+    parser.add_argument('--num_samples', type=int, default=500)
+    parser.add_argument('--grace_period', type=int, default=3, 
+                        help='Min epochs before ASHA can stop a trial.')
+    args = parser.parse_args()
+    
     print("DATA_ROOT:", cfg.DATA_ROOT)
     print("os.environ['TRANSFORMERS_CACHE']", os.environ['TRANSFORMERS_CACHE'])
     print("Cuda support:", torch.cuda.is_available(),":", 
@@ -100,7 +174,7 @@ if __name__ == "__main__":
         "lig_edge_opt": cfg.LIG_EDGE_OPT.binary,
         
         "fold_selection": 0,
-        "save_checkpoint": False,
+        "save_checkpoint": True, # needed to resume trials
                 
         ## hyperparameters to tune:
         "lr": ray.tune.loguniform(1e-5, 1e-3),
@@ -128,31 +202,41 @@ if __name__ == "__main__":
         arch_kwargs["pro_emb_dim"]      = ray.tune.choice([128, 256, 320])
 
     
-    # each worker is a node from the ray cluster.
-    # WARNING: SBATCH GPU directive should match num_workers*GPU_per_worker
-    # same for cpu-per-task directive
-    scaling_config = ScalingConfig(num_workers=4, # number of ray actors to launch to distribute compute across
-                                   use_gpu=True,  # default is for each worker to have 1 GPU (overrided by resources per worker)
-                                   resources_per_worker={"CPU": 2, "GPU": 1},
-                                   # trainer_resources={"CPU": 2, "GPU": 1},
-                                   # placement_strategy="PACK", # place workers on same node
-                                   )
-
-    print('init Tuner')     
-    tuner = ray.tune.Tuner(
-        TorchTrainer(train_func),
-        param_space={
-            "train_loop_config": search_space,
-            "scaling_config": scaling_config
-            },
-        tune_config=ray.tune.TuneConfig(
-            metric="loss",
-            mode="min",
-            search_alg=OptunaSearch(), # using ray.tune.search.Repeater() could be useful to get multiple trials per set of params
-                                       # would be even better if we could set trial-wise dependencies for a certain fold.
-                                       # https://github.com/ray-project/ray/issues/33677
-            num_samples=500,
-        ),
-    )
+    scaling_config = get_scaling_config(search_space['model'], use_gpu=torch.cuda.is_available())
+    
+    # datasets are processed once here, trials memory map them
+    prepare_shared_datasets(search_space)
+    trainer = TorchTrainer(train_func)
+    
+    name = args.name or f"{search_space['model']}_{search_space['dataset']}{search_space['fold_selection']}"
+    exp_path = os.path.join(args.storage_path, name)
+    
+    if args.resume and ray.tune.Tuner.can_restore(exp_path):
+        print('restoring Tuner from', exp_path)
+        # trainable has to be passed again when restoring
+        tuner = ray.tune.Tuner.restore(exp_path, trainable=trainer, 
+                                       resume_unfinished=True, resume_errored=True)
+    else:
+        print('init Tuner')     
+        tuner = ray.tune.Tuner(
+            trainer,
+            param_space={
+                "train_loop_config": search_space,
+                "scaling_config": scaling_config
+                },
+            tune_config=ray.tune.TuneConfig(
+                metric="loss",
+                mode="min",
+                search_alg=OptunaSearch(), # using ray.tune.search.Repeater() could be useful to get multiple trials per set of params
+                                           # would be even better if we could set trial-wise dependencies for a certain fold.
+                                           # https://github.com/ray-project/ray/issues/33677
+                # stops bad trials early based on their per epoch val loss
+                scheduler=ASHAScheduler(time_attr='training_iteration', max_t=search_space['epochs'],
+                                        grace_period=args.grace_period, reduction_factor=3),
+                num_samples=args.num_samples,
+            ),
+            run_config=RunConfig(name=name, storage_path=args.storage_path,
+                                 checkpoint_config=CheckpointConfig(num_to_keep=1)),
+        )
 
     results = tuner.fit()
@@ -1,10 +1,14 @@
-import os, logging, argparse
+import os, json, logging, argparse
 parser = argparse.ArgumentParser(description='Runs Mutagenesis on an input PDB file and a given ligand SMILES.')
 group = parser.add_mutually_exclusive_group(required=True)
 group.add_argument('-ls', '--ligand_smiles', type=str, help='Ligand SMILES string.')
 group.add_argument('-sdf', '--ligand_sdf', type=str, help='File path to SDF file (needed for GVPL features).')
-parser.add_argument('--ligand_id', type=str, required=True, 
-                    help='Ligand SMILES identifier, required for creating unique output path.')
+group.add_argument('-lf', '--ligand_file', type=str, 
+                   help='CSV with "ligand_id" and "smiles" (and optionally "sdf") columns to score the same '+\
+                       'mutants against multiple ligands. Each mutant is only featurized and embedded once and '+\
+                       'results are saved to a single [20, L, n_ligands] matrix.')
+parser.add_argument('--ligand_id', type=str, required=False, 
+                    help='Ligand SMILES identifier, required for creating unique output path (unless --ligand_file).')
 
 parser.add_argument('--pdb_file', type=str, required=True, help='Path to the PDB file.')
 parser.add_argument('--out_path', type=str, default='./', 
@@ -14,9 +18,30 @@ parser.add_argument('-na', '--num_modeller_attempts', type=int, required=False,
                         ' this number of attempts it will set to np.nan. Defaults to 5.')
 
 full_mut = parser.add_argument_group('FULL SATURATION MUTAGENESIS ARGS', 
-                                     description="This is the default unless mutations are specified")
-full_mut.add_argument('--res_start', type=int, default=0, help='Start index for mutagenesis (zero-indexed).')
-full_mut.add_argument('--res_end', type=int, default=float('inf'), help='End index for mutagenesis.')
+                                     description="This is the default unless mutations are specified. "+\
+                                         "Finished cells are saved as they complete and reruns resume from them.")
+full_mut.add_argument('-nw', '--num_workers', type=int, default=None, 
+                      help='Number of Modeller worker processes, defaults to all available cpus.')
+full_mut.add_argument('-bs', '--batch_size', type=int, default=19, 
+                      help='Number of mutants to run through the model at once, defaults to 19 (a full position).')
+full_mut.add_argument('--fast', action='store_true', default=False,
+                      help='Structure-free fast mode - patches the mutated node features (and sequence) of the '+\
+                          'native graph instead of running Modeller. Only for nomsa features with binary edges.')
+full_mut.add_argument('--compare_positions', type=int, default=0,
+                      help='With --fast, number of randomly sampled positions to also run through Modeller '+\
+                          'to build a json report comparing both paths. Defaults to 0 (no report).')
+
+combo_mut = parser.add_argument_group('COMBINATORIAL MUTAGENESIS ARGS',
+                                      description="Double/triple mutant landscapes. Singles are scored first and only "+\
+                                          "the top-k sets by ΔpKd are expanded to the next order. Mutant structures are "+\
+                                          "cached in the output dir and reused to build higher order mutants.")
+combo_mut.add_argument('--combinatorial', action='store_true', default=False, help='Run combinatorial scan.')
+combo_mut.add_argument('--max_order', type=int, default=2, help='Maximum number of simultaneous mutations.')
+combo_mut.add_argument('--top_k', type=int, default=10, help='Number of mutation sets to expand at each order.')
+combo_mut.add_argument('--positions', type=int, nargs='+', default=None, 
+                       help='1-indexed positions to mutate, defaults to all positions.')
+combo_mut.add_argument('--rank_by', type=str, default='abs', choices=['abs', 'decrease', 'increase'],
+                       help='How to rank mutation sets by ΔpKd, "decrease" for loss of affinity (resistance).')
 
 partial_mut = parser.add_argument_group('PARTIAL MUTAGENESIS ARGS',
                                            description="Less intensive for when a full staturation is not needed. " + \
@@ -36,6 +61,10 @@ model_args.add_argument('--fold', type=int, default=1,
                     help='Which model fold to use (there are 5 models for each option due to 5-fold CV).')
 model_args.add_argument("-D", "--only_download", help="for downloading esm models if the are missing", default=False, action="store_true")
 args = parser.parse_args()
+if not (args.ligand_id or args.ligand_file):
+    parser.error('--ligand_id is required unless --ligand_file is given')
+if args.ligand_file and (args.combinatorial or args.compare_positions):
+    parser.error('--combinatorial and --compare_positions only support a single ligand')
 
 
 # Assign variables
@@ -46,12 +75,25 @@ if LIGAND_SDF:
     LIGAND_SMILES = Chem.MolToSmiles(Chem.MolFromMolFile(LIGAND_SDF))
 
 LIGAND_ID = args.ligand_id
+LIGAND_FILE = args.ligand_file
+if LIGAND_FILE:
+    import pandas as pd
+    df_lig = pd.read_csv(LIGAND_FILE)
+    # (id, smiles, sdf) for each ligand
+    LIGANDS = [(r['ligand_id'], r['smiles'], r.get('sdf') if isinstance(r.get('sdf'), str) else None) 
+               for _, r in df_lig.iterrows()]
+    LIGAND_ID = os.path.basename(LIGAND_FILE).split('.')[0]
+else:
+    LIGANDS = [(LIGAND_ID, LIGAND_SMILES, LIGAND_SDF)]
 PDB_FILE = args.pdb_file
 OUT_PATH = args.out_path
 MODEL_OPT = args.model_opt
 FOLD = args.fold
-RES_START = args.res_start
-RES_END = args.res_end
+NUM_WORKERS = args.num_workers
+BATCH_SIZE = args.batch_size
+FAST = args.fast
+COMBINATORIAL = args.combinatorial
+COMPARE_POSITIONS = args.compare_positions
 MUTATIONS=args.mutations
 NUM_MODELLER_ATTEMPTS = args.num_modeller_attempts
 
@@ -63,12 +105,14 @@ print("#"*50)
 print(f"LIGAND_SMILES: {LIGAND_SMILES}")
 print(f"   LIGAND_SDF: {LIGAND_SDF}")
 print(f"    LIGAND_ID: {LIGAND_ID}")
+print(f"  N_LIGANDS: {len(LIGANDS)}")
 print(f"     PDB_FILE: {PDB_FILE}")
 print(f"     OUT_PATH: {OUT_PATH}")
 print(f"      OUT_DIR: {OUT_DIR}")
 
-print(f"\n    RES_START: {RES_START}")
-print(f"      RES_END: {RES_END}")
+print(f"\n  NUM_WORKERS: {NUM_WORKERS}")
+print(f"   BATCH_SIZE: {BATCH_SIZE}")
+print(f"         FAST: {FAST}")
 
 print(f"\n    MUTATIONS: {MUTATIONS}")
 
@@ -78,21 +122,25 @@ print(f"ONLY_DOWNLOAD: {ONLY_DOWNLOAD}")
 print("#"*50, end="\n\n")
 os.makedirs(OUT_DIR, exist_ok=True)
 
-import numpy as np
 import torch
-from tqdm import tqdm
+import numpy as np
 
 from src import TUNED_MODEL_CONFIGS
 from src.utils.loader import Loader
-from src.utils.residue import ResInfo
 from src.data_prep.quick_prep import get_ligand_features, get_protein_features
-from src.utils.mutate_model import run_modeller_multiple, run_modeller
+from src.utils.mutate_model import run_modeller_multiple
+from src.utils.mutagenesis import (MutantPredictor, run_saturation, run_fast_saturation, 
+                                  compare_fast_to_modeller, run_combinatorial, start_pool)
 
 
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 MODEL_PARAMS = TUNED_MODEL_CONFIGS[MODEL_OPT]
 PDB_FILE_NAME = os.path.basename(PDB_FILE).split('.pdb')[0]
 
+# Modeller workers are forked, so they need to be started before the model touches the gpu
+USES_POOL = not ONLY_DOWNLOAD and not MUTATIONS and (COMBINATORIAL or not FAST or COMPARE_POSITIONS > 0)
+POOL = start_pool(NUM_WORKERS) if USES_POOL else None
+
 ##################################################
 ### Loading the model and get original pkd value #
 ##################################################
@@ -104,57 +152,65 @@ if ONLY_DOWNLOAD:
     logging.critical("ONLY DOWNLOAD OPTION SET, EXITING")
     exit()
 
-# build ligand graph
-lig = get_ligand_features(LIGAND_SMILES, MODEL_PARAMS['lig_feat_opt'], MODEL_PARAMS['lig_edge_opt'], LIGAND_SDF)
+# build ligand graph(s)
+ligs = [get_ligand_features(smi, MODEL_PARAMS['lig_feat_opt'], MODEL_PARAMS['lig_edge_opt'], sdf)
+        for _, smi, sdf in LIGANDS]
+lig = ligs if LIGAND_FILE else ligs[0]
 
 # build protein graph
 pro, pdb_original = get_protein_features(PDB_FILE, MODEL_PARAMS['feature_opt'], MODEL_PARAMS['edge_opt'])
 original_seq = pdb_original.sequence
 
-original_pkd = MODEL(pro.to(DEVICE), lig.to(DEVICE))
+predictor = MutantPredictor(MODEL, lig, DEVICE)
+original_pkd = predictor([pro])[0]
 print("Original pkd:", original_pkd, end="\n\n")
 
+if LIGAND_FILE: # ligand order for the last dim of the output matrices
+    with open(f'{OUT_DIR}/ligands.json', 'w') as f:
+        json.dump([l[0] for l in LIGANDS], f, indent=2)
+
 if MUTATIONS:
     mut_pdb_file = run_modeller_multiple(PDB_FILE, MUTATIONS, n_attempts=NUM_MODELLER_ATTEMPTS)
     print(mut_pdb_file)
     pro, _ = get_protein_features(mut_pdb_file, MODEL_PARAMS['feature_opt'], MODEL_PARAMS['edge_opt'])
-    mut_pkd = MODEL(pro.to(DEVICE), lig.to(DEVICE))
+    mut_pkd = predictor([pro])[0]
     print("\nMutated pkd:", mut_pkd)
+elif COMBINATORIAL:
+    COMBO_DIR = f"{OUT_DIR}/{PDB_FILE_NAME}_combinatorial"
+    print("Saving combinatorial scan results to", COMBO_DIR)
+    df = run_combinatorial(MODEL, lig, pro, PDB_FILE, COMBO_DIR, 
+                           MODEL_PARAMS['feature_opt'], MODEL_PARAMS['edge_opt'], DEVICE,
+                           max_order=args.max_order, top_k=args.top_k, positions=args.positions,
+                           rank_by=args.rank_by, n_attempts=NUM_MODELLER_ATTEMPTS, num_workers=NUM_WORKERS,
+                           batch_size=BATCH_SIZE, pool=POOL)
+    print(df.groupby('order').head(args.top_k).to_string())
+elif FAST:
+    logging.warning("No mutations were passed in - running fast (structure-free) saturation mutagenesis")
+    OUT_FP = f"{OUT_DIR}/0_{len(original_seq)}-{PDB_FILE_NAME}_fast.npy"
+    print("Saving mutagenesis numpy matrix to", OUT_FP)
+    fast_matrix = run_fast_saturation(MODEL, lig, pro, MODEL_PARAMS['feature_opt'], MODEL_PARAMS['edge_opt'], 
+                                      DEVICE, batch_size=BATCH_SIZE)
+    np.save(OUT_FP, fast_matrix)
+    
+    if COMPARE_POSITIONS > 0:
+        report = compare_fast_to_modeller(MODEL, lig, pro, PDB_FILE, MODEL_PARAMS['feature_opt'], 
+                                          MODEL_PARAMS['edge_opt'], DEVICE, fast_matrix=fast_matrix,
+                                          n_positions=COMPARE_POSITIONS, n_attempts=NUM_MODELLER_ATTEMPTS,
+                                          num_workers=NUM_WORKERS, pool=POOL)
+        REPORT_FP = OUT_FP.replace('.npy', '_report.json')
+        with open(REPORT_FP, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(json.dumps(report, indent=2))
+        print("Saved comparison report to", REPORT_FP)
 else:
     logging.warning("No mutations were passed in - running full saturation mutagenesis")
-    # zero indexed res range to mutate:
-    res_range = (max(RES_START, 0), min(RES_END, len(original_seq)))
-    
-    amino_acids = ResInfo.amino_acids[:-1] # not including "X" - unknown
-    muta = np.zeros(shape=(len(amino_acids), len(original_seq)))
-
-    with tqdm(range(*res_range), ncols=100, total=(res_range[1]-res_range[0]), 
-              desc='Saturation mutagenesis') as t:
-        for j in t:
-            for i, AA in enumerate(amino_acids):
-                if i%2 == 0:
-                    t.set_postfix(res=j, AA=i+1)
-                
-                if original_seq[j] == AA: # skip same AA modifications 
-                    muta[i,j] = original_pkd
-                    continue
-                try:
-                    out_pdb_fp = run_modeller(PDB_FILE, j+1, ResInfo.code_to_pep[AA], "A", n_attempts=NUM_MODELLER_ATTEMPTS)
-                except OverflowError as e:
-                    muta[i,j] = np.nan
-                    continue
-                
-                pro, _ = get_protein_features(out_pdb_fp, MODEL_PARAMS['feature_opt'], MODEL_PARAMS['edge_opt'])
-                assert pro.pro_seq != original_seq and pro.pro_seq[j] == AA, \
-                    f"ERROR in modeller, {pro.pro_seq} == {original_seq} \nor {pro.pro_seq[j]} != {AA}"
-                
-                muta[i,j] = MODEL(pro.to(DEVICE), lig.to(DEVICE))
-                
-                # delete after use
-                os.remove(out_pdb_fp)
-
-
-    # Save mutagenesis matrix
-    OUT_FP = f"{OUT_DIR}/{res_range[0]}_{res_range[1]}-{os.path.basename(PDB_FILE).split('.pdb')[0]}.npy"
+    OUT_FP = f"{OUT_DIR}/0_{len(original_seq)}-{PDB_FILE_NAME}.npy"
     print("Saving mutagenesis numpy matrix to", OUT_FP)
-    np.save(OUT_FP, muta)
\ No newline at end of file
+    run_saturation(MODEL, lig, pro, PDB_FILE, OUT_FP, 
+                   MODEL_PARAMS['feature_opt'], MODEL_PARAMS['edge_opt'], DEVICE,
+                   n_attempts=NUM_MODELLER_ATTEMPTS, num_workers=NUM_WORKERS,
+                   batch_size=BATCH_SIZE, pool=POOL)
+
+if POOL is not None:
+    POOL.close()
+    POOL.join()
@@ -9,11 +9,20 @@ parser.add_argument('--fold', type=int, default=1,
                     help='Which model fold to use (there are 5 models for each option due to 5-fold CV).')
 parser.add_argument('--out_dir', type=str, default='./', 
                     help='Output directory path to save csv file for prediction results.')
+parser.add_argument('--batch_size', type=int, default=128,
+                    help='Batch size for inference (default: 128).')
+parser.add_argument('--out_fmt', type=str, default='csv', choices=['csv', 'parquet'],
+                    help='"csv" writes {out_dir}/{model_key}_PLATINUM.csv, "parquet" appends to a shared dataset '+\
+                        'at {out_dir}/PLATINUM/ partitioned by model/fold (safe for concurrent jobs).')
+parser.add_argument('--overwrite', action='store_true',
+                    help='Replace an existing {out_dir}/{model_key}_PLATINUM.csv (csv only), otherwise '+\
+                        'an existing file is an error.')
 
 args = parser.parse_args()
 MODEL_OPT = args.model_opt
 FOLD = args.fold
 OUT_DIR = args.out_dir
+OUT_FMT = args.out_fmt
 
 import logging
 logging.getLogger().setLevel(logging.DEBUG)
@@ -30,6 +39,7 @@ from src import cfg
 from src import TUNED_MODEL_CONFIGS
 from src.utils.loader import Loader
 from src.train_test.training import test
+from src.utils.predictions import PredictionWriter
 
 DEVICE = torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
 MODEL_PARAMS = TUNED_MODEL_CONFIGS[MODEL_OPT]
@@ -41,6 +51,11 @@ MODEL_KEY = Loader.get_model_key(**model_kwargs)
 model.to(DEVICE)
 model.eval()
 
+# one csv per model key, checked before inference so a rerun doesnt fail only after all the work
+OUT_P = f'{OUT_DIR}/{MODEL_KEY}_PLATINUM.csv' if OUT_FMT == 'csv' else f'{OUT_DIR}/PLATINUM'
+if OUT_FMT == 'csv' and os.path.isfile(OUT_P) and not args.overwrite:
+    raise FileExistsError(f"'{OUT_P}' already exists, pass --overwrite to replace it.")
+
 ### Loading the data and Test
 logging.debug("Loading platinum test dataloader for model")
 loaders = Loader.load_DataLoaders(cfg.DATA_OPT.platinum,
@@ -48,19 +63,25 @@ loaders = Loader.load_DataLoaders(cfg.DATA_OPT.platinum,
                                edge_opt       = MODEL_PARAMS['edge_opt'],
                                ligand_feature = MODEL_PARAMS['lig_feat_opt'], 
                                ligand_edge    = MODEL_PARAMS['lig_edge_opt'],
-                               datasets=['test'])
+                               datasets=['test'],
+                               batch_test     = args.batch_size,
+                               **Loader.tuned_loader_kwargs(MODEL_OPT))
 
 logging.debug("Running inference on test loader")
-loss, pred, actual = test(model, loaders['test'], DEVICE, verbose=True)
+loss, pred, actual, ids = test(model, loaders['test'], DEVICE, verbose=True, return_ids=True)
 
-# save as a CSV with cols: code, prot_id, pred, actual
-logging.debug(f"Saving output to '{OUT_DIR}/{MODEL_KEY}_PLATINUM.csv'")
+# save with cols: code, prot_id, pred, actual (+ model, fold for parquet partitions)
 df = pd.DataFrame({
-    'prot_id': [b['prot_id'][0] for b in loaders['test']], 
+    'prot_id': ids['prot_id'], 
     'pred': pred, 
     'actual': actual
     },
-    index=[b['code'][0] for b in loaders['test']])
+    index=ids['code'])
 
 df.index.name = 'code'
-df.to_csv(f'{OUT_DIR}/{MODEL_KEY}_PLATINUM.csv')
\ No newline at end of file
+if OUT_FMT == 'csv':
+    if os.path.isfile(OUT_P): os.remove(OUT_P) # only reached with --overwrite
+else:
+    df['model'], df['fold'] = MODEL_OPT, FOLD
+logging.debug(f"Saving output to '{OUT_P}'")
+PredictionWriter(OUT_P, fmt=OUT_FMT).write(df, index=True)
\ No newline at end of file
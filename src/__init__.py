@@ -2,6 +2,17 @@ from src.utils import config
 from src.utils import config as cfg
 
 
+# DataLoader performance options (see `Loader.dataloader_kwargs`), same defaults as the CLI 
+# (`arg_parse.add_dataset_args`). Tuned configs can override these with a 'loader_kwargs' 
+# entry (see `Loader.tuned_loader_kwargs`).
+DEFAULT_LOADER_KWARGS = {
+    'num_workers': 0,
+    'persistent_workers': True,
+    'prefetch_factor': 2,
+    'pin_memory': False,
+    'mmap': False,
+}
+
 TUNED_MODEL_CONFIGS = {
     #DGM_davis0D_nomsaF_binaryE_128B_0.00012LR_0.24D_2000E.model
     'davis_DG':{
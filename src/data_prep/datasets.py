@@ -25,6 +25,8 @@ from src.data_prep.feature_extraction.protein import (multi_save_cmaps,
                                                       multi_get_sequences, 
                                                       target_to_graph,)
 from src.data_prep.feature_extraction.protein_edges import get_target_edge_weights
+from src.data_prep.feature_extraction.compact import (encode_graphs, encode_protein, 
+                                                      encode_ligand, decode_graph)
 from src.data_prep.processors import PDBbindProcessor, Processor
 from src.data_prep.downloaders import Downloader
 
@@ -48,6 +50,9 @@ class BaseDataset(torchg.data.InMemoryDataset, abc.ABC):
                  ligand_feature:str='original', 
                  ligand_edge:str='binary',
                  verbose=False,
+                 gcn_norm=False,
+                 compact=False,
+                 mmap=False,
                  *args, **kwargs):
         """
         Base class for datasets. This class is used to create datasets for 
@@ -91,10 +96,30 @@ class BaseDataset(torchg.data.InMemoryDataset, abc.ABC):
         `only_dowwnload` : bool, optional
             If you only want to download the raw files and not prepare the dataset set 
             this to true, by default False. 
+        `gcn_norm` : bool, optional
+            Precomputes GCN normalized edges (`gcn_edge_index`, `gcn_edge_weight`) for each protein 
+            and ligand graph so that GCNConv layers dont have to recompute `gcn_norm` for the same 
+            graph every step (see `src.models.utils.gcn_conv`). Norms are only added in memory on 
+            load (never saved to the processed files) and stripped on load when False, by default False.
+        `compact` : bool, optional
+            Stores node features as uint8 residue/atom codes plus any continuous channels (e.g.: pssm) 
+            instead of dense float matrices, these are expanded back to the exact same features in 
+            `__getitem__` (see `feature_extraction.compact`). Graphs are only compacted in memory on 
+            load, the saved graphs stay dense since they share the same processed paths as non-compact 
+            datasets, by default False.
+        `mmap` : bool, optional
+            Memory maps the saved protein and ligand graphs (`torch.load(..., mmap=True)`) instead of 
+            reading them into memory, so that dataloader workers share the same pages from the page 
+            cache instead of each touching (and copying) their own, by default False. Only the saved 
+            tensors are mapped, node features compacted on load (`compact`) and GCN norms added on load 
+            (`gcn_norm` for datasets saved without them) are regular in-memory tensors.
             
         *args and **kwargs sent to superclass `torch_geometric.data.InMemoryDataset`.
         """
         self.verbose = verbose
+        self.gcn_norm = gcn_norm
+        self.compact = compact
+        self.mmap = mmap
         self.data_root = data_root
         self.cmap_threshold = cmap_threshold
         self.overwrite = overwrite
@@ -245,8 +270,59 @@ class BaseDataset(torchg.data.InMemoryDataset, abc.ABC):
         self.df = pd.read_csv(self.processed_paths[3], index_col=0)
         
         self._indices = self.df.index
-        self._data_pro = torch.load(self.processed_paths[1])
-        self._data_mol = torch.load(self.processed_paths[2])
+        load_kwargs = {'mmap': True} if self.mmap else {}
+        self._data_pro = torch.load(self.processed_paths[1], **load_kwargs)
+        self._data_mol = torch.load(self.processed_paths[2], **load_kwargs)
+        
+        # norms are never saved to the shared processed files, only added in memory
+        if self.gcn_norm:
+            self._add_gcn_norms(self._data_pro, self._data_mol)
+        else: # strip norms saved by older builds so gcn_conv doesnt pick them up
+            self.drop_gcn_norm(self._data_pro)
+            self.drop_gcn_norm(self._data_mol)
+        if self.compact:
+            if self.mmap:
+                logging.warning('compact node features are built in memory, only the edges stay memory mapped')
+            self._compact_graphs(self._data_pro, self._data_mol)
+        
+    @staticmethod
+    def add_gcn_norm(graphs:dict[str, torchg.data.Data]) -> dict[str, torchg.data.Data]:
+        """
+        Adds `gcn_edge_index` and `gcn_edge_weight` (self loops + symmetric degree normalization) 
+        inplace to each graph. Graphs with multi-dim edge attributes (e.g.: ring3) are skipped since 
+        GCNConv cant use them as weights.
+        """
+        from torch_geometric.nn.conv.gcn_conv import gcn_norm
+        for g in graphs.values():
+            if 'gcn_edge_weight' in g or 'edge_index' not in g:
+                continue
+            ew = getattr(g, 'edge_weight', None)
+            if ew is not None and ew.dim() > 1:
+                continue
+            g.gcn_edge_index, g.gcn_edge_weight = gcn_norm(g.edge_index, ew, num_nodes=g.num_nodes,
+                                                           add_self_loops=True)
+        return graphs
+    
+    @staticmethod
+    def drop_gcn_norm(graphs:dict[str, torchg.data.Data]) -> dict[str, torchg.data.Data]:
+        """Removes any `gcn_edge_index` and `gcn_edge_weight` inplace from each graph."""
+        for g in graphs.values():
+            for k in ('gcn_edge_index', 'gcn_edge_weight'):
+                if k in g: del g[k]
+        return graphs
+    
+    def _add_gcn_norms(self, prots:dict, ligs:dict):
+        # gvp graphs dont go through GCNConv layers
+        if self.pro_feat_opt != cfg.PRO_FEAT_OPT.gvp:
+            self.add_gcn_norm(prots)
+        if self.ligand_feature != cfg.LIG_FEAT_OPT.gvp:
+            self.add_gcn_norm(ligs)
+        
+    def _compact_graphs(self, prots:dict, ligs:dict):
+        if self.pro_feat_opt in [cfg.PRO_FEAT_OPT.nomsa, cfg.PRO_FEAT_OPT.msa, cfg.PRO_FEAT_OPT.shannon]:
+            encode_graphs(prots, encode_protein)
+        if self.ligand_feature == cfg.LIG_FEAT_OPT.original:
+            encode_graphs(ligs, encode_ligand)
         
     def __len__(self):
         return len(self.df)
@@ -259,8 +335,8 @@ class BaseDataset(torchg.data.InMemoryDataset, abc.ABC):
         
         return {'code': code, 'prot_id': prot_id, 
                 'y': row['pkd'],
-                'protein': self._data_pro[prot_id],
-                'ligand': self._data_mol[lig_seq]}
+                'protein': decode_graph(self._data_pro[prot_id]),
+                'ligand': decode_graph(self._data_mol[lig_seq])}
         
     def save_subset(self, idxs:Iterable[int]|data.Sampler|data.DataLoader, 
                     subset_name:str)->str:
@@ -296,6 +372,18 @@ class BaseDataset(torchg.data.InMemoryDataset, abc.ABC):
             paths.append(p)
         return paths        
     
+    def subset_indices(self, subset_name:str) -> np.ndarray:
+        """
+        Positions in `self.df` of the rows in a saved subset (e.g.: train0, val0) so that folds can be 
+        built as views of an already loaded dataset instead of loading each subset's graphs again.
+        """
+        fp = os.path.join(self.root, subset_name, self.processed_file_names[3])
+        assert os.path.isfile(fp), f"Subset {subset_name} does not exist!"
+        codes = pd.read_csv(fp, index_col=0).index
+        idxs = self.df.index.get_indexer(codes)
+        assert (idxs >= 0).all(), f"Subset {subset_name} has {(idxs < 0).sum()} rows not in {self.subset}"
+        return idxs
+    
     def load_subset(self, subset_name:str):
         path = os.path.join(self.root, subset_name)
         
@@ -0,0 +1,109 @@
+"""
+Compact encoding for protein and ligand node features.
+
+Most of the node features we save are categorical and are fully determined by a few small integers per node:
+    - Proteins (nomsa/msa/shannon): [pssm (21 or 1) | one-hot residue (21) | residue properties (12)]
+      where the one-hot and properties only depend on the residue letter, and for nomsa the pssm is all zeros.
+    - Ligands (original): [symbol (44) | degree (11) | num Hs (11) | implicit valence (11) | aromatic (1)]
+      divided by their sum (4 + aromatic).
+
+Compact graphs replace `x` with uint8 category codes (`x_res` for proteins, `x_atom` for ligands) plus any
+continuous channels (`x_cont`, the pssm block) and are expanded back to the exact float32 features with
+lookup tables by `decode_graph`.
+"""
+import torch
+import torch_geometric as torchg
+
+from src.utils.residue import ResInfo
+from src.data_prep.feature_extraction.protein_nodes import target_to_feature
+
+N_RES = len(ResInfo.amino_acids)
+PRO_RES_DIM = N_RES + 12 # one-hot + properties
+LIG_BLOCKS = [44, 11, 11, 11] # symbol, degree, Hs, implicit valence (+1 aromatic)
+LIG_DIM = sum(LIG_BLOCKS) + 1
+
+_PRO_TABLE = None
+
+def _pro_table() -> torch.Tensor:
+    """[N_RES, 33] lookup table of one-hot + property features for each residue code."""
+    global _PRO_TABLE
+    if _PRO_TABLE is None:
+        pro_hot, pro_property = target_to_feature(ResInfo.amino_acids)
+        _PRO_TABLE = torch.cat((torch.Tensor(pro_hot), torch.Tensor(pro_property)), axis=1)
+    return _PRO_TABLE
+
+def _copy_without(data:torchg.data.Data, keys:list[str], **kwargs) -> torchg.data.Data:
+    attrs = {k: v for k, v in data.items() if k not in keys}
+    return torchg.data.Data(**attrs, **kwargs)
+
+def encode_protein(data:torchg.data.Data) -> torchg.data.Data:
+    """
+    Returns compact version of protein graph or the original graph if its features
+    cannot be exactly rebuilt from residue codes.
+    """
+    x = data.x
+    n_pssm = x.shape[1] - PRO_RES_DIM
+    if n_pssm not in [1, N_RES]:
+        return data
+
+    codes = x[:, n_pssm:n_pssm+N_RES].argmax(dim=1).to(torch.uint8)
+    pssm = x[:, :n_pssm]
+    if n_pssm == N_RES and not pssm.any(): # nomsa, pssm is all zeros
+        pssm = pssm[:, :0]
+
+    compact = _copy_without(data, ['x'], x_res=codes, x_cont=pssm.clone(), num_nodes=x.shape[0])
+    if not torch.equal(decode_protein(compact).x, x):
+        return data
+    return compact
+
+def decode_protein(data:torchg.data.Data) -> torchg.data.Data:
+    x_res = _pro_table()[data.x_res.long()]
+    pssm = data.x_cont
+    if pssm.shape[1] == 0:
+        pssm = torch.zeros((x_res.shape[0], N_RES))
+    return _copy_without(data, ['x_res', 'x_cont', 'num_nodes'], x=torch.cat((pssm, x_res), axis=1))
+
+def encode_ligand(data:torchg.data.Data) -> torchg.data.Data:
+    """
+    Returns compact version of ligand graph or the original graph if its features
+    cannot be exactly rebuilt from atom codes.
+    """
+    x = data.x
+    if x.shape[1] != LIG_DIM:
+        return data
+
+    codes, start = [], 0
+    for size in LIG_BLOCKS:
+        codes.append(x[:, start:start+size].argmax(dim=1))
+        start += size
+    codes.append((x[:, -1] > 0).long())
+    codes = torch.stack(codes, dim=1).to(torch.uint8) # [N, 5]
+
+    compact = _copy_without(data, ['x'], x_atom=codes, num_nodes=x.shape[0])
+    if not torch.equal(decode_ligand(compact).x, x):
+        return data
+    return compact
+
+def decode_ligand(data:torchg.data.Data) -> torchg.data.Data:
+    codes = data.x_atom.long()
+    x = torch.cat([torch.nn.functional.one_hot(codes[:, i], size) for i, size in enumerate(LIG_BLOCKS)] +
+                  [codes[:, -1:]], dim=1).double()
+    # same normalization as `smile_to_graph`, done in float64 to match numpy
+    x = (x / x.sum(dim=1, keepdim=True)).float()
+    return _copy_without(data, ['x_atom', 'num_nodes'], x=x)
+
+def decode_graph(data:torchg.data.Data) -> torchg.data.Data:
+    """Expands compact graphs back to their float features, returns all other graphs as is."""
+    if 'x_res' in data:
+        return decode_protein(data)
+    if 'x_atom' in data:
+        return decode_ligand(data)
+    return data
+
+def encode_graphs(graphs:dict[str, torchg.data.Data],
+                  encode_fn=encode_protein) -> dict[str, torchg.data.Data]:
+    """Encodes all graphs in dict inplace (skips graphs that are already compact)"""
+    for k, g in graphs.items():
+        if 'x' in g:
+            graphs[k] = encode_fn(g)
+    return graphs
@@ -1,5 +1,6 @@
-import os
+import os, time
 
+import numpy as np
 import torch
 import torch_geometric as torchg
 
@@ -43,10 +44,155 @@ def get_protein_features(pdb_file_path, feature_opt, edge_opt, prot_id=None, cma
     return pro, pdb
 
 
+def _timed_protein_features(pdb_file_path, feature_opt, edge_opt):
+    t0 = time.perf_counter()
+    pro, _ = get_protein_features(pdb_file_path, feature_opt, edge_opt)
+    return pro, time.perf_counter() - t0
+
+
+def iter_protein_batches(pdb_files:list[str], feature_opt:str, edge_opt:str, batch_size:int, 
+                         num_workers:int=0, prefetch:int=2):
+    """
+    Returns an iterator over batches of protein graphs in order as (batch pdb files, graphs, featurization 
+    seconds), where the seconds are summed over the graphs in the batch (i.e.: cpu time, not wall time).
+
+    With `num_workers` > 0 the graphs are built in a process pool and up to `prefetch` batches are queued
+    ahead of the one being consumed so that featurization overlaps with whatever the caller does with
+    each batch (e.g.: running the model). The first batches are submitted as soon as this is called.
+
+    Parameters
+    ----------
+    `pdb_files` : list[str]
+        Paths to the pdb files to featurize.
+    `batch_size` : int
+        Number of graphs per batch.
+    `num_workers` : int, optional
+        Number of featurization processes, 0 to build graphs serially in this process, by default 0
+    `prefetch` : int, optional
+        Max number of batches queued ahead of the current one, by default 2
+    """
+    batches = [pdb_files[i:i+batch_size] for i in range(0, len(pdb_files), batch_size)]
+    if num_workers <= 0:
+        def serial():
+            for b in batches:
+                out = [_timed_protein_features(fp, feature_opt, edge_opt) for fp in b]
+                yield b, [p for p, _ in out], sum(t for _, t in out)
+        return serial()
+    
+    import multiprocessing as mp
+    from collections import deque
+    from concurrent.futures import ProcessPoolExecutor
+    # fork so that workers dont re-run the calling script, they never touch cuda. Executor workers are not 
+    # daemonic so edge options that spawn their own pools (e.g.: aflow) still work.
+    pool = ProcessPoolExecutor(num_workers, mp_context=mp.get_context('fork'))
+    queue = deque()
+    def submit(k):
+        if k < len(batches):
+            queue.append((batches[k], [pool.submit(_timed_protein_features, fp, feature_opt, edge_opt)
+                                       for fp in batches[k]]))
+    for k in range(prefetch + 1):
+        submit(k)
+    
+    def pipelined():
+        try:
+            for k in range(len(batches)):
+                if k > 0: submit(k + prefetch) # previous batch was consumed
+                b, futures = queue.popleft()
+                out = [f.result() for f in futures]
+                yield b, [p for p, _ in out], sum(t for _, t in out)
+        finally:
+            pool.shutdown(cancel_futures=True)
+    return pipelined()
+
+
 def get_ligand_features(lig_smile, lig_feat, lig_edge, lig_sdf=None):
     if lig_feat == cfg.LIG_FEAT_OPT.gvp:
         from src.data_prep.feature_extraction.gvp_feats import GVPFeaturesLigand
         return GVPFeaturesLigand().featurize_as_graph(lig_sdf) # returns torch_geometric.data.Data(x=coords, edge_index=edge_index, name=name,node_v=node_v, node_s=node_s, edge_v=edge_v, edge_s=edge_s)
     else:
         mol_feat, mol_edge = smile_to_graph(lig_smile, lig_feature=lig_feat, lig_edge=lig_edge)
-        return torchg.data.Data(x=torch.Tensor(mol_feat), edge_index=torch.LongTensor(mol_edge), lig_seq=lig_smile)
\ No newline at end of file
+        return torchg.data.Data(x=torch.Tensor(mol_feat), edge_index=torch.LongTensor(mol_edge), lig_seq=lig_smile)
+
+class IncrementalProteinFeatures:
+    """
+    Builds protein graphs for point mutants of a single wild-type structure (same output as 
+    `get_protein_features`) without recomputing the full LxL contact map.
+
+    Residues whose representative coordinate (CB, or CA for glycine) moved or whose identity changed are 
+    detected by diffing against the wild-type, and only their rows and columns of the distance matrix and
+    edge index are recomputed. All other edges are copied from the wild-type graph.
+
+    Only nomsa features with binary edges are supported since all other options either need an alignment
+    or edge weights computed from the full structure.
+    """
+    def __init__(self, pdb_wt:str, feature_opt:str, edge_opt:str, cmap_thresh:float=8.0, atol:float=1e-3):
+        """
+        Parameters
+        ----------
+        `pdb_wt` : str
+            Path to the wild-type structure.
+        `cmap_thresh` : float, optional
+            Distance threshold for an edge, by default 8.0
+        `atol` : float, optional
+            Residues that moved by more than this (in Angstroms) are recomputed, by default 1e-3
+        """
+        assert self.supported(feature_opt, edge_opt), \
+            f'Incremental features not supported for {feature_opt} features with {edge_opt} edges'
+        self.feature_opt = feature_opt
+        self.cmap_thresh = cmap_thresh
+        self.atol = atol
+        
+        self.pro_wt, chain_wt = get_protein_features(pdb_wt, feature_opt, edge_opt, cmap_thresh=cmap_thresh)
+        self.coords = chain_wt.getCoords()
+        self.seq = chain_wt.sequence
+        self.n_changed = [] # number of recomputed residues for each mutant
+    
+    @staticmethod
+    def supported(feature_opt:str, edge_opt:str) -> bool:
+        return feature_opt == cfg.PRO_FEAT_OPT.nomsa and edge_opt == cfg.PRO_EDGE_OPT.binary
+    
+    def __call__(self, pdb_mut:str, prot_id:str=None) -> torchg.data.Data:
+        prot_id = prot_id or os.path.basename(pdb_mut).split('.pdb')[0]
+        pdb = Chain(pdb_mut)
+        coords, seq = pdb.getCoords(), pdb.sequence
+        L = len(self.seq)
+        assert len(seq) == L, f'Mutant length {len(seq)} != wild-type length {L} for {pdb_mut}'
+        
+        moved = np.linalg.norm(coords - self.coords, axis=1) > self.atol
+        mutated = np.array([a != b for a, b in zip(seq, self.seq)], dtype=bool)
+        changed = np.where(moved | mutated)[0]
+        self.n_changed.append(len(changed))
+        
+        # edges that dont touch a changed residue are the same as in the wild-type
+        ei = self.pro_wt.edge_index.numpy()
+        is_changed = np.zeros(L, dtype=bool)
+        is_changed[changed] = True
+        keep = ei[:, ~(is_changed[ei[0]] | is_changed[ei[1]])]
+        
+        # recompute rows (and by symmetry columns) of the distance matrix for changed residues 
+        # (same operations as `Chain.get_contact_map` so that distances match exactly)
+        dist = np.sqrt(np.sum((coords[changed, np.newaxis] - coords) ** 2, axis=-1)) # [C, L]
+        dist[np.arange(len(changed)), changed] = 0
+        src, dst = np.where(dist <= self.cmap_thresh)
+        src = changed[src]
+        col = ~is_changed[dst] # changed x changed pairs are already covered by the rows
+        new = np.concatenate([np.stack([src, dst]), np.stack([dst[col], src[col]])], axis=1)
+        
+        # same row-major order as np.where on the full contact map
+        edge_index = np.concatenate([keep, new], axis=1)
+        edge_index = edge_index[:, np.argsort(edge_index[0] * L + edge_index[1], kind='stable')]
+        
+        x = self.pro_wt.x.clone()
+        if mutated.any():
+            idx = np.where(mutated)[0]
+            sub_seq = ''.join(seq[i] for i in idx)
+            _, feat, _ = target_to_graph(sub_seq, np.zeros((len(idx), len(idx))), 
+                                         threshold=self.cmap_thresh, pro_feat=self.feature_opt)
+            x[idx] = torch.Tensor(feat)
+        
+        pro = torchg.data.Data(x=x,
+                               edge_index=torch.LongTensor(edge_index),
+                               pro_seq=seq,
+                               prot_id=prot_id,
+                               edge_weight=None)
+        return pro, pdb
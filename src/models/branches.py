@@ -11,7 +11,7 @@ from transformers import AutoTokenizer, EsmModel
 from transformers.utils import logging
 
 from torch_scatter import scatter_mean 
-from src.models.utils import GVP, GVPConvLayer, LayerNorm
+from src.models.utils import GVP, GVPConvLayer, LayerNorm, gcn_conv
 
 class ESMBranch(nn.Module):
     def __init__(self, esm_head:str='facebook/esm2_t6_8M_UR50D', 
@@ -91,17 +91,17 @@ class ESMBranch(nn.Module):
                                             training=self.training)
         
         # conv1
-        xt = self.conv1(xt, ei_drp, ew[e_mask] if ew is not None else ew)
+        xt = gcn_conv(self.conv1, xt, data, ei_drp, ew, e_mask)
         xt = self.relu(xt)
         ei_drp, e_mask, _ = dropout_node(ei, p=self.dropout_gnn, num_nodes=target_x.shape[0], 
                                         training=self.training)
         # conv2
-        xt = self.conv2(xt, ei_drp, ew[e_mask] if ew is not None else ew)
+        xt = gcn_conv(self.conv2, xt, data, ei_drp, ew, e_mask)
         xt = self.relu(xt)
         ei_drp, e_mask, _ = dropout_node(ei, p=self.dropout_gnn, num_nodes=target_x.shape[0], 
                                         training=self.training)
         # conv3
-        xt = self.conv3(xt, ei_drp, ew[e_mask] if ew is not None else ew)
+        xt = gcn_conv(self.conv3, xt, data, ei_drp, ew, e_mask)
         xt = self.relu(xt)
 
         # flatten/pool
@@ -0,0 +1,103 @@
+"""
+Runs all k-fold checkpoints of a tuned model as a single module.
+
+The trainable parameters and buffers of each fold are stacked along a new leading dimension and
+evaluated in one pass with `torch.func.vmap` + `functional_call`. Frozen pretrained sub-modules
+(e.g.: `esm_mdl`) are identical across folds, so only a single copy is kept and shared. Since they are
+not batched by vmap, their forward pass is also only computed once per batch.
+
+Not every op used by our models supports vmap (e.g.: some torch_scatter kernels), in that case we fall
+back to a serial loop over the stacked parameters, which still avoids keeping k full models in memory.
+"""
+import logging
+import torch
+from torch import nn
+from torch.func import functional_call, vmap
+
+from src.models.utils import BaseModel, get_frozen_prefixes
+
+
+class FoldEnsemble(nn.Module):
+    def __init__(self, base:BaseModel, state_dicts:list[dict], use_vmap:bool=True):
+        """
+        Parameters
+        ----------
+        `base` : BaseModel
+            Model used as the stateless template, also holds the shared frozen weights.
+        `state_dicts` : list[dict]
+            state_dict for each fold (all must match the keys of `base`).
+        `use_vmap` : bool, optional
+            Try to evaluate all folds in a single vectorized pass, by default True
+        """
+        super().__init__()
+        assert len(state_dicts) > 0, "Need at least one state_dict for ensemble"
+        self.n_folds = len(state_dicts)
+        self.use_vmap = use_vmap
+
+        self.base = base.eval()
+        self.shared_prefixes = get_frozen_prefixes(self.base)
+
+        def is_shared(name):
+            return any(name.startswith(p + '.') for p in self.shared_prefixes)
+
+        param_names = [n for n, _ in self.base.named_parameters() if not is_shared(n)]
+        buffer_names = [n for n in self.base.state_dict() 
+                        if n not in param_names and not is_shared(n)]
+
+        self.stacked_params = {n: torch.stack([sd[n].detach() for sd in state_dicts])
+                               for n in param_names}
+        self.stacked_buffers = {n: torch.stack([sd[n] for sd in state_dicts])
+                                for n in buffer_names}
+
+    @classmethod
+    def from_models(cls, models:list[BaseModel], **kwargs) -> 'FoldEnsemble':
+        return cls(models[0], [m.state_dict() for m in models], **kwargs)
+
+    def to(self, *args, **kwargs):
+        super().to(*args, **kwargs)
+        self.stacked_params = {k: v.to(*args, **kwargs) for k, v in self.stacked_params.items()}
+        self.stacked_buffers = {k: v.to(*args, **kwargs) for k, v in self.stacked_buffers.items()}
+        return self
+
+    def _fold_forward(self, params, buffers, *args):
+        return functional_call(self.base, (params, buffers), args)
+
+    def forward(self, *args) -> torch.Tensor:
+        """
+        Returns
+        -------
+        torch.Tensor
+            Predictions for every fold with shape [n_folds, B, 1]
+        """
+        if not self.use_vmap:
+            return self._serial_forward(*args)
+
+        try:
+            return vmap(lambda p, b: self._fold_forward(p, b, *args),
+                        randomness='different')(self.stacked_params, self.stacked_buffers)
+        except RuntimeError as e:
+            # missing batching rules and data-dependent ops raise RuntimeError while tracing.
+            # Other exceptions propagate as is, and a RuntimeError caused by the model/inputs
+            # themselves will be re-raised by the serial loop before vmap is disabled.
+            out = self._serial_forward(*args)
+            logging.warning(f'vmap not supported for {self.base.__class__.__name__}, '+\
+                            f'falling back to serial loop over folds: {e}')
+            self.use_vmap = False
+            return out
+
+    def _serial_forward(self, *args) -> torch.Tensor:
+        return torch.stack([
+            self._fold_forward({k: v[i] for k, v in self.stacked_params.items()},
+                               {k: v[i] for k, v in self.stacked_buffers.items()}, *args)
+            for i in range(self.n_folds)])
+
+    @torch.no_grad()
+    def predict(self, *args) -> tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+        """
+        Returns
+        -------
+        tuple[torch.Tensor, torch.Tensor, torch.Tensor]
+            mean [B, 1], std [B, 1], and per-fold predictions [n_folds, B, 1]
+        """
+        preds = self.forward(*args)
+        return preds.mean(dim=0), preds.std(dim=0), preds
@@ -12,7 +12,7 @@ from torch_geometric import data as geo_data
 from transformers import AutoTokenizer, EsmModel
 from transformers.utils import logging
 
-from src.models.utils import BaseModel
+from src.models.utils import BaseModel, gcn_conv
 
 class EsmDTA(BaseModel):
     def __init__(self, esm_head:str='facebook/esm2_t6_8M_UR50D', 
@@ -111,17 +111,17 @@ class EsmDTA(BaseModel):
                                             training=self.training)
         
         # conv1
-        xt = self.pro_conv1(xt, ei_drp, ew[e_mask] if ew is not None else ew)
+        xt = gcn_conv(self.pro_conv1, xt, data, ei_drp, ew, e_mask)
         xt = self.relu(xt)
         ei_drp, e_mask, _ = dropout_node(ei, p=self.dropout_gnn, num_nodes=target_x.shape[0], 
                                         training=self.training)
         # conv2
-        xt = self.pro_conv2(xt, ei_drp, ew[e_mask] if ew is not None else ew)
+        xt = gcn_conv(self.pro_conv2, xt, data, ei_drp, ew, e_mask)
         xt = self.relu(xt)
         ei_drp, e_mask, _ = dropout_node(ei, p=self.dropout_gnn, num_nodes=target_x.shape[0], 
                                         training=self.training)
         # conv3
-        xt = self.pro_conv3(xt, ei_drp, ew[e_mask] if ew is not None else ew)
+        xt = gcn_conv(self.pro_conv3, xt, data, ei_drp, ew, e_mask)
         xt = self.relu(xt)
 
         # flatten/pool
@@ -145,15 +145,15 @@ class EsmDTA(BaseModel):
         return xt
     
     def forward_mol(self, data):
-        x = self.mol_conv1(data.x, data.edge_index)
+        x = gcn_conv(self.mol_conv1, data.x, data, data.edge_index)
         x = self.relu(x)
 
         # mol_edge_index, _ = dropout_adj(mol_edge_index, training=self.training)
-        x = self.mol_conv2(x, data.edge_index)
+        x = gcn_conv(self.mol_conv2, x, data, data.edge_index)
         x = self.relu(x)
 
         # mol_edge_index, _ = dropout_adj(mol_edge_index, training=self.training)
-        x = self.mol_conv3(x, data.edge_index)
+        x = gcn_conv(self.mol_conv3, x, data, data.edge_index)
         x = self.relu(x)
         x = gep(x, data.batch)  # global pooling
 
@@ -182,8 +182,10 @@ class EsmDTA(BaseModel):
         """
         xm = self.forward_mol(data_mol)
         xp = self.forward_pro(data_pro)
-
-        # print(x.size(), xt.size())
+        return self.forward_head(xm, xp)
+    
+    def forward_head(self, xm, xp):
+        """Output layers on the ligand (`xm`) and protein (`xp`) embeddings"""
         # concat
         xc = torch.cat((xm, xp), 1)
         # add some dense layers
@@ -277,17 +279,17 @@ class SaProtDTA(EsmDTA):
                                             training=self.training)
         
         # conv1
-        xt = self.pro_conv1(xt, ei_drp, ew[e_mask] if ew is not None else ew)
+        xt = gcn_conv(self.pro_conv1, xt, data, ei_drp, ew, e_mask)
         xt = self.relu(xt)
         ei_drp, e_mask, _ = dropout_node(ei, p=self.dropout_gnn, num_nodes=target_x.shape[0], 
                                         training=self.training)
         # conv2
-        xt = self.pro_conv2(xt, ei_drp, ew[e_mask] if ew is not None else ew)
+        xt = gcn_conv(self.pro_conv2, xt, data, ei_drp, ew, e_mask)
         xt = self.relu(xt)
         ei_drp, e_mask, _ = dropout_node(ei, p=self.dropout_gnn, num_nodes=target_x.shape[0], 
                                         training=self.training)
         # conv3
-        xt = self.pro_conv3(xt, ei_drp, ew[e_mask] if ew is not None else ew)
+        xt = gcn_conv(self.pro_conv3, xt, data, ei_drp, ew, e_mask)
         xt = self.relu(xt)
         
         # flatten/pool
@@ -8,7 +8,7 @@ from torch_geometric.nn import (GCNConv,
 from torch_geometric.data import Data as Data_g
 from torch_geometric import nn as nn_g
 
-from src.models.utils import BaseModel
+from src.models.utils import BaseModel, gcn_conv
 from src.models.branches import GVPBranchProt, GVPBranchLigand, ESMBranch
 
 
@@ -78,15 +78,15 @@ class GVPLigand_DGPro(BaseModel):
         # if edge_weight doesnt exist no error is thrown it just passes it as None
         ew = data.edge_weight if self.edge_weight else None
 
-        xt = self.pro_conv1(target_x, ei, ew)
+        xt = gcn_conv(self.pro_conv1, target_x, data, ei, ew)
         xt = self.relu(xt)
 
         # target_edge_index, _ = dropout_adj(target_edge_index, training=self.training)
-        xt = self.pro_conv2(xt, ei, ew)
+        xt = gcn_conv(self.pro_conv2, xt, data, ei, ew)
         xt = self.relu(xt)
         
         # target_edge_index, _ = dropout_adj(target_edge_index, training=self.training)
-        xt = self.pro_conv3(xt, ei, ew)
+        xt = gcn_conv(self.pro_conv3, xt, data, ei, ew)
         xt = self.relu(xt)
 
         # xt = self.pro_conv4(xt, target_edge_index)
@@ -99,7 +99,9 @@ class GVPLigand_DGPro(BaseModel):
     def forward(self, data_pro, data_mol):
         xm = self.forward_mol(data_mol)
         xp = self.forward_pro(data_pro)
-
+        return self.forward_head(xm, xp)
+    
+    def forward_head(self, xm, xp):
         xc = torch.cat((xm, xp), 1)
         return self.dense_out(xc)
     def load_state_dict(self, state_dict: Mapping[str, Any], strict: bool = True):
@@ -157,7 +159,9 @@ class GVPL_ESM(BaseModel):
     def forward(self, data_pro, data_mol):
         xm = self.forward_mol(data_mol)
         xp = self.forward_pro(data_pro)
-
+        return self.forward_head(xm, xp)
+    
+    def forward_head(self, xm, xp):
         xc = torch.cat((xm, xp), 1)
         return self.dense_out(xc)
 
@@ -198,7 +202,9 @@ class GVPLigand_RNG3(BaseModel):
     def forward(self, data_pro:Data_g, data_mol:Data_g):
         xm = self.forward_mol(data_mol)
         xp = self.forward_pro(data_pro)
-        
+        return self.forward_head(xm, xp)
+    
+    def forward_head(self, xm, xp):
         # concat
         xc = torch.cat((xm, xp), 1)
         return self.dense_out(xc)
@@ -234,15 +240,15 @@ class GVPModel(BaseModel):
         self.out = nn.Linear(512, 1) # 1 output (binding affinity)            
         
     def forward_mol(self, data):
-        x = self.mol_conv1(data.x, data.edge_index)
+        x = gcn_conv(self.mol_conv1, data.x, data, data.edge_index)
         x = self.relu(x)
 
         # mol_edge_index, _ = dropout_adj(mol_edge_index, training=self.training)
-        x = self.mol_conv2(x, data.edge_index)
+        x = gcn_conv(self.mol_conv2, x, data, data.edge_index)
         x = self.relu(x)
 
         # mol_edge_index, _ = dropout_adj(mol_edge_index, training=self.training)
-        x = self.mol_conv3(x, data.edge_index)
+        x = gcn_conv(self.mol_conv3, x, data, data.edge_index)
         x = self.relu(x)
         x = gep(x, data.batch)  # global pooling
 
@@ -270,9 +276,13 @@ class GVPModel(BaseModel):
             output of the model
         """
         xm = self.forward_mol(data_mol)
-        xp = self.pro_branch(data_pro)
-
-        # print(x.size(), xt.size())
+        xp = self.forward_pro(data_pro)
+        return self.forward_head(xm, xp)
+    
+    def forward_pro(self, data):
+        return self.pro_branch(data)
+    
+    def forward_head(self, xm, xp):
         # concat
         xc = torch.cat((xm, xp), 1)
         # add some dense layers
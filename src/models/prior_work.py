@@ -9,7 +9,7 @@ from torch_geometric.utils import dropout_adj
 from torch_geometric.nn import summary
 from torch_geometric import data as geo_data
 
-from src.models.utils import BaseModel
+from src.models.utils import BaseModel, gcn_conv
 
 ################ DGraphDTA: ################
 class DGraphDTA(BaseModel):
@@ -51,15 +51,15 @@ class DGraphDTA(BaseModel):
         # if edge_weight doesnt exist no error is thrown it just passes it as None
         ew = data.edge_weight if self.edge_weight else None
 
-        xt = self.pro_conv1(target_x, ei, ew)
+        xt = gcn_conv(self.pro_conv1, target_x, data, ei, ew)
         xt = self.relu(xt)
 
         # target_edge_index, _ = dropout_adj(target_edge_index, training=self.training)
-        xt = self.pro_conv2(xt, ei, ew)
+        xt = gcn_conv(self.pro_conv2, xt, data, ei, ew)
         xt = self.relu(xt)
         
         # target_edge_index, _ = dropout_adj(target_edge_index, training=self.training)
-        xt = self.pro_conv3(xt, ei, ew)
+        xt = gcn_conv(self.pro_conv3, xt, data, ei, ew)
         xt = self.relu(xt)
 
         # xt = self.pro_conv4(xt, target_edge_index)
@@ -78,15 +78,15 @@ class DGraphDTA(BaseModel):
         # get graph input
         mol_x, mol_edge_index, mol_batch = data_mol.x, data_mol.edge_index, data_mol.batch
 
-        x = self.mol_conv1(mol_x, mol_edge_index)
+        x = gcn_conv(self.mol_conv1, mol_x, data_mol, mol_edge_index)
         x = self.relu(x)
 
         # mol_edge_index, _ = dropout_adj(mol_edge_index, training=self.training)
-        x = self.mol_conv2(x, mol_edge_index)
+        x = gcn_conv(self.mol_conv2, x, data_mol, mol_edge_index)
         x = self.relu(x)
 
         # mol_edge_index, _ = dropout_adj(mol_edge_index, training=self.training)
-        x = self.mol_conv3(x, mol_edge_index)
+        x = gcn_conv(self.mol_conv3, x, data_mol, mol_edge_index)
         x = self.relu(x)
         x = gep(x, mol_batch)  # global pooling
 
@@ -115,8 +115,10 @@ class DGraphDTA(BaseModel):
         """
         xm = self.forward_mol(data_mol)
         xp = self.forward_pro(data_pro)
-
-        # print(x.size(), xt.size())
+        return self.forward_head(xm, xp)
+    
+    def forward_head(self, xm, xp):
+        """Output layers on the ligand (`xm`) and protein (`xp`) embeddings"""
         # concat
         xc = torch.cat((xm, xp), 1)
         # add some dense layers
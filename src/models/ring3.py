@@ -160,7 +160,10 @@ class Ring3DTA(BaseModel):
         """
         xm = self.forward_mol(data_mol)
         xp = self.forward_pro(data_pro)
-        
+        return self.forward_head(xm, xp)
+    
+    def forward_head(self, xm, xp):
+        """Output layers on the ligand (`xm`) and protein (`xp`) embeddings"""
         # concat
         xc = torch.cat((xm, xp), 1)
         out = self.fc_concat(xc)
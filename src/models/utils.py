@@ -1,6 +1,105 @@
+import logging
 from torch import nn
 from src.utils import config as cfg
 
+SLIM_CKPT_FORMAT = 'slim-v1'
+
+def get_frozen_prefixes(model:nn.Module, pretrained_only:bool=False) -> list[str]:
+    """
+    Returns the names of the outermost sub-modules whose parameters are all frozen 
+    (e.g.: `esm_mdl` or `esm_branch.esm_mdl`).
+
+    `pretrained_only` restricts this to HF pretrained models that can be rehydrated from 
+    their `config._name_or_path`.
+    """
+    prefixes = []
+    for name, module in model.named_modules():
+        if name == '' or any(name.startswith(p + '.') for p in prefixes):
+            continue
+        if pretrained_only and not hasattr(getattr(module, 'config', None), '_name_or_path'):
+            continue
+        params = list(module.parameters())
+        if len(params) > 0 and not any(p.requires_grad for p in params):
+            prefixes.append(name)
+    return prefixes
+
+def _strip_module(k:str) -> str:
+    return k[7:] if 'module.' == k[:7] else k
+
+def slim_state_dict(model:nn.Module, state_dict:dict=None) -> dict:
+    """
+    Builds a checkpoint without frozen pretrained weights (e.g.: ESM), these are identical across 
+    every fold and run and are instead rehydrated from the HF cache on load.
+
+    Parameters
+    ----------
+    `model` : nn.Module
+        Model to get the pretrained sub-modules from (DDP/DataParallel wrappers are unwrapped).
+    `state_dict` : dict, optional
+        state_dict to slim down, by default `model.state_dict()`
+
+    Returns
+    -------
+    dict
+        {'format': SLIM_CKPT_FORMAT, 'state_dict': ..., 'pretrained': {prefix: {'name', 'revision'}}}
+    """
+    state_dict = model.state_dict() if state_dict is None else state_dict
+    model = getattr(model, 'module', model)
+    pretrained = {}
+    for p in get_frozen_prefixes(model, pretrained_only=True):
+        config = model.get_submodule(p).config
+        pretrained[p] = {'name': config._name_or_path, 
+                         'revision': getattr(config, '_commit_hash', None)}
+    
+    return {'format': SLIM_CKPT_FORMAT,
+            'state_dict': {k:v for k,v in state_dict.items() 
+                           if not any(_strip_module(k).startswith(p + '.') for p in pretrained)},
+            'pretrained': pretrained}
+
+def unpack_checkpoint(model:nn.Module, ckpt:dict) -> dict:
+    """
+    Returns a full state_dict for `model` from either a regular state_dict or a slim checkpoint
+    (see `slim_state_dict`). Pretrained weights missing from slim checkpoints are taken from `model`
+    itself since they were already loaded from the HF cache when the model was initialized.
+    """
+    if ckpt.get('format') != SLIM_CKPT_FORMAT:
+        return ckpt # old full checkpoint
+    
+    current = getattr(model, 'module', model).state_dict()
+    state_dict = dict(ckpt['state_dict'])
+    for p, info in ckpt['pretrained'].items():
+        config = getattr(model, 'module', model).get_submodule(p).config
+        if config._name_or_path != info['name'] or \
+            (info['revision'] and getattr(config, '_commit_hash', None) not in [None, info['revision']]):
+            logging.warning(f"Pretrained weights for `{p}` do not match checkpoint: "+\
+                            f"{config._name_or_path}@{getattr(config, '_commit_hash', None)} != "+\
+                            f"{info['name']}@{info['revision']}")
+        for k, v in current.items():
+            if k.startswith(p + '.'):
+                state_dict[k] = v
+    return state_dict
+
+def gcn_conv(conv:nn.Module, x, data, edge_index, edge_weight=None, edge_mask=None):
+    """
+    Runs GCNConv `conv` on graph `data`, reusing the normalized edges precomputed at dataset build 
+    time (`gcn_edge_index`, `gcn_edge_weight`, see `BaseDataset(gcn_norm=True)`) when the graph passed 
+    in is unchanged. Otherwise (e.g.: edges dropped by `dropout_node` during training) it falls back to 
+    the regular forward pass that recomputes `gcn_norm`.
+
+    `edge_mask` is applied to `edge_weight` in the fallback if edges were dropped.
+    """
+    if ('gcn_edge_weight' in data and edge_index is data.edge_index and 
+        edge_weight is getattr(data, 'edge_weight', None)):
+        normalize, conv.normalize = conv.normalize, False
+        try:
+            return conv(x, data.gcn_edge_index, data.gcn_edge_weight)
+        finally:
+            conv.normalize = normalize
+    
+    if edge_weight is not None and edge_mask is not None:
+        edge_weight = edge_weight[edge_mask]
+    return conv(x, edge_index, edge_weight)
+
 class BaseModel(nn.Module):
     """
     Base model for printing summary
@@ -34,8 +133,9 @@ class BaseModel(nn.Module):
         prefix added by DDP
 
         Args:
-            mdl_dict (_type_): torch.load output for loaded model
+            mdl_dict (_type_): torch.load output for loaded model (full or slim checkpoint)
         """
+        mdl_dict = unpack_checkpoint(self, mdl_dict)
         try:
             self.load_state_dict(mdl_dict)
         except RuntimeError as e:
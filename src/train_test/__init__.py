@@ -1 +1,3 @@
-from src.train_test.distributed import dtrain
\ No newline at end of file
+from src.train_test.distributed import dtrain, launch_cpu
+
+__all__ = ['dtrain', 'launch_cpu']
@@ -1,4 +1,4 @@
-import time, os, subprocess
+import time, os, json, subprocess
 import submitit
 
 import numpy as np
@@ -10,10 +10,10 @@ from torch.utils.data.distributed import DistributedSampler
 from torch_geometric.loader import DataLoader
 
 
-from src.utils.loader import Loader
+from src.utils.loader import Loader, CachedBatchLoader
 from src.analysis.metrics import get_save_metrics
 
-from src.train_test.training import train, test, CheckpointSaver
+from src.train_test.training import train, test_distributed, CheckpointSaver, StateCheckpointer
 from src.train_test.utils import print_device_info
 
 from src.utils import config as cfg
@@ -60,6 +60,43 @@ def init_dist_gpu(args):
     # __builtin__.print = print
 
 
+def init_dist_cpu(rank:int, args):
+    """
+    Sets up a local gloo process group for cpu only data-parallel training (see `launch_cpu`), 
+    the cpu threads are partitioned between ranks with `args.threads_per_rank` each.
+    """
+    args.gpu = None
+    args.rank = rank
+    torch.set_num_threads(args.threads_per_rank)
+    dist.init_process_group(backend='gloo', init_method=args.dist_url, 
+                            world_size=args.world_size, rank=args.rank)
+    torch.manual_seed(0)
+    np.random.seed(0)
+    dist.barrier()
+
+
+def launch_cpu(args, unknown_args):
+    """
+    torchrun-style local launcher that runs `dtrain` over `args.nprocs` cpu processes with gloo
+    (no SLURM or CUDA needed).
+    """
+    import torch.multiprocessing as mp
+    args.world_size = args.nprocs
+    args.dist_url = f'tcp://127.0.0.1:{args.port}'
+    args.threads_per_rank = args.threads_per_rank or max(1, (os.cpu_count() or 1) // args.nprocs)
+    # child processes inherit this so that OpenMP/MKL pools match the torch thread count
+    os.environ['OMP_NUM_THREADS'] = str(args.threads_per_rank)
+    mp.spawn(dtrain_cpu, args=(args, unknown_args), nprocs=args.nprocs, join=True)
+
+
+def dtrain_cpu(rank:int, args, unknown_args):
+    init_dist_cpu(rank, args)
+    try:
+        _dtrain(args, unknown_args)
+    finally:
+        dist.destroy_process_group()
+
+
 # distributed training fn
 def dtrain(args, unknown_args):
     # ==== initialize the node ====
@@ -68,6 +105,14 @@ def dtrain(args, unknown_args):
     
     # ==== Set up distributed training environment ====
     init_dist_gpu(args)
+    _dtrain(args, unknown_args)
+
+
+def _dtrain(args, unknown_args):
+    # args.gpu is None for cpu processes (see `launch_cpu`)
+    device = torch.device('cpu') if args.gpu is None else torch.device(f'cuda:{args.gpu}')
+    # short benchmark runs from the local launcher dont save or load anything (see `add_local_dist_args`)
+    max_steps = getattr(args, 'max_steps', None)
     
     # TODO: update this to loop through all options.
     # only support for a single option for now:
@@ -81,7 +126,8 @@ def dtrain(args, unknown_args):
     media_save_p = f'{cfg.MEDIA_SAVE_DIR}/{DATA}/'
     MODEL_KEY = Loader.get_model_key(model=MODEL,data=DATA,pro_feature=FEATURE,edge=EDGEW,
                                      ligand_feature=ligand_feature, ligand_edge=ligand_edge,
-                                     batch_size=args.batch_size*args.world_size,
+                                     batch_size=Loader.batch_key(args.batch_size, args.accum_steps, args.world_size,
+                                                                args.max_tokens),
                                      lr=args.learning_rate,dropout=args.dropout,
                                      n_epochs=args.num_epochs,
                                      pro_overlap=args.protein_overlap,
@@ -109,14 +155,18 @@ def dtrain(args, unknown_args):
     
     print(f"----------------- DISTRIBUTED ARGS -----------------")
     print(f"         Local Batch size: {args.batch_size}")
-    print(f"        Global Batch size: {args.batch_size*args.world_size}")
+    print(f"        Global Batch size: {Loader.batch_key(args.batch_size, args.accum_steps, args.world_size, args.max_tokens)}")
+    print(f"      Accumulation steps: {args.accum_steps}")
     print(f"                      GPU: {args.gpu}")
     print(f"                     Rank: {args.rank}")
     print(f"               World Size: {args.world_size}")
 
     
-    print(f'----------------- GPU INFO ------------------------')
-    print_device_info(args.gpu)
+    if args.gpu is not None:
+        print(f'----------------- GPU INFO ------------------------')
+        print_device_info(args.gpu)
+    else:
+        print(f"       Threads per rank: {torch.get_num_threads()}")
     
     
     # ==== Load up training dataset ====
@@ -128,8 +178,15 @@ def dtrain(args, unknown_args):
         training_fold=args.fold_selection, # default is None from arg_parse
         protein_overlap=args.protein_overlap,
         ligand_feature=ligand_feature, ligand_edge=ligand_edge,
-        num_workers=args.slurm_cpus_per_task, # number of subproc used for data loading
+        # number of subproc used for data loading (defaults to cpus per task for SLURM runs)
+        num_workers=args.loader_workers if args.gpu is None else (args.loader_workers or args.slurm_cpus_per_task),
+        persistent_workers=not args.no_persistent_workers, prefetch_factor=args.prefetch_factor,
+        pin_memory=args.pin_memory or None, # None keeps pinning on whenever cuda is available
+        mmap=args.mmap, gcn_norm=args.gcn_norm, compact=args.compact, max_tokens=args.max_tokens,
     )
+    if args.cache_eval: # shards are fixed so each rank can keep its own val/test batches
+        for d in ['val', 'test']:
+            loaders[d] = CachedBatchLoader(loaders[d], device)
     print(f"Data loaded")
     
     
@@ -139,36 +196,50 @@ def dtrain(args, unknown_args):
                               dropout=args.dropout, 
                               dropout_prot=args.dropout_prot, 
                               pro_emb_dim=args.pro_emb_dim,
-                              **unknown_args).cuda(args.gpu)
+                              **unknown_args).to(device)
     
     cp_saver = CheckpointSaver(model=model, save_path=f'{cfg.MODEL_SAVE_DIR}/{MODEL_KEY}.model',
                             train_all=False,
                             patience=1000, min_delta=(0.2 if DATA == cfg.DATA_OPT.PDBbind else 0.05),
-                            dist_rank=args.rank)
+                            dist_rank=args.rank, debug=max_steps is not None)
     # load ckpnt
     ckpt_fp = cp_saver.save_path if os.path.exists(cp_saver.save_path) else cp_saver.save_path + '_tmp'
-    if os.path.exists(ckpt_fp) and args.rank == 0:
+    if os.path.exists(ckpt_fp) and args.rank == 0 and max_steps is None:
         print('# Model already trained, loading checkpoint')
-        model.safe_load_state_dict(torch.load(ckpt_fp, 
-                                map_location=torch.device(f'cuda:{args.gpu}')))
+        model.safe_load_state_dict(torch.load(ckpt_fp, map_location=device))
         
-    model = nn.SyncBatchNorm.convert_sync_batchnorm(model) # use if model contains batchnorm.
-    model = nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=False)
+    if args.gpu is not None:
+        model = nn.SyncBatchNorm.convert_sync_batchnorm(model) # use if model contains batchnorm.
+        model = nn.parallel.DistributedDataParallel(model, device_ids=[args.gpu], find_unused_parameters=False)
+    else:
+        model = nn.parallel.DistributedDataParallel(model, find_unused_parameters=False)
     
     torch.distributed.barrier() # Sync params across GPUs before training
     
     # ==== train ====
     print("starting training:")
+    # full training state is restored on every rank so that optimizer/scheduler/RNG stay in sync
+    state_ckpt = StateCheckpointer(f'{cp_saver.save_path}.state', every=args.state_every, 
+                                   dist_rank=args.rank) if max_steps is None else None
     logs = train(model=model, train_loader=loaders['train'], val_loader=loaders['val'], 
-          device=args.gpu, saver=cp_saver, epochs=args.num_epochs, lr_0=args.learning_rate)
+          device=device, saver=cp_saver, epochs=args.num_epochs, lr_0=args.learning_rate,
+          state_ckpt=state_ckpt, accum_steps=args.accum_steps, max_steps=max_steps)
     torch.distributed.barrier() # Sync params across GPUs
     
+    if args.rank == 0 and getattr(args, 'logs_out', None):
+        logs['world_size'] = args.world_size
+        with open(args.logs_out, 'w') as f:
+            json.dump(logs, f, indent=4)
+    if max_steps is not None:
+        return
+    
     cp_saver.save()
+    if args.rank == 0: state_ckpt.remove()
     
     
     # ==== Evaluate ====
-    loss, pred, actual = test(model, loaders['test'], args.gpu)
-    torch.distributed.barrier() # Sync params across GPUs
+    # each rank evaluates its shard, results are gathered so metrics cover the full set
+    loss, pred, actual = test_distributed(model, loaders['test'], device)
     if args.rank == 0:
         print("Test loss:", loss)
         get_save_metrics(actual, pred,
@@ -181,8 +252,7 @@ def dtrain(args, unknown_args):
                     )
         
     # validation
-    loss, pred, actual = test(model, loaders['val'], args.gpu)
-    torch.distributed.barrier() # Sync params across GPUs
+    loss, pred, actual = test_distributed(model, loaders['val'], device)
     if args.rank == 0:
         print(f'# Val loss: {loss}')
         get_save_metrics(actual, pred,
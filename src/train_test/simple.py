@@ -5,12 +5,13 @@ import torch
 from torch_geometric.loader import DataLoader
 
 from src.models.utils import BaseModel
+from src.train_test.utils import set_epoch
 import ray
 
 
 def simple_train(model: BaseModel, optimizer:torch.optim.Optimizer, 
                  train_loader:DataLoader, device: torch.device=None,
-                 epochs=10) -> dict:
+                 epochs=10, accum_steps:int=1, start_epoch:int=0) -> dict:
     """
     simple training loop without any checkpointing, lr scheduling, early stopping, 
     or support for distributed training.
@@ -27,6 +28,12 @@ def simple_train(model: BaseModel, optimizer:torch.optim.Optimizer,
         Device to train on.
     `epochs` : int, optional
         number of epochs, by default 10
+    `accum_steps` : int, optional
+        Number of micro-batches to accumulate gradients over for each optimizer step, 
+        by default 1
+    `start_epoch` : int, optional
+        Epoch number of the first epoch, used to reshuffle epoch seeded samplers when training 
+        one epoch per call (see `src.train_test.utils.set_epoch`), by default 0
         
     Returns
     -------
@@ -39,9 +46,12 @@ def simple_train(model: BaseModel, optimizer:torch.optim.Optimizer,
         device = ray.train.torch.get_device() # WARNING: returns list if worker has multiple GPUs
     
     model.train()
-    for _ in range(epochs):
+    for epoch in range(start_epoch, start_epoch+epochs):
         # Training loop
-        for data in train_loader:
+        set_epoch(train_loader, epoch)
+        n_batches = len(train_loader)
+        optimizer.zero_grad()
+        for i, data in enumerate(train_loader):
             batch_pro = data['protein'].to(device)
             batch_mol = data['ligand'].to(device)
             labels = data['y'].reshape(-1,1).to(device)
@@ -52,10 +62,13 @@ def simple_train(model: BaseModel, optimizer:torch.optim.Optimizer,
             # Compute loss
             loss = CRITERION(predictions, labels)
 
-            # Backward pass and optimization
-            optimizer.zero_grad()
-            loss.backward()
-            optimizer.step()
+            # Backward pass and optimization (every `accum_steps` micro-batches, the last 
+            # step of the epoch can have fewer)
+            group_size = min(accum_steps, n_batches - (i // accum_steps) * accum_steps)
+            (loss / group_size).backward()
+            if (i+1) % accum_steps == 0 or (i+1) == n_batches:
+                optimizer.step()
+                optimizer.zero_grad()
 
 
 def simple_eval(model:BaseModel, data_loader:DataLoader, device:torch.device=None, 
@@ -130,7 +130,7 @@ def train_val_test_split(dataset: BaseDataset,
                             sampler=train_sampler, pin_memory=True)
     val_loader = DataLoader(dataset, batch_size=batch_train,
                             sampler=val_sampler, pin_memory=True)
-    test_loader = DataLoader(dataset, batch_size=1, # batch size 1 for testing
+    test_loader = DataLoader(dataset, batch_size=batch_train, # eval is batched, ids are kept per sample
                             sampler=test_sampler, pin_memory=True)
     
     return train_loader, val_loader, test_loader
@@ -207,7 +207,7 @@ def balanced_kfold_split(dataset: BaseDataset |str,
     # looping through dataset to get indices for test
     test_indices = [i for i in range(dataset_size) if dataset[i]['prot_id'] in test_prots]
     test_sampler = SubsetRandomSampler(test_indices)
-    test_loader = DataLoader(dataset, batch_size=1, # batch size 1 for testing
+    test_loader = DataLoader(dataset, batch_size=batch_train, # eval is batched, ids are kept per sample
                             sampler=test_sampler, pin_memory=True)
             
     # removing selected proteins from prots
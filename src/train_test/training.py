@@ -1,23 +1,25 @@
 from typing import Tuple
-import os
+import os, time, random, logging, threading
 from copy import deepcopy
+from contextlib import nullcontext
 
 
 from tqdm import tqdm
 import numpy as np
 import torch
 from torch import nn
-from torch.distributed import all_reduce, ReduceOp
+from torch.distributed import all_reduce, all_gather_object, get_world_size, ReduceOp
 from torch.optim.lr_scheduler import ReduceLROnPlateau
 from torch_geometric.loader import DataLoader
 
 from src.analysis.metrics import concordance_index
-from src.models.utils import BaseModel
+from src.models.utils import BaseModel, slim_state_dict
+from src.train_test.utils import set_epoch
 
 class CheckpointSaver:
     # Adapted from https://stackoverflow.com/questions/71998978/early-stopping-in-pytorch
     def __init__(self, model:BaseModel, save_path=None, train_all=True, patience=100, 
-                 min_delta=0.2, debug=False, dist_rank:int=None):
+                 min_delta=0.2, debug=False, dist_rank:int=None, slim:bool=True):
         """
         Early stopping and checkpoint saving class.
 
@@ -38,12 +40,16 @@ class CheckpointSaver:
         `dist_rank` : int, optional
             Whether or not this is for a distributed run, if it is this number will indicate 
             the rank of this particular process, by default None.
+        `slim` : bool, optional
+            Saves checkpoints without frozen pretrained weights (e.g.: ESM) which are rehydrated 
+            from the HF cache on load (see `slim_state_dict`), by default True.
         """
         self.train_all = train_all 
         self.patience = patience
         self.min_delta = min_delta
         self.debug = debug
         self.dist_rank = dist_rank
+        self.slim = slim
         
         self.new_model(model, save_path)
     
@@ -108,13 +114,29 @@ class CheckpointSaver:
         if self.dist_rank is None or self.dist_rank == 0:
             path = path or self.save_path
             # save model default path is model class name + best epoch
-            torch.save(self.best_model_dict, path)
+            if self.slim and self._model is not None:
+                torch.save(slim_state_dict(self._model, self.best_model_dict), path)
+            else:
+                torch.save(self.best_model_dict, path)
             if not silent: print(f'Model saved to: {path}')
             if rm_tmp and os.path.isfile(f'{path}_tmp'): 
                 os.remove(f'{path}_tmp')
         elif not silent:
             print(f'WARNING: No saving on non-main process')
         
+    def state_dict(self) -> dict:
+        """Early stopping state and best weights for `StateCheckpointer`"""
+        return {'best_epoch': self.best_epoch, 'stop_epoch': self.stop_epoch, 
+                'counter': self._counter, 'min_val_loss': self.min_val_loss,
+                'best_model_dict': self.best_model_dict}
+    
+    def load_state_dict(self, state:dict):
+        self.best_epoch = state['best_epoch']
+        self.stop_epoch = state['stop_epoch']
+        self._counter = state['counter']
+        self.min_val_loss = state['min_val_loss']
+        self.best_model_dict = state['best_model_dict']
+        
     def __repr__(self) -> str:
         return f'save path: {self.save_path}'+ \
                f'min val loss: {self.min_val_loss}'+ \
@@ -122,10 +144,265 @@ class CheckpointSaver:
                f'best epoch: {self.best_epoch}'
     
 
+def _to_cpu(obj):
+    """Recursively copies tensors in nested dicts/lists to cpu"""
+    if isinstance(obj, torch.Tensor):
+        return obj.detach().to('cpu', copy=True)
+    if isinstance(obj, dict):
+        return {k: _to_cpu(v) for k, v in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return type(obj)(_to_cpu(v) for v in obj)
+    return deepcopy(obj)
+
+
+class StateCheckpointer:
+    def __init__(self, path:str, every:int=10, dist_rank:int=None):
+        """
+        Periodic full training state checkpoints so that preempted/timed out jobs can resume 
+        `train` exactly where they left off.
+        
+        Saves the model, optimizer, scheduler, `CheckpointSaver` state, logs, epoch and RNG streams 
+        (python, numpy, torch and cuda). Resuming happens at epoch boundaries, since shuffling is 
+        driven by the restored torch RNG the sampler order of the following epochs is the same 
+        as in an uninterrupted run.
+        
+        Overhead: the training loop only blocks while the state is copied to cpu memory (roughly 
+        3x the model size with Adam), the `torch.save` to disk happens on a background thread. 
+        Both times are logged and recorded in `times` for each save.
+
+        Parameters
+        ----------
+        `path` : str
+            File to write the training state to.
+        `every` : int, optional
+            Number of epochs between checkpoints, by default 10
+        `dist_rank` : int, optional
+            Rank of this process for distributed runs, only rank 0 writes, by default None.
+        """
+        self.path = path
+        self.every = every
+        self.dist_rank = dist_rank
+        self.times = [] # (blocking, write) seconds for each save
+        self._thread = None
+    
+    @property
+    def exists(self) -> bool:
+        return os.path.isfile(self.path)
+    
+    def should_save(self, epoch:int) -> bool:
+        return self.every > 0 and epoch % self.every == 0 and \
+            (self.dist_rank is None or self.dist_rank == 0)
+        
+    @staticmethod
+    def _train_state(model:BaseModel, optimizer, scheduler, saver:CheckpointSaver, logs:dict) -> dict:
+        return {'model': model.state_dict(), 'optimizer': optimizer.state_dict(), 
+                'scheduler': scheduler.state_dict(), 'saver': saver.state_dict(), 'logs': logs}
+    
+    @staticmethod
+    def _load_train_state(state:dict, model:BaseModel, optimizer, scheduler, saver:CheckpointSaver):
+        model.load_state_dict(state['model'])
+        optimizer.load_state_dict(state['optimizer'])
+        scheduler.load_state_dict(state['scheduler'])
+        saver.load_state_dict(state['saver'])
+        
+    def save(self, epoch:int, model:BaseModel, optimizer, scheduler, 
+             saver:CheckpointSaver, logs:dict):
+        """Snapshots the training state and writes it to `path` on a background thread"""
+        self._save(epoch, lambda: self._train_state(model, optimizer, scheduler, saver, logs))
+    
+    def save_folds(self, epoch:int, models:dict[int, BaseModel], optimizers:dict, schedulers:dict,
+                   savers:dict[int, CheckpointSaver], logs:dict[int, dict]):
+        """
+        `save` for `train_folds`, the state of every fold is written to the same file so that all 
+        folds resume from the same epoch with a single set of RNG streams.
+        """
+        self._save(epoch, lambda: {'folds': {k: self._train_state(models[k], optimizers[k], schedulers[k], 
+                                                                 savers[k], logs[k]) 
+                                             for k in models}})
+    
+    def _save(self, epoch:int, get_state):
+        self.wait() # only one write in flight
+        t0 = time.time()
+        rng = {'python': random.getstate(), 'numpy': np.random.get_state(), 
+               'torch': torch.get_rng_state()}
+        if torch.cuda.is_available():
+            rng['cuda'] = torch.cuda.get_rng_state_all()
+        state = _to_cpu({'epoch': epoch, **get_state()})
+        state['rng'] = rng
+        t_block = time.time() - t0
+        
+        def _write():
+            t1 = time.time()
+            torch.save(state, self.path + '.tmp')
+            os.replace(self.path + '.tmp', self.path) # never leave a partially written state
+            self.times.append((t_block, time.time() - t1))
+            logging.info(f'Saved training state @ epoch {epoch} to {self.path} ' + \
+                         f'(blocking: {t_block:.2f}s, write: {self.times[-1][1]:.2f}s)')
+        
+        self._thread = threading.Thread(target=_write, daemon=False)
+        self._thread.start()
+    
+    def wait(self):
+        """Blocks until any pending write has finished"""
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
+    
+    def load(self, model:BaseModel, optimizer, scheduler, 
+             saver:CheckpointSaver, map_location=None) -> Tuple[int, dict]:
+        """
+        Restores the training state inplace.
+
+        Returns
+        -------
+        Tuple[int, dict]
+            The last completed epoch and training logs up to that epoch.
+        """
+        state = self._load(map_location)
+        self._load_train_state(state, model, optimizer, scheduler, saver)
+        return state['epoch'], state['logs']
+    
+    def load_folds(self, models:dict[int, BaseModel], optimizers:dict, schedulers:dict,
+                   savers:dict[int, CheckpointSaver], map_location=None) -> Tuple[int, dict[int, dict]]:
+        """
+        Restores the training state of every fold inplace (see `save_folds`).
+
+        Returns
+        -------
+        Tuple[int, dict[int, dict]]
+            The last completed epoch and training logs of each fold up to that epoch.
+        """
+        state = self._load(map_location)
+        assert set(state['folds']) == set(models), \
+            f"Training state at {self.path} is for folds {sorted(state['folds'])} not {sorted(models)}"
+        for k, fold_state in state['folds'].items():
+            self._load_train_state(fold_state, models[k], optimizers[k], schedulers[k], savers[k])
+        return state['epoch'], {k: fold_state['logs'] for k, fold_state in state['folds'].items()}
+    
+    def _load(self, map_location=None) -> dict:
+        """Loads the state file and restores the RNG streams"""
+        if isinstance(map_location, int): # local rank for distributed runs
+            map_location = f'cuda:{map_location}'
+        state = torch.load(self.path, map_location=map_location)
+        
+        rng = state['rng']
+        random.setstate(rng['python'])
+        np.random.set_state(rng['numpy'])
+        torch.set_rng_state(rng['torch'].cpu()) # map_location also moves the RNG states
+        if 'cuda' in rng and torch.cuda.is_available():
+            torch.cuda.set_rng_state_all([r.cpu() for r in rng['cuda']])
+        return state
+    
+    def remove(self):
+        """Removes the state file (e.g.: once training is complete)"""
+        self.wait()
+        if self.exists: os.remove(self.path)
+
+
+def _autocast(device, enabled:bool):
+    """bf16 autocast context, only used on cpu where it doesnt need a grad scaler"""
+    device_type = torch.device(device).type
+    return torch.autocast(device_type='cpu', dtype=torch.bfloat16, 
+                          enabled=enabled and device_type == 'cpu')
+
+
+def _scheduler(optimizer:torch.optim.Optimizer, saver:CheckpointSaver) -> ReduceLROnPlateau:
+    """lr schedule shared by `train` and `train_folds`, patience is tied to the early stopper"""
+    return ReduceLROnPlateau(optimizer, mode='min', 
+                             patience=int(saver.patience*0.9), 
+                             threshold=saver.min_delta*0.1, # more sensitive than early stopper 
+                             min_lr=5e-7, factor=0.5,
+                             verbose=True)
+
+
+def train_epoch(model:BaseModel, train_loader:DataLoader, device:torch.device, 
+                optimizer:torch.optim.Optimizer, criterion=None, desc:str=None, 
+                silent=False, bf16=False, log_every:int=50, accum_steps:int=1, 
+                max_steps:int=None) -> Tuple[float, dict]:
+    """
+    Runs a single epoch of training.
+    
+    Losses are accumulated on `device` and only synced once per epoch (and every 
+    `log_every` batches for the progress bar) to avoid a device sync on each step.
+    
+    With `accum_steps` > 1 gradients are accumulated over that many micro-batches before each 
+    optimizer step (effective batch size = batch size x `accum_steps`), DDP gradient syncs are 
+    skipped for all but the last micro-batch of each step.
+    
+    `max_steps` caps the number of batches in the epoch (e.g.: for quick benchmarks).
+
+    Returns
+    -------
+    Tuple[float, dict]
+        Average training loss for the epoch and throughput stats (elapsed, n_samples, 
+        samples_per_s, data_s and compute_s, time spent waiting on the loader vs the rest of the step).
+    """
+    criterion = criterion or torch.nn.MSELoss()
+    model.train()
+    train_loss = torch.zeros((), device=device)
+    n_samples, data_s = 0, 0.0
+    n_batches = len(train_loader) if max_steps is None else min(len(train_loader), max_steps)
+    optimizer.zero_grad()
+    with tqdm(total=n_batches, desc=desc, 
+              unit="batch", disable=silent) as progress_bar:
+        t_start = t0 = time.perf_counter()
+        for i, data in enumerate(train_loader):
+            batch_pro = data['protein'].to(device)
+            batch_mol = data['ligand'].to(device)
+            labels = data['y'].reshape(-1,1).to(device)
+            data_s += time.perf_counter() - t0
+            
+            step = (i+1) % accum_steps == 0 or (i+1) == n_batches
+            # the last step of the epoch can have fewer than `accum_steps` micro-batches
+            group_size = min(accum_steps, n_batches - (i // accum_steps) * accum_steps)
+            # only sync DDP gradients on micro-batches that end with an optimizer step
+            sync_ctx = model.no_sync() if (not step and hasattr(model, 'no_sync')) else nullcontext()
+            with sync_ctx:
+                # Forward pass
+                with _autocast(device, bf16):
+                    predictions = model(batch_pro, batch_mol)
+                
+                # Compute loss
+                loss = criterion(predictions.float(), labels.float())
+                train_loss += loss.detach()
+                n_samples += len(labels)
+
+                # Backward pass (scaled so accumulated grads are the mean over micro-batches)
+                (loss / group_size).backward()
+            
+            if step:
+                optimizer.step()
+                optimizer.zero_grad()
+
+            # Update tqdm progress bar
+            if not silent and (i+1) % log_every == 0:
+                progress_bar.set_postfix({"Train Loss": train_loss.item() / (i+1)})
+            progress_bar.update(1)
+            if i+1 == n_batches:
+                break
+            t0 = time.perf_counter()
+
+        # Compute average training loss for the epoch
+        train_loss = train_loss.item() / n_batches # single sync per epoch
+        elapsed = time.perf_counter() - t_start
+    
+    stats = {'elapsed': elapsed, 'n_samples': n_samples, 
+             'samples_per_s': n_samples / max(elapsed, 1e-9),
+             'data_s': data_s, 'compute_s': elapsed - data_s}
+    return train_loss, stats
+
+
+def _log_stats(stats:dict) -> str:
+    return f"{stats['samples_per_s']:.1f} samples/s " + \
+           f"(data: {stats['data_s']:.1f}s, compute: {stats['compute_s']:.1f}s)"
+
+
 def train(model: BaseModel, train_loader:DataLoader, val_loader:DataLoader, 
           device: torch.device, saver: CheckpointSaver=None, 
           silent=False, 
           epochs=10, lr_0=0.1,
+          state_ckpt:StateCheckpointer=None,
+          compile_model=False, bf16=False, accum_steps:int=1, max_steps:int=None,
           **kwargs) -> dict:
     """
     Training loop for graph models.
@@ -153,6 +430,18 @@ def train(model: BaseModel, train_loader:DataLoader, val_loader:DataLoader,
         End learning rate
     `last_epoch` : int, optional
         Starting point for scheduler if continuing from prev run, by default -1
+    `state_ckpt` : StateCheckpointer, optional
+        Saves the full training state periodically and resumes from it if it already exists, 
+        by default None
+    `compile_model` : bool, optional
+        Runs the forward/backward passes through `torch.compile(model)`, by default False
+    `bf16` : bool, optional
+        Use bf16 autocast when training on cpu, by default False
+    `accum_steps` : int, optional
+        Number of micro-batches to accumulate gradients over for each optimizer step, 
+        by default 1
+    `max_steps` : int, optional
+        Maximum number of training batches per epoch, by default None (full epoch)
         
     Returns
     -------
@@ -163,66 +452,51 @@ def train(model: BaseModel, train_loader:DataLoader, val_loader:DataLoader,
     CRITERION = torch.nn.MSELoss()
     OPTIMIZER = torch.optim.Adam(model.parameters(), lr=lr_0, **kwargs)
     # gamma = (lr_e/lr_0)**(step_size/epochs) # calculate gamma based on final lr chosen.
-    SCHEDULER = ReduceLROnPlateau(OPTIMIZER, mode='min', 
-                                  patience=int(saver.patience*0.9), 
-                                  threshold=saver.min_delta*0.1, # more sensitive than early stopper 
-                                  min_lr=5e-7, factor=0.5,
-                                  verbose=True)
+    SCHEDULER = _scheduler(OPTIMIZER, saver)
 
-    logs = {'train_loss': [], 'val_loss': []}
+    # saver and state checkpoints keep the original module so that state dict keys dont change
+    fwd_model = torch.compile(model) if compile_model else model
     
-    # pre training validation test:
-    val_loss = test(model, val_loader, device, CRITERION)[0]
-    # ensures that we save the best model arch even when loading from existing.
-    saver.early_stop(val_loss, 0) 
+    logs = {'train_loss': [], 'val_loss': [], 'samples_per_s': []}
+    start_epoch = 1
+    # distributed runs validate on the full val set gathered from all ranks
+    eval_fn = test_distributed if saver.dist_rank is not None else test
     
-    # validation loss before training
-    if not silent:
-        print(f"Epoch {0}/{epochs}: Val Loss: {val_loss:.4f} ")
-    # we dont save it to logs since this will not be useful information
-    #   - either very high or the same as prev model (redundant)
+    if state_ckpt is not None and state_ckpt.exists:
+        last_epoch, logs = state_ckpt.load(model, OPTIMIZER, SCHEDULER, saver, map_location=device)
+        start_epoch = last_epoch + 1
+        if not silent:
+            print(f"Resuming from epoch {last_epoch}/{epochs}, best epoch was {saver.best_epoch}")
+    else:
+        # pre training validation test:
+        val_loss = eval_fn(fwd_model, val_loader, device, CRITERION, bf16=bf16)[0]
+        # ensures that we save the best model arch even when loading from existing.
+        saver.early_stop(val_loss, 0) 
+        
+        # validation loss before training
+        if not silent:
+            print(f"Epoch {0}/{epochs}: Val Loss: {val_loss:.4f} ")
+        # we dont save it to logs since this will not be useful information
+        #   - either very high or the same as prev model (redundant)
     
     is_distributed = saver.dist_rank is not None
     es_flag = torch.zeros(1).to(device)
     
-    for epoch in range(1, epochs+1):
+    for epoch in range(start_epoch, epochs+1):
         # Training loop
-        model.train()
-        train_loss = 0.0
-        with tqdm(total=len(train_loader), 
-                  desc=f"Epoch {epoch}/{epochs}", 
-                  unit="batch", disable=silent) as progress_bar:
-            for data in train_loader:
-                batch_pro = data['protein'].to(device)
-                batch_mol = data['ligand'].to(device)
-                labels = data['y'].reshape(-1,1).to(device)
-                
-                # Forward pass
-                predictions = model(batch_pro, batch_mol)
-
-                # Compute loss
-                loss = CRITERION(predictions, labels)
-                train_loss += loss.item()
-
-                # Backward pass and optimization
-                OPTIMIZER.zero_grad()
-                loss.backward()
-                OPTIMIZER.step()
-
-                # Update tqdm progress bar
-                progress_bar.set_postfix({"Train Loss": train_loss / (progress_bar.n + 1)})
-                progress_bar.update(1)
-
-            # Compute average training loss for the epoch
-            train_loss /= len(train_loader)
+        set_epoch(train_loader, epoch)
+        train_loss, stats = train_epoch(fwd_model, train_loader, device, OPTIMIZER, CRITERION,
+                                        desc=f"Epoch {epoch}/{epochs}", silent=silent, bf16=bf16,
+                                        accum_steps=accum_steps, max_steps=max_steps)
         
         # Validation loop
-        val_loss, val_pred, val_actual = test(model, val_loader, device, CRITERION)
+        val_loss, val_pred, val_actual = eval_fn(fwd_model, val_loader, device, CRITERION, bf16=bf16)
         cindex = concordance_index(val_actual, val_pred)
         SCHEDULER.step(val_loss)
 
         logs['train_loss'].append(train_loss)
         logs['val_loss'].append(val_loss)
+        logs.setdefault('samples_per_s', []).append(stats['samples_per_s'])
         
         if not is_distributed or saver.dist_rank == 0: # must satisfy (distributed --implies> main process) to early stop 
             if saver.early_stop(val_loss, epoch) and not silent:
@@ -235,17 +509,135 @@ def train(model: BaseModel, train_loader:DataLoader, val_loader:DataLoader,
             if es_flag == 1:
                 break
         
+        if state_ckpt is not None and state_ckpt.should_save(epoch):
+            state_ckpt.save(epoch, model, OPTIMIZER, SCHEDULER, saver, logs)
+        
         # Print training and validation loss for the epoch
         if not silent:
-            print(f"Epoch {epoch}/{epochs} {progress_bar.format_dict['elapsed']:.1f}s: Train Loss: {train_loss:.4f}, "+\
+            print(f"Epoch {epoch}/{epochs} {stats['elapsed']:.1f}s: Train Loss: {train_loss:.4f}, "+\
                 f"Val Loss: {val_loss:.4f}, cindex: {cindex:.3f}, "+\
-                f"Best Val Loss: {saver.min_val_loss:.4f} @ Epoch {saver.best_epoch}")
+                f"Best Val Loss: {saver.min_val_loss:.4f} @ Epoch {saver.best_epoch} | {_log_stats(stats)}")
 
+    ckpt_time = _ckpt_time(state_ckpt, silent)
+    if ckpt_time is not None:
+        logs['ckpt_time'] = ckpt_time
     logs['best_epoch'] = saver.best_epoch
     return logs
 
 
-def test(model, test_loader, device, CRITERION=None, verbose=False) -> Tuple[float, np.ndarray, np.ndarray]:
+def _ckpt_time(state_ckpt:StateCheckpointer, silent=False) -> dict:
+    """Waits for the last state checkpoint write and returns its average overhead (None if nothing was saved)"""
+    if state_ckpt is None:
+        return None
+    state_ckpt.wait()
+    if not state_ckpt.times:
+        return None
+    t_block, t_write = np.mean(state_ckpt.times, axis=0)
+    if not silent:
+        print(f"Training state checkpoint overhead: {t_block:.2f}s blocking " + \
+              f"({t_block/state_ckpt.every:.3f}s/epoch), {t_write:.2f}s background write")
+    return {'n_saves': len(state_ckpt.times), 'every': state_ckpt.every,
+            'blocking_s': t_block, 'write_s': t_write,
+            'blocking_s_per_epoch': t_block / state_ckpt.every}
+
+
+def train_folds(models:dict[int, BaseModel], loaders:dict[int, dict[str, DataLoader]], 
+                device:torch.device, savers:dict[int, CheckpointSaver], 
+                silent=False, epochs=10, lr_0=0.1, state_ckpt:StateCheckpointer=None,
+                compile_model=False, bf16=False, accum_steps:int=1, **kwargs) -> dict[int, dict]:
+    """
+    Trains the models for multiple cross-validation folds in a single process, interleaving 
+    one epoch of each fold at a time. The loaders for each fold are expected to be views of the 
+    same dataset (see `Loader.load_fold_DataLoaders`) so that it is only held in memory once.
+    Same optimizer, scheduler and early stopping behaviour as `train`.
+
+    Parameters
+    ----------
+    `models` : dict[int, BaseModel]
+        Model to train for each fold.
+    `loaders` : dict[int, dict[str, DataLoader]]
+        'train' and 'val' data loaders for each fold.
+    `device` : torch.device
+        Device to train on.
+    `savers` : dict[int, CheckpointSaver]
+        CheckpointSaver for each fold.
+    `epochs` : int, optional
+        number of epochs, by default 10
+    `lr_0` : float, optional
+        Starting learning rate, by default 0.1
+    `state_ckpt` : StateCheckpointer, optional
+        Saves the training state of all folds periodically (see `StateCheckpointer.save_folds`) and 
+        resumes from it if it already exists, by default None
+    `compile_model` : bool, optional
+        Runs the forward/backward passes through `torch.compile` of each model, by default False
+
+    Returns
+    -------
+    dict[int, dict]
+        Training logs for each fold (see `train`).
+    """
+    CRITERION = torch.nn.MSELoss()
+    optimizers, schedulers, logs, fwd_models = {}, {}, {}, {}
+    for k, model in models.items():
+        optimizers[k] = torch.optim.Adam(model.parameters(), lr=lr_0, **kwargs)
+        schedulers[k] = _scheduler(optimizers[k], savers[k])
+        logs[k] = {'train_loss': [], 'val_loss': [], 'samples_per_s': []}
+        fwd_models[k] = torch.compile(model) if compile_model else model
+    
+    start_epoch = 1
+    if state_ckpt is not None and state_ckpt.exists:
+        last_epoch, logs = state_ckpt.load_folds(models, optimizers, schedulers, savers, map_location=device)
+        start_epoch = last_epoch + 1
+        if not silent:
+            print(f"Resuming folds {list(models)} from epoch {last_epoch}/{epochs}")
+    else:
+        for k in models:
+            val_loss = test(fwd_models[k], loaders[k]['val'], device, CRITERION, bf16=bf16)[0]
+            savers[k].early_stop(val_loss, 0)
+            if not silent:
+                print(f"Fold {k} Epoch {0}/{epochs}: Val Loss: {val_loss:.4f} ")
+    
+    active = [k for k in models if savers[k].stop_epoch < 0]
+    for epoch in range(start_epoch, epochs+1):
+        if not active:
+            break
+        for k in list(active):
+            model, saver = fwd_models[k], savers[k]
+            set_epoch(loaders[k]['train'], epoch)
+            train_loss, stats = train_epoch(model, loaders[k]['train'], device, optimizers[k], 
+                                            CRITERION, desc=f"Fold {k} Epoch {epoch}/{epochs}", 
+                                            silent=silent, bf16=bf16, accum_steps=accum_steps)
+            val_loss, val_pred, val_actual = test(model, loaders[k]['val'], device, CRITERION, bf16=bf16)
+            schedulers[k].step(val_loss)
+            
+            logs[k]['train_loss'].append(train_loss)
+            logs[k]['val_loss'].append(val_loss)
+            logs[k]['samples_per_s'].append(stats['samples_per_s'])
+            
+            if saver.early_stop(val_loss, epoch):
+                active.remove(k)
+                if not silent:
+                    print(f'Fold {k} early stopping at epoch {epoch}, best epoch was {saver.best_epoch}')
+            
+            if not silent:
+                cindex = concordance_index(val_actual, val_pred)
+                print(f"Fold {k} Epoch {epoch}/{epochs} {stats['elapsed']:.1f}s: Train Loss: {train_loss:.4f}, "+\
+                    f"Val Loss: {val_loss:.4f}, cindex: {cindex:.3f}, "+\
+                    f"Best Val Loss: {saver.min_val_loss:.4f} @ Epoch {saver.best_epoch} | {_log_stats(stats)}")
+        
+        if state_ckpt is not None and state_ckpt.should_save(epoch):
+            state_ckpt.save_folds(epoch, models, optimizers, schedulers, savers, logs)
+    
+    ckpt_time = _ckpt_time(state_ckpt, silent)
+    for k in models:
+        if ckpt_time is not None:
+            logs[k]['ckpt_time'] = ckpt_time
+        logs[k]['best_epoch'] = savers[k].best_epoch
+    return logs
+
+
+def test(model, test_loader, device, CRITERION=None, verbose=False, 
+         bf16=False, return_ids=False) -> Tuple[float, np.ndarray, np.ndarray]:
     """
     Run inference on the test set.
 
@@ -257,40 +649,83 @@ def test(model, test_loader, device, CRITERION=None, verbose=False) -> Tuple[flo
         The test set data loader.
     `device` : torch.device
         Device to run inference on.
+    `bf16` : bool, optional
+        Use bf16 autocast when running on cpu, by default False
+    `return_ids` : bool, optional
+        Also return the `code` and `prot_id` of each sample in the same order as the 
+        predictions, by default False
 
     Returns
     -------
     Tuple[float, np.ndarray, np.ndarray]
-        Tuple of test loss, predictions, and actual labels.
+        Tuple of test loss (averaged over samples), predictions, and actual labels 
+        (+ dict of 'code' and 'prot_id' lists if `return_ids`).
     """
     # After training, you can evaluate the model on the test set if needed
     model.eval()
-    test_loss = 0.0
     CRITERION = CRITERION or torch.nn.MSELoss()
     
-    pred = np.array([])
-    actual = np.array([])
-    model.eval()
-    with torch.no_grad():
+    # preallocated on device and only copied back once at the end (sampler length is an upper bound 
+    # on the number of samples, we trim to what was actually seen)
+    n_max = len(test_loader.sampler)
+    pred = torch.empty(n_max, device=device)
+    actual = torch.empty(n_max, device=device)
+    test_loss = torch.zeros((), device=device)
+    ids = {'code': [], 'prot_id': []}
+    n = 0
+    with torch.inference_mode():
         for data in tqdm(test_loader, total=len(test_loader), disable=not verbose):
             batch_pro = data['protein'].to(device)
             batch_mol = data['ligand'].to(device)
             labels = data['y'].reshape(-1,1).to(device)
             
             # Forward pass
-            predictions = model(batch_pro, batch_mol)
+            with _autocast(device, bf16):
+                predictions = model(batch_pro, batch_mol)
+            predictions = predictions.float()
+            labels = labels.float()
 
-            # Compute loss
-            loss = CRITERION(predictions, labels) # y is labels
-            test_loss += loss.item()
+            # Compute loss, weighted by batch size so that it is the same for any batch size
+            b = len(labels)
+            test_loss += CRITERION(predictions, labels) * b # y is labels
             
             # save predictions and actual labels
-            pred = np.append(pred, 
-                            predictions.detach().cpu().numpy().flatten())
-            actual = np.append(actual, 
-                               labels.detach().cpu().numpy().flatten())
+            pred[n:n+b] = predictions.flatten()
+            actual[n:n+b] = labels.flatten()
+            n += b
+            if return_ids:
+                ids['code'].extend(data['code'])
+                ids['prot_id'].extend(data['prot_id'])
 
         # Compute average test loss
-        test_loss /= len(test_loader)
+        test_loss = test_loss.item() / max(n, 1)
+    
+    pred = pred[:n].cpu().numpy().astype(np.float64)
+    actual = actual[:n].cpu().numpy().astype(np.float64)
+    if return_ids:
+        return test_loss, pred, actual, ids
+    return test_loss, pred, actual
+
+
+def test_distributed(model, test_loader, device, CRITERION=None, verbose=False, 
+                     bf16=False, return_ids=False) -> Tuple[float, np.ndarray, np.ndarray]:
+    """
+    Same as `test` but for a loader that is sharded across ranks (see `ShardSampler`). 
+    Predictions, labels and ids from all ranks are all-gathered so that every rank 
+    returns the results (and loss) for the full set.
+    
+    Requires an initialized process group (works with gloo on cpu).
+    """
+    loss, pred, actual, ids = test(model, test_loader, device, CRITERION, verbose=verbose, 
+                                   bf16=bf16, return_ids=True)
+    shards = [None] * get_world_size()
+    all_gather_object(shards, (loss, pred, actual, ids))
     
-    return test_loss, pred, actual
\ No newline at end of file
+    n = sum(len(p) for _, p, _, _ in shards)
+    loss = sum(l * len(p) for l, p, _, _ in shards) / max(n, 1)
+    pred = np.concatenate([p for _, p, _, _ in shards])
+    actual = np.concatenate([a for _, _, a, _ in shards])
+    if return_ids:
+        ids = {k: [i for _, _, _, s in shards for i in s[k]] for k in ids}
+        return loss, pred, actual, ids
+    return loss, pred, actual
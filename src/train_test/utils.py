@@ -22,6 +22,15 @@ def print_device_info(device:torch.device|int) -> torch.cuda.device:
     
     return prop
 
+def set_epoch(loader, epoch:int):
+    """
+    Calls `set_epoch` on the sampler and batch sampler of `loader` if they have one (e.g.: 
+    `DistributedSampler`, `TokenBudgetBatchSampler`) so that they reshuffle every epoch.
+    """
+    for s in [getattr(loader, 'sampler', None), getattr(loader, 'batch_sampler', None)]:
+        if hasattr(s, 'set_epoch'):
+            s.set_epoch(epoch)
+
 def debug(model: BaseModel, data_loader:DataLoader,
           device: torch.device) -> Tuple[torch.Tensor]:
     """
@@ -77,6 +77,11 @@ def add_hyperparam_args(parser: argparse.ArgumentParser):
         - learning_rate
         - dropout
         - num_epochs
+        - state_every
+        - torch_compile
+        - bf16
+        - accum_steps
+        - max_tokens
         
     """
     # hyperparameter options
@@ -111,6 +116,32 @@ def add_hyperparam_args(parser: argparse.ArgumentParser):
         action='store', type=int, default=2000,
         help='Number of epochs for training (default: 2000)'
     )
+    parser.add_argument('-se',
+        '--state_every',
+        action='store', type=int, default=10,
+        help='Epochs between full training state checkpoints used to resume preempted jobs, ' + \
+            '0 to disable (default: 10)'
+    )
+    parser.add_argument('-tc',
+        '--torch_compile', action='store_true',
+        help='Train with torch.compile(model).'
+    )
+    parser.add_argument('-bf16',
+        '--bf16', action='store_true',
+        help='Use bf16 autocast for training and evaluation on cpu.'
+    )
+    parser.add_argument('-as',
+        '--accum_steps',
+        action='store', type=int, default=1,
+        help='Micro-batches to accumulate gradients over for each optimizer step, the effective ' + \
+            'batch size (used in the model key) is batch_size x accum_steps (default: 1)'
+    )
+    parser.add_argument('-mt',
+        '--max_tokens',
+        action='store', type=int, default=None,
+        help='Build training micro-batches by a budget of protein residues instead of a fixed ' + \
+            'number of samples (default: None - fixed batch_size)'
+    )
     return parser
 
 def add_dataset_args(parser: argparse.ArgumentParser):
@@ -122,6 +153,11 @@ def add_dataset_args(parser: argparse.ArgumentParser):
         - shuffle_data
         - rand_seed
         - fold_selection
+        - all_folds
+        - gcn_norm
+        - compact
+        - loader_workers, no_persistent_workers, prefetch_factor, pin_memory, mmap
+        - cache_eval
     """
 
     # Add the argument for data_opt
@@ -157,6 +193,50 @@ def add_dataset_args(parser: argparse.ArgumentParser):
         action='store', type=int, default=0,
         help='Fold selection (default: 0 - first fold)'
     )
+    parser.add_argument('-af',
+        '--all_folds',
+        action='store', type=int, nargs='?', const=5, default=None,
+        help='Train folds 0 to N-1 (default N: 5) in one process sharing the loaded dataset, ' + \
+            'overrides --fold_selection (default: None - only train --fold_selection)'
+    )
+    parser.add_argument('-gcn',
+        '--gcn_norm', action='store_true',
+        help='Precompute GCN edge normalization for each graph instead of recomputing it every step.'
+    )
+    parser.add_argument('-cmp',
+        '--compact', action='store_true',
+        help='Keep node features as compact residue/atom codes in memory, expanded when batches are loaded.'
+    )
+    
+    # DataLoader performance options:
+    parser.add_argument('-lw',
+        '--loader_workers',
+        action='store', type=int, default=0,
+        help='Number of DataLoader worker processes (default: 0 - load in main process)'
+    )
+    parser.add_argument('-npw',
+        '--no_persistent_workers', action='store_true',
+        help='Restart DataLoader workers every epoch instead of keeping them alive.'
+    )
+    parser.add_argument('-pff',
+        '--prefetch_factor',
+        action='store', type=int, default=2,
+        help='Batches prefetched by each DataLoader worker (default: 2)'
+    )
+    parser.add_argument('-pin',
+        '--pin_memory', action='store_true',
+        help='Use pinned memory for faster host to GPU copies.'
+    )
+    parser.add_argument('-mm',
+        '--mmap', action='store_true',
+        help='Memory map the saved graphs so that DataLoader workers share them instead of copying. ' + \
+            'Anything added on load is not mapped: node features with --compact and GCN norms with ' + \
+            '--gcn_norm for datasets saved without them.'
+    )
+    parser.add_argument('-ce',
+        '--cache_eval', action='store_true',
+        help='Collate the val/test batches once and keep them on the training device across epochs.'
+    )
     
     # for test.py:
     parser.add_argument('-spte', # default is not to save predictions
@@ -214,6 +294,36 @@ def add_slurm_dist_args(parser: argparse.ArgumentParser):
     )
     return parser
 
+def add_local_dist_args(parser: argparse.ArgumentParser):
+    """Arguments for local cpu data-parallel training (see `src.train_test.distributed.launch_cpu`)"""
+    parser.add_argument('-p',
+        '--port',
+        action='store', type=int, default=random.randint(49152,65535),
+        help='Port for DDP (default: random int)'
+    )
+    parser.add_argument('-np',
+        '--nprocs',
+        action='store', type=int, default=2,
+        help='Number of cpu processes to train with (default: 2)'
+    )
+    parser.add_argument('-tpr',
+        '--threads_per_rank',
+        action='store', type=int, default=None,
+        help='Torch threads for each process (default: cpu count // nprocs)'
+    )
+    parser.add_argument('-ms',
+        '--max_steps',
+        action='store', type=int, default=None,
+        help='Only train on this many batches per epoch and skip checkpoints and test metrics, ' + \
+            'for quick benchmarks (see `benchmark.py ddp_cpu`) (default: None, full training run)'
+    )
+    parser.add_argument('-lo',
+        '--logs_out',
+        action='store', type=str, default=None,
+        help='Json file for rank 0 to write the training logs to (default: None)'
+    )
+    return parser
+
 def safe_parse(parser: argparse.ArgumentParser, 
                jyp_args:str='-m EAT -d davis -f nomsa -e simple -D'):
     """Safe argument parsing for jupyter notebooks"""
@@ -262,14 +372,16 @@ def process_unknown_args(unknown_args):
             i += 1
     return kwargs
 
-def parse_train_test_args(verbose=True, distributed=False, 
+def parse_train_test_args(verbose=True, distributed=False, local=False,
                           jyp_args='-m EAT -d davis -f nomsa -e simple -D'):
     # Create the argument parser
     parser = argparse.ArgumentParser(description="Arguments for train test.")
     add_model_args(parser)
     add_dataset_args(parser)
     add_hyperparam_args(parser)
-    if distributed: 
+    if local:
+        add_local_dist_args(parser)
+    elif distributed: 
         add_slurm_dist_args(parser)
     args, unknown_args = safe_parse(parser, jyp_args=jyp_args)
     unknown_args = process_unknown_args(unknown_args)
@@ -279,13 +391,16 @@ def parse_train_test_args(verbose=True, distributed=False,
     if verbose:
         # Now you can use the selected options in your code as needed
         if args.debug: print(f'|============|! DEBUG MODE !|============|\n')
-        global_bs = args.batch_size
-        if distributed:
+        global_bs = args.batch_size * args.accum_steps
+        if local:
+            global_bs *= args.nprocs
+        elif distributed:
             global_bs *= args.slurm_nnodes * args.slurm_ngpus
         print(f"---------------- DATA OPT ----------------")
         print(f"             data_opt: {args.data_opt}")
         print(f"      protein_overlap: {args.protein_overlap}")
-        print(f"       fold_selection: {args.fold_selection}\n")
+        print(f"       fold_selection: {args.fold_selection}")
+        print(f"            all_folds: {args.all_folds}\n")
         print(f"---------------- MODEL OPT ---------------")
         print(f"   Selected model_opt: {args.model_opt}")
         print(f"    Selected data_opt: {args.data_opt}")
@@ -297,7 +412,9 @@ def parse_train_test_args(verbose=True, distributed=False,
         print(f"      ligand_edge_opt: {args.ligand_edge_opt}\n")
 
         print(f"-------------- HYPERPARAMETERS -----------")
-        print(f"   Global Batch size: {global_bs}")
+        print(f"   Global Batch size: {global_bs}" + \
+              (f" ({args.accum_steps} accumulation steps)" if args.accum_steps > 1 else ""))
+        if args.max_tokens: print(f"          Max tokens: {args.max_tokens}")
         print(f"       Learning rate: {args.learning_rate}")
         print(f"             Dropout: {args.dropout}")
         print(f"          Num epochs: {args.num_epochs}\n")
@@ -308,4 +425,12 @@ def parse_train_test_args(verbose=True, distributed=False,
             print(f"-------------------------------------------\n")
         
         
-    return args, unknown_args
\ No newline at end of file
+    return args, unknown_args
+
+def loader_kwargs(args) -> dict:
+    """DataLoader performance kwargs from `add_dataset_args` for `Loader.load_DataLoaders`"""
+    return {'num_workers': args.loader_workers, 
+            'persistent_workers': not args.no_persistent_workers,
+            'prefetch_factor': args.prefetch_factor, 
+            'pin_memory': args.pin_memory, 
+            'mmap': args.mmap}
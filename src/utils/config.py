@@ -133,6 +133,10 @@ elif 'narval' in DOMAIN_NAME:
     SLURM_GPU_NAME = 'a100'
     DATA_ROOT = os.path.abspath(Path.home() / 'scratch' / DATA_BASENAME)
 
+# Content addressed cache of Modeller mutant structures (see `MutantStructureCache` in src/utils/mutate_model.py)
+# set MUTDTA_MUTANT_CACHE to an empty string to disable it.
+MUTANT_CACHE_DIR = os.environ.get('MUTDTA_MUTANT_CACHE', f'{DATA_ROOT}/mutant_cache')
+MUTANT_CACHE_MAX_GB = float(os.environ.get('MUTDTA_MUTANT_CACHE_GB', 20))
 
 # bin paths
 FOLDSEEK_BIN = f'{Path.home()}/lib/foldseek/bin/foldseek'
@@ -3,10 +3,11 @@ import logging
 from functools import wraps
 from typing import Iterable
 import torch
+from torch.utils.data import Subset, Sampler
 from torch.utils.data.distributed import DistributedSampler
 from torch_geometric.loader import DataLoader
 
-from src.models.utils import BaseModel
+from src.models.utils import BaseModel, get_frozen_prefixes
 from src.models.lig_mod import ChemDTA, ChemEsmDTA
 from src.models.esm_models import EsmDTA, SaProtDTA
 from src.models.prior_work import DGraphDTA, DGraphDTAImproved
@@ -14,7 +15,7 @@ from src.models.ring3 import Ring3DTA
 from src.models.gvp_models import GVPModel, GVPLigand_DGPro, GVPLigand_RNG3, GVPL_ESM
 from src.data_prep.datasets import PDBbindDataset, DavisKibaDataset, PlatinumDataset, BaseDataset
 from src.utils import config  as cfg # sets up os env for HF
-from src import TUNED_MODEL_CONFIGS
+from src import TUNED_MODEL_CONFIGS, DEFAULT_LOADER_KWARGS
 from glob import glob
 
 
@@ -29,6 +30,123 @@ def validate_args(valid_options):
         return wrapper
     return decorator
 
+class ShardSampler(Sampler):
+    """
+    Splits the dataset across ranks for evaluation without padding or dropping samples
+    (unlike `DistributedSampler`), rank r gets indices r, r+num_replicas, ...
+    """
+    def __init__(self, dataset, num_replicas:int, rank:int):
+        self.n = len(dataset)
+        self.num_replicas = num_replicas
+        self.rank = rank
+        
+    def __iter__(self):
+        return iter(range(self.rank, self.n, self.num_replicas))
+    
+    def __len__(self):
+        return len(range(self.rank, self.n, self.num_replicas))
+
+
+def _protein_lengths(dataset) -> list[int]:
+    """Protein sequence length of each sample in a `BaseDataset` (or a `Subset` of one)"""
+    if isinstance(dataset, Subset):
+        return [int(l) for l in dataset.dataset.df['prot_seq'].str.len().iloc[dataset.indices]]
+    return [int(l) for l in dataset.df['prot_seq'].str.len()]
+
+
+class TokenBudgetBatchSampler(Sampler):
+    """
+    Batches samples so that the total number of protein residues in each batch stays under 
+    `max_tokens` instead of using a fixed number of samples, so batches of short proteins are 
+    large and batches of long proteins are small (use with gradient accumulation to reach the 
+    effective batch size, see `train(..., accum_steps)`).
+    
+    Samples are sorted by length within shuffled chunks of `chunk_size` so that batches have 
+    similar lengths, and batch order is reshuffled every epoch (seeded by `seed` + epoch so that 
+    all ranks agree and resumed runs get the same order, `train` calls `train_test.utils.set_epoch` 
+    before each epoch, like with `DistributedSampler`). For distributed runs each rank gets every 
+    `num_replicas`-th batch and all ranks get the same number of batches.
+    """
+    def __init__(self, dataset, max_tokens:int, shuffle:bool=True, seed:int=0, 
+                 chunk_size:int=1024, num_replicas:int=1, rank:int=0):
+        self.lengths = _protein_lengths(dataset)
+        assert max(self.lengths) <= max_tokens, \
+            f'max_tokens ({max_tokens}) is smaller than the longest protein ({max(self.lengths)})'
+        self.max_tokens = max_tokens
+        self.shuffle = shuffle
+        self.seed = seed
+        self.chunk_size = chunk_size
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.epoch = 0
+        self._cache = (None, None) # (epoch, batches)
+        
+    def set_epoch(self, epoch:int):
+        self.epoch = epoch
+    
+    def _batches(self) -> list[list[int]]:
+        """Batches of this rank for the current epoch (only built once per epoch)"""
+        if self._cache[0] != self.epoch:
+            self._cache = (self.epoch, self._build_batches())
+        return self._cache[1]
+    
+    def _build_batches(self) -> list[list[int]]:
+        g = torch.Generator()
+        g.manual_seed(self.seed + self.epoch)
+        idxs = torch.randperm(len(self.lengths), generator=g).tolist() if self.shuffle \
+                else list(range(len(self.lengths)))
+        
+        batches, batch, n_tokens = [], [], 0
+        for c in range(0, len(idxs), self.chunk_size):
+            for i in sorted(idxs[c:c+self.chunk_size], key=lambda i: self.lengths[i]):
+                if batch and n_tokens + self.lengths[i] > self.max_tokens:
+                    batches.append(batch)
+                    batch, n_tokens = [], 0
+                batch.append(i)
+                n_tokens += self.lengths[i]
+        if batch: batches.append(batch)
+        
+        if self.shuffle:
+            batches = [batches[i] for i in torch.randperm(len(batches), generator=g).tolist()]
+        # same number of batches on every rank (DDP needs the same number of steps)
+        n = len(batches) // self.num_replicas
+        return batches[self.rank:n*self.num_replicas:self.num_replicas]
+    
+    def __iter__(self):
+        return iter(self._batches())
+    
+    def __len__(self):
+        return len(self._batches())
+
+
+class CachedBatchLoader:
+    """
+    Collates the batches of an evaluation `DataLoader` once and keeps them resident (optionally 
+    already on `device`) so that re-running the same val/test set every epoch skips fetching 
+    and collating. Batch order is fixed to that of the first pass.
+    
+    Supports what `train_test.training.test` uses from a `DataLoader` (iteration, `len` and `sampler`).
+    """
+    def __init__(self, loader:DataLoader, device:torch.device=None):
+        self.dataset = loader.dataset
+        self.batch_size = loader.batch_size
+        self.batches = [self._to(b, device) for b in loader]
+        n = sum(len(b['y']) for b in self.batches)
+        self.sampler = range(n) # only used for its length
+        
+    @staticmethod
+    def _to(batch:dict, device) -> dict:
+        if device is None:
+            return batch
+        return {k: v.to(device) if hasattr(v, 'to') else v for k, v in batch.items()}
+    
+    def __iter__(self):
+        return iter(self.batches)
+    
+    def __len__(self):
+        return len(self.batches)
+
+
 ##########################################################
 ################## Class Method ##########################
 ##########################################################
@@ -38,6 +156,17 @@ class Loader():
     data_opt = cfg.DATA_OPT
     pro_feature_opt = cfg.PRO_FEAT_OPT
     
+    @staticmethod
+    def batch_key(batch_size:int, accum_steps:int=1, world_size:int=1, max_tokens:int=None) -> int|str:
+        """
+        `batch_size` for `get_model_key`. The effective batch size (`batch_size*world_size*accum_steps`) 
+        for fixed size batches, or `{max_tokens}Tx{world_size*accum_steps}` for token-budget batches 
+        (see `TokenBudgetBatchSampler`) since `batch_size` is then unused.
+        """
+        if max_tokens:
+            return f'{max_tokens}Tx{world_size*accum_steps}'
+        return batch_size*world_size*accum_steps
+    
     @staticmethod
     @validate_args({'model': model_opt, 'data':data_opt, 'edge': edge_opt, 'pro_feature': pro_feature_opt,
                     'ligand_feature':cfg.LIG_FEAT_OPT, 'ligand_edge':cfg.LIG_EDGE_OPT})
@@ -67,7 +196,8 @@ class Loader():
         
     @staticmethod
     @validate_args({'tuned_model':TUNED_MODEL_CONFIGS.keys()})
-    def load_tuned_model(tuned_model='davis_DG', fold=0, device=torch.device('cpu')):
+    def get_tuned_checkpoint(tuned_model='davis_DG', fold=0) -> tuple[str, dict]:
+        """Returns the checkpoint path and reformatted model kwargs for a tuned model"""
         MODEL_TUNED_PARAMS = TUNED_MODEL_CONFIGS[tuned_model]
 
         def reformat_kwargs(model_kwargs):
@@ -101,6 +231,13 @@ class Loader():
         if model_p != glob_p[0]:
             logging.warning(f'\n\t{glob_p[0]} -> \n\t{model_p}')
             os.rename(glob_p[0], model_p)
+        return model_p, model_kwargs
+
+    @staticmethod
+    @validate_args({'tuned_model':TUNED_MODEL_CONFIGS.keys()})
+    def load_tuned_model(tuned_model='davis_DG', fold=0, device=torch.device('cpu')):
+        MODEL_TUNED_PARAMS = TUNED_MODEL_CONFIGS[tuned_model]
+        model_p, model_kwargs = Loader.get_tuned_checkpoint(tuned_model, fold)
 
         logging.debug(f'loading: {model_p}')
         model = Loader.init_model(model=model_kwargs['model'], pro_feature=model_kwargs['pro_feature'], 
@@ -108,8 +245,43 @@ class Loader():
         # load checkpoint
         logging.debug(f'Loading checkpoint {model_p}')
         model.to(device)
-        model.load_state_dict(torch.load(model_p, map_location=device))
+        model.safe_load_state_dict(torch.load(model_p, map_location=device))
         return model, model_kwargs
+
+    @staticmethod
+    @validate_args({'tuned_model':TUNED_MODEL_CONFIGS.keys()})
+    def load_tuned_ensemble(tuned_model='davis_DG', folds:Iterable[int]=range(5), 
+                            device=torch.device('cpu'), use_vmap=True):
+        """
+        Loads all fold checkpoints of a tuned model into a single `FoldEnsemble` that shares 
+        frozen pretrained weights (e.g.: ESM) across folds.
+
+        Returns
+        -------
+        tuple[FoldEnsemble, dict]
+            The ensemble and model kwargs (`fold` is set to the list of folds and `loader_kwargs` 
+            to `tuned_loader_kwargs(tuned_model)` for loading its data).
+        """
+        from src.models.ensemble import FoldEnsemble
+        folds = list(folds)
+        # only the first fold initializes the model (and loads any pretrained weights)
+        model, model_kwargs = Loader.load_tuned_model(tuned_model, fold=folds[0], device=device)
+        shared = tuple(p + '.' for p in get_frozen_prefixes(model))
+
+        def trainable_state():
+            return {k: v.clone() for k, v in model.state_dict().items() if not k.startswith(shared)}
+
+        state_dicts = [trainable_state()]
+        for fold in folds[1:]:
+            model_p, _ = Loader.get_tuned_checkpoint(tuned_model, fold)
+            logging.debug(f'Loading checkpoint {model_p}')
+            # loading through the model keeps any key remapping done by its load_state_dict
+            model.safe_load_state_dict(torch.load(model_p, map_location=device))
+            state_dicts.append(trainable_state())
+
+        model_kwargs['fold'] = folds
+        model_kwargs['loader_kwargs'] = Loader.tuned_loader_kwargs(tuned_model)
+        return FoldEnsemble(model, state_dicts, use_vmap=use_vmap).to(device), model_kwargs
     
     @staticmethod
     @validate_args({'model': model_opt, 'edge': edge_opt, 'pro_feature': pro_feature_opt,
@@ -231,7 +403,7 @@ class Loader():
                      path:str=cfg.DATA_ROOT,
                      ligand_feature:str='original', ligand_edge:str='binary',
                      
-                     max_seq_len:int=1500):
+                     max_seq_len:int=1500, gcn_norm:bool=False, compact:bool=False, mmap:bool=False):
         # subset is used for train/val/test split.
         # can also be used to specify the cross-val fold used by train1, train2, etc.
         if data == 'PDBbind':
@@ -245,7 +417,10 @@ class Loader():
                     af_conf_dir=f'{path}/pdbbind/pdbbind_af2_out/all_ln/',
                     ligand_feature=ligand_feature,
                     ligand_edge=ligand_edge,
-                    max_seq_len=max_seq_len
+                    max_seq_len=max_seq_len,
+                    gcn_norm=gcn_norm,
+                    compact=compact,
+                    mmap=mmap,
                     )
         elif data in ['davis', 'kiba']:
             dataset = DavisKibaDataset(
@@ -259,7 +434,10 @@ class Loader():
                     af_conf_dir='../colabfold/davis_af2_out/',
                     ligand_feature=ligand_feature,
                     ligand_edge=ligand_edge,
-                    max_seq_len=max_seq_len
+                    max_seq_len=max_seq_len,
+                    gcn_norm=gcn_norm,
+                    compact=compact,
+                    mmap=mmap,
                     )
         elif data == 'platinum':
             dataset = PlatinumDataset(
@@ -274,16 +452,42 @@ class Loader():
                     ligand_feature=ligand_feature,
                     ligand_edge=ligand_edge,
                     subset=subset,
+                    gcn_norm=gcn_norm,
+                    compact=compact,
+                    mmap=mmap,
                 )
         else:
             # Check if dataset is a string (file path) and it exists
             if isinstance(data, str) and os.path.exists(data):
                 kwargs = Loader.parse_db_kwargs(data)
-                return Loader.load_dataset(**kwargs, max_seq_len=max_seq_len)
+                return Loader.load_dataset(**kwargs, max_seq_len=max_seq_len, gcn_norm=gcn_norm,
+                                           compact=compact, mmap=mmap)
             raise Exception(f'Invalid data option, pick from {Loader.data_opt}')
             
         return dataset
     
+    @staticmethod
+    def dataloader_kwargs(num_workers:int=0, persistent_workers:bool=True, prefetch_factor:int=2,
+                          pin_memory:bool=False) -> dict:
+        """
+        Performance related `DataLoader` kwargs. `persistent_workers` and `prefetch_factor` 
+        only apply when `num_workers` > 0 (torch raises otherwise).
+        """
+        kwargs = {'num_workers': num_workers, 'pin_memory': pin_memory}
+        if num_workers > 0:
+            kwargs['persistent_workers'] = persistent_workers
+            kwargs['prefetch_factor'] = prefetch_factor
+        return kwargs
+    
+    @staticmethod
+    @validate_args({'tuned_model':TUNED_MODEL_CONFIGS.keys()})
+    def tuned_loader_kwargs(tuned_model:str) -> dict:
+        """
+        `DEFAULT_LOADER_KWARGS` updated with the 'loader_kwargs' of a tuned config (if any), 
+        for use with `load_DataLoaders(..., **kwargs)`.
+        """
+        return {**DEFAULT_LOADER_KWARGS, **TUNED_MODEL_CONFIGS[tuned_model].get('loader_kwargs', {})}
+    
     @staticmethod
     @validate_args({'data': data_opt, 'pro_feature': pro_feature_opt, 'edge_opt': edge_opt,
                     'ligand_feature':cfg.LIG_FEAT_OPT, 'ligand_edge':cfg.LIG_EDGE_OPT})
@@ -291,7 +495,8 @@ class Loader():
                       subsets:Iterable[str]=['train', 'test', 'val'],
                       training_fold:int=None, # for cross-val. None for no cross-val
                       protein_overlap:bool=False, 
-                      ligand_feature:str='original', ligand_edge:str='binary'):
+                      ligand_feature:str='original', ligand_edge:str='binary',
+                      gcn_norm:bool=False, compact:bool=False, mmap:bool=False):
         # no overlap or cross-val
         subsets_cv = subsets
         
@@ -314,7 +519,8 @@ class Loader():
             dataset = Loader.load_dataset(data, pro_feature, edge_opt, 
                                           subset=s, path=path, 
                                           ligand_feature=ligand_feature, 
-                                          ligand_edge=ligand_edge)                
+                                          ligand_edge=ligand_edge,
+                                          gcn_norm=gcn_norm, compact=compact, mmap=mmap)
             loaded_datasets[k] = dataset
         return loaded_datasets
     
@@ -328,25 +534,75 @@ class Loader():
                       ligand_feature:str='original', ligand_edge:str='binary',
                       # NOTE:  if loaded_dataset is provided batch_train is the only real argument
                       loaded_datasets:dict=None,
-                      batch_train:int=64):
+                      batch_train:int=64, batch_test:int=None,
+                      gcn_norm:bool=False, compact:bool=False, mmap:bool=False,
+                      max_tokens:int=None, **loader_kwargs):
         # loaded_datasets is used to avoid loading the same dataset multiple times when we just want 
         # to create a new dataloader (e.g.: for testing with different batch size)
         if loaded_datasets is None:
             loaded_datasets = Loader.load_datasets(data=data, pro_feature=pro_feature, edge_opt=edge_opt, 
                                                path=path, subsets=datasets, training_fold=training_fold, 
                                                protein_overlap=protein_overlap, ligand_feature=ligand_feature, 
-                                               ligand_edge=ligand_edge)
+                                               ligand_edge=ligand_edge, gcn_norm=gcn_norm,
+                                               compact=compact, mmap=mmap)
         
+        # test set is evaluated in batches (`batch_test` defaults to `batch_train`) and in a fixed 
+        # order, `test(..., return_ids=True)` keeps per sample codes aligned with predictions
+        # `max_tokens` replaces the fixed training batch size with token-budget batches
         loaders = {}
         for d in loaded_datasets:
-            bs = 1 if d == 'test' else batch_train
+            if max_tokens and d == 'train':
+                loaders[d] = DataLoader(dataset=loaded_datasets[d],
+                                        batch_sampler=TokenBudgetBatchSampler(loaded_datasets[d], max_tokens),
+                                        **Loader.dataloader_kwargs(**loader_kwargs))
+                continue
+            bs = (batch_test or batch_train) if d == 'test' else batch_train
             loader = DataLoader(dataset=loaded_datasets[d], 
                                 batch_size=bs, 
-                                shuffle=True)
+                                shuffle=(d != 'test'),
+                                **Loader.dataloader_kwargs(**loader_kwargs))
             loaders[d] = loader
             
         return loaders
     
+    @staticmethod
+    @validate_args({'data': data_opt, 'pro_feature': pro_feature_opt, 'edge_opt': edge_opt,
+                    'ligand_feature':cfg.LIG_FEAT_OPT, 'ligand_edge':cfg.LIG_EDGE_OPT})
+    def load_fold_DataLoaders(data:str, pro_feature:str, edge_opt:str, folds:Iterable[int],
+                              path:str=cfg.DATA_ROOT, protein_overlap:bool=False,
+                              ligand_feature:str='original', ligand_edge:str='binary',
+                              batch_train:int=64, batch_test:int=None, 
+                              gcn_norm:bool=False, compact:bool=False, mmap:bool=False,
+                              max_tokens:int=None, **loader_kwargs) -> dict:
+        """
+        Loads the `full` dataset once and builds the cross-val folds as index views over it 
+        (from the rows of the saved `train{k}`/`val{k}`/`test` subsets), so that all folds share 
+        the same graphs in memory.
+
+        Returns
+        -------
+        dict
+            {'test': DataLoader, k: {'train': DataLoader, 'val': DataLoader}} for each k in `folds`.
+        """
+        full = Loader.load_dataset(data, pro_feature, edge_opt, subset='full', path=path,
+                                   ligand_feature=ligand_feature, ligand_edge=ligand_edge,
+                                   gcn_norm=gcn_norm, compact=compact, mmap=mmap)
+        sfx = '-overlap' if protein_overlap else ''
+        
+        def _loader(subset:str, bs:int, shuffle=True, token_budget=False) -> DataLoader:
+            dataset = Subset(full, full.subset_indices(subset + sfx))
+            if token_budget:
+                return DataLoader(dataset=dataset, batch_sampler=TokenBudgetBatchSampler(dataset, max_tokens),
+                                  **Loader.dataloader_kwargs(**loader_kwargs))
+            return DataLoader(dataset=dataset, batch_size=bs, shuffle=shuffle,
+                              **Loader.dataloader_kwargs(**loader_kwargs))
+        
+        loaders = {'test': _loader('test', batch_test or batch_train, shuffle=False)}
+        for k in folds:
+            loaders[k] = {'train': _loader(f'train{k}', batch_train, token_budget=bool(max_tokens)),
+                          'val': _loader(f'val{k}', batch_train)}
+        return loaders
+    
     @staticmethod
     @validate_args({'data': data_opt, 'pro_feature': pro_feature_opt, 'edge_opt': edge_opt,
                     'ligand_feature':cfg.LIG_FEAT_OPT, 'ligand_edge':cfg.LIG_EDGE_OPT})
@@ -359,28 +615,43 @@ class Loader():
                                      
                                      ligand_feature:str='original', ligand_edge:str='binary',
                                      
-                                     num_workers:int=4):
+                                     num_workers:int=4, gcn_norm:bool=False, compact:bool=False,
+                                     batch_test:int=None, mmap:bool=False, 
+                                     persistent_workers:bool=True, prefetch_factor:int=2,
+                                     pin_memory:bool=None, max_tokens:int=None):
         
         loaded_datasets = Loader.load_datasets(data=data, pro_feature=pro_feature, edge_opt=edge_opt, 
                                                path=path, subsets=datasets, training_fold=training_fold, 
                                                protein_overlap=protein_overlap, ligand_feature=ligand_feature, 
-                                               ligand_edge=ligand_edge)
+                                               ligand_edge=ligand_edge, gcn_norm=gcn_norm,
+                                               compact=compact, mmap=mmap)
+        # workers are kept alive between epochs (persistent_workers) instead of being rebuilt
+        pin_memory = torch.cuda.is_available() if pin_memory is None else pin_memory
+        loader_kwargs = Loader.dataloader_kwargs(num_workers, persistent_workers, 
+                                                 prefetch_factor, pin_memory)
         
         loaders = {}
         for d in loaded_datasets:
             dataset = loaded_datasets[d]
-            sampler = DistributedSampler(dataset, shuffle=False,
-                                            num_replicas=num_replicas,
-                                            rank=rank, seed=seed)
+            if d == 'train' and max_tokens:
+                sampler = TokenBudgetBatchSampler(dataset, max_tokens, shuffle=True, seed=seed,
+                                                  num_replicas=num_replicas, rank=rank)
+                loaders[d] = DataLoader(dataset=dataset, batch_sampler=sampler, **loader_kwargs)
+                continue
+            elif d == 'train':
+                sampler = DistributedSampler(dataset, shuffle=False,
+                                                num_replicas=num_replicas,
+                                                rank=rank, seed=seed)
+            else: # eval sets are sharded without dropping samples, see `test_distributed`
+                sampler = ShardSampler(dataset, num_replicas=num_replicas, rank=rank)
                                             
-            bs = 1 if d == 'test' else batch_train
+            bs = (batch_test or batch_train) if d == 'test' else batch_train
             loader = DataLoader(dataset=dataset, 
                                 sampler=sampler,
                                 batch_size=bs, # should be per gpu batch size (local batch size)
-                                num_workers=num_workers,
                                 shuffle=False, # mut exclusive with DDP
-                                pin_memory=True,
-                                drop_last=True) # drop last batch if not divisible by batch size
+                                **loader_kwargs,
+                                drop_last=(d == 'train')) # drop last batch if not divisible by batch size (except for eval)
             loaders[d] = loader
             
         return loaders
@@ -0,0 +1,598 @@
+"""
+Parallel saturation mutagenesis engine used by `run_mutagenesis.py`.
+
+Each worker process owns a persistent `ModellerMutator` (libraries + template loaded once) and runs the structure modelling + featurization
+for a single (residue, amino acid) cell. Workers are forked, so scripts should start the pool with `start_pool` before
+the model is loaded onto the gpu. The main process keeps the model and runs inference on the
+returned graphs. Finished cells are written to an on-disk matrix as they complete so that a restarted
+job (e.g.: after a SLURM timeout) only runs the cells that are still missing.
+"""
+import os, time, shutil, logging, tempfile, atexit
+import multiprocessing as mp
+
+import numpy as np
+import pandas as pd
+
+from src.utils.residue import ResInfo
+
+AMINO_ACIDS = ResInfo.amino_acids[:-1] # not including "X" - unknown
+
+
+class MutagenesisMatrix:
+    """
+    On-disk (memmapped) [20, L] (or [20, L, n_ligands]) matrix of predicted pkd values with a matching 
+    [20, L] `done` mask so that partially completed saturation runs can be resumed.
+    """
+    def __init__(self, out_fp:str, seq_len:int, flush_every:float=30.0, n_ligands:int=None):
+        """
+        Parameters
+        ----------
+        `out_fp` : str
+            Path to the .npy matrix, mask is saved alongside it as `*.done.npy`.
+        `seq_len` : int
+            Length of the protein sequence (L).
+        `flush_every` : float, optional
+            Seconds between flushes to disk, by default 30.0
+        `n_ligands` : int, optional
+            If set the matrix has a trailing ligand dimension [20, L, n_ligands] (all ligands of a cell are
+            set together), by default None
+        """
+        self.out_fp = out_fp
+        self.done_fp = out_fp.replace('.npy', '') + '.done.npy'
+        shape = (len(AMINO_ACIDS), seq_len) + ((n_ligands,) if n_ligands else ())
+
+        if os.path.isfile(self.out_fp) and os.path.isfile(self.done_fp):
+            self.values = np.lib.format.open_memmap(self.out_fp, mode='r+')
+            self.done = np.lib.format.open_memmap(self.done_fp, mode='r+')
+            assert self.values.shape == shape and self.done.shape == shape[:2], \
+                f"Existing matrix at {self.out_fp} has shape {self.values.shape} != {shape}"
+            logging.info(f'Resuming from {self.out_fp} with {self.done.sum()}/{self.done.size} cells done')
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(self.out_fp)), exist_ok=True)
+            self.values = np.lib.format.open_memmap(self.out_fp, mode='w+', dtype=np.float64, shape=shape)
+            self.done = np.lib.format.open_memmap(self.done_fp, mode='w+', dtype=bool, shape=shape[:2])
+            self.values[:] = np.nan
+            self.flush()
+
+        self.flush_every = flush_every
+        self._last_flush = time.time()
+
+    def pending(self) -> list[tuple[int,int]]:
+        """(AA index, residue index) cells that still need to be run, in residue order"""
+        return [(i, j) for j in range(self.done.shape[1]) for i in range(self.done.shape[0])
+                if not self.done[i, j]]
+
+    def set(self, i:int, j:int, value:float|np.ndarray):
+        # value is written before mask so a crash in between only causes the cell to be rerun
+        self.values[i, j] = value
+        self.done[i, j] = True
+        if time.time() - self._last_flush > self.flush_every:
+            self.flush()
+
+    def flush(self):
+        self.values.flush()
+        self.done.flush()
+        self._last_flush = time.time()
+
+    @property
+    def complete(self) -> bool:
+        return bool(self.done.all())
+
+
+##################################################
+### Worker process                             ###
+##################################################
+_WORKER = {}
+
+def _init_pool():
+    import torch
+    torch.set_num_threads(1) # parallelism comes from the pool
+
+def _setup_worker(init_fn, config:tuple):
+    """Runs `init_fn(*config)` the first time this worker gets a task for `config`"""
+    key = (init_fn.__name__, config)
+    if _WORKER.get('key') == key:
+        return
+    if _WORKER.get('mutator') is not None:
+        _WORKER['mutator'].close()
+    _WORKER.clear()
+    init_fn(*config)
+    _WORKER['key'] = key
+
+def _cell_errors() -> tuple:
+    """Exceptions that only fail a single cell (left as NaN) instead of the whole run"""
+    try:
+        from modeller import ModellerError
+        return (OverflowError, AssertionError, ModellerError)
+    except ImportError:
+        return (OverflowError, AssertionError)
+
+def start_pool(num_workers:int=None):
+    """
+    Forks a pool of Modeller workers. Workers are set up lazily for the structure of each task, so the 
+    same pool can be started at the top of a script before the model is loaded onto the gpu (forking 
+    after cuda has been initialized is unsafe) and passed to `run_saturation`, `run_combinatorial` or 
+    `compare_fast_to_modeller`.
+    """
+    num_workers = num_workers or len(os.sched_getaffinity(0))
+    return mp.get_context('fork').Pool(num_workers, initializer=_init_pool)
+
+def _start_own_pool(num_workers:int=None):
+    import torch
+    if torch.cuda.is_initialized():
+        logging.warning('Forking Modeller workers after cuda was initialized, use `start_pool` before '+\
+                        'loading the model instead.')
+    return start_pool(num_workers)
+
+def _init_worker(pdb_file:str, feature_opt:str, edge_opt:str, chain:str, n_attempts:int, tmp_dir:str):
+    from src.utils.mutate_model import ModellerMutator
+    from src.data_prep.quick_prep import IncrementalProteinFeatures
+    # libraries and template are loaded once per worker and reused for every mutation
+    mutator = ModellerMutator(pdb_file, chain=chain, n_attempts=n_attempts)
+    atexit.register(mutator.close)
+    # only recompute contacts of residues that moved when the features allow it
+    featurizer = None
+    if IncrementalProteinFeatures.supported(feature_opt, edge_opt):
+        featurizer = IncrementalProteinFeatures(pdb_file, feature_opt, edge_opt)
+    _WORKER.update(pdb_file=pdb_file, feature_opt=feature_opt, edge_opt=edge_opt,
+                   chain=chain, n_attempts=n_attempts, tmp_dir=tmp_dir, mutator=mutator,
+                   featurizer=featurizer)
+
+def _mutate_and_featurize(task:tuple[tuple, tuple[int,int]]):
+    """Returns (i, j, protein graph or None if modeller failed) for a (worker config, cell) task"""
+    from src.data_prep.quick_prep import get_protein_features
+    config, (i, j) = task
+    _setup_worker(_init_worker, config)
+    AA = AMINO_ACIDS[i]
+    restyp = ResInfo.code_to_pep[AA]
+    name = os.path.basename(_WORKER['pdb_file']).split('.pdb')[0]
+    out_fp = os.path.join(_WORKER['tmp_dir'], f'{name}-{restyp}_{j+1}.pdb')
+    try:
+        out_fp = _WORKER['mutator'].mutate(j+1, restyp, out_fp=out_fp)
+        try:
+            if _WORKER['featurizer'] is not None:
+                pro, _ = _WORKER['featurizer'](out_fp)
+            else:
+                pro, _ = get_protein_features(out_fp, _WORKER['feature_opt'], _WORKER['edge_opt'])
+        finally:
+            os.remove(out_fp) # delete after use
+        assert pro.pro_seq[j] == AA, f"ERROR in modeller, {pro.pro_seq[j]} != {AA} at position {j+1}"
+    except _cell_errors() as e:
+        logging.warning(f'Mutation {restyp} at position {j+1} failed: {e.__class__.__name__}: {e}')
+        return i, j, None
+    return i, j, pro
+
+
+##################################################
+### Main process                               ###
+##################################################
+class MutantPredictor:
+    """
+    Batched inference for mutants of the same protein against one or more ligands.
+
+    Ligand embeddings are computed once with `forward_mol` and each mutant's protein embedding is computed
+    once with `forward_pro`, so scoring extra ligands only costs a pass through the output head. Models 
+    without `forward_head` fall back to a full forward pass per ligand with a repeated ligand batch.
+    """
+    def __init__(self, model, lig, device):
+        """
+        Parameters
+        ----------
+        `lig` : torch_geometric.data.Data | list[torch_geometric.data.Data]
+            Single ligand graph (predictions have shape [B]) or list of ligands (predictions have 
+            shape [B, n_ligands]).
+        """
+        import torch
+        from torch_geometric.data import Batch
+        self.model = model
+        self.device = device
+        self.multi = isinstance(lig, (list, tuple))
+        self.ligs = list(lig) if self.multi else [lig]
+        self.split = hasattr(model, 'forward_head') and hasattr(model, 'forward_mol')
+        self.n_mutants = 0
+        self.model_time = 0.0
+        
+        if self.split:
+            with torch.inference_mode():
+                self.lig_emb = model.forward_mol(Batch.from_data_list(self.ligs).to(device)) # [n_ligands, D]
+    
+    def __call__(self, pros:list) -> 'np.ndarray':
+        import torch
+        from torch_geometric.data import Batch
+        t0 = time.perf_counter()
+        B, n = len(pros), len(self.ligs)
+        with torch.inference_mode():
+            batch = Batch.from_data_list(pros).to(self.device)
+            if self.split:
+                xp = self.model.forward_pro(batch) # [B, D]
+                # every (mutant, ligand) pair through the head
+                out = self.model.forward_head(self.lig_emb.repeat(B, 1), xp.repeat_interleave(n, dim=0))
+            else:
+                out = torch.stack([self.model(batch, Batch.from_data_list([l] * B).to(self.device)).flatten()
+                                   for l in self.ligs], dim=1)
+            out = out.reshape(B, n).cpu().numpy() # also syncs with device
+        self.model_time += time.perf_counter() - t0
+        self.n_mutants += B
+        return out if self.multi else out[:, 0]
+    
+
+def _modeller_mutants(cells:list[tuple[int,int]], pdb_file:str, feature_opt:str, edge_opt:str, chain:str, 
+                      n_attempts:int, num_workers:int=None, work_dir:str=None, pool=None):
+    """
+    Yields (i, j, protein graph or None) for each cell as the Modeller workers finish them. Uses `pool` 
+    (see `start_pool`) if given, otherwise a pool of `num_workers` is forked just for these cells.
+    """
+    from tqdm import tqdm
+    own_pool = pool is None
+    tmp_dir = tempfile.mkdtemp(prefix='mutagenesis_', dir=work_dir)
+    try:
+        pool = _start_own_pool(num_workers) if own_pool else pool
+        config = (pdb_file, feature_opt, edge_opt, chain, n_attempts, tmp_dir)
+        with tqdm(pool.imap_unordered(_mutate_and_featurize, [(config, c) for c in cells]), total=len(cells),
+                  ncols=100, desc=f'Modeller ({pool._processes} workers)') as t:
+            for i, j, pro in t:
+                t.set_postfix(res=j, AA=AMINO_ACIDS[i])
+                yield i, j, pro
+    finally:
+        if own_pool and pool is not None:
+            pool.terminate()
+        shutil.rmtree(tmp_dir, ignore_errors=True)
+
+
+def run_saturation(model, lig, pro_wt, pdb_file:str, out_fp:str, feature_opt:str, edge_opt:str,
+                   device, chain:str="A", n_attempts:int=5, num_workers:int=None, 
+                   batch_size:int=len(AMINO_ACIDS)-1, pool=None) -> np.ndarray:
+    """
+    Runs (or resumes) full saturation mutagenesis for `pdb_file` and writes results to `out_fp`.
+
+    Parameters
+    ----------
+    `model` : BaseModel
+        Model to run inference with (stays in the main process).
+    `lig` : torch_geometric.data.Data | list[torch_geometric.data.Data]
+        Ligand graph or list of ligand graphs to score every mutant against.
+    `pro_wt` : torch_geometric.data.Data
+        Protein graph of the native structure, used for the sequence and the native pkd.
+    `pdb_file` : str
+        Native structure to mutate.
+    `out_fp` : str
+        Path of the .npy output matrix of shape [20, L] (or [20, L, n_ligands] for a list of ligands).
+    `num_workers` : int, optional
+        Number of Modeller worker processes, by default all available cpus.
+    `batch_size` : int, optional
+        Number of mutant graphs to run through the model at once, by default 19 (all substitutions 
+        of a position).
+    `pool` : multiprocessing.pool.Pool, optional
+        Worker pool from `start_pool`, by default a new pool of `num_workers` is forked.
+
+    Returns
+    -------
+    np.ndarray
+        [20, L] (or [20, L, n_ligands]) matrix of predicted pkd values, NaN where modeller failed.
+    """
+    seq = pro_wt.pro_seq
+    predictor = MutantPredictor(model, lig, device)
+    matrix = MutagenesisMatrix(out_fp, len(seq), n_ligands=len(predictor.ligs) if predictor.multi else None)
+    original_pkd = predictor([pro_wt])[0]
+
+    # same AA cells dont need modeller
+    pending = []
+    for i, j in matrix.pending():
+        if seq[j] == AMINO_ACIDS[i]:
+            matrix.set(i, j, original_pkd)
+        else:
+            pending.append((i, j))
+
+    logging.info(f'{len(pending)} mutations left to run')
+
+    buffer = []
+    def flush_buffer():
+        if not buffer: return
+        for (i, j, _), pkd in zip(buffer, predictor([pro for _, _, pro in buffer])):
+            matrix.set(i, j, pkd)
+        buffer.clear()
+
+    t_start = time.perf_counter()
+    for i, j, pro in _modeller_mutants(pending, pdb_file, feature_opt, edge_opt, chain, n_attempts,
+                                       num_workers, work_dir=os.path.dirname(os.path.abspath(out_fp)),
+                                       pool=pool):
+        if pro is None:
+            matrix.set(i, j, np.nan)
+            continue
+        buffer.append((i, j, pro))
+        if len(buffer) >= batch_size:
+            flush_buffer()
+    flush_buffer()
+    matrix.flush()
+    
+    total = time.perf_counter() - t_start
+    n = max(predictor.n_mutants - 1, 0) # excluding native
+    logging.info(f'Saturation done in {total:.1f}s - modeller+featurization: {total-predictor.model_time:.1f}s, '+\
+                 f'model: {predictor.model_time:.2f}s for {n} mutants '+\
+                 f'({n / max(predictor.model_time, 1e-9):.1f} mutants/s)')
+    return np.array(matrix.values)
+
+
+##################################################
+### Structure-free fast mode                   ###
+##################################################
+def supports_fast_mode(feature_opt:str, edge_opt:str) -> bool:
+    """
+    Fast mode only applies when a point mutation changes nothing but the mutated node's features and 
+    the sequence: nomsa features (one-hot + residue properties, no pssm) and binary edges from the 
+    contact map. For these the only structural difference is the (minor) change in contacts of the 
+    new side chain, which is what the Modeller comparison report quantifies.
+    """
+    from src.utils import config as cfg
+    return feature_opt == cfg.PRO_FEAT_OPT.nomsa and edge_opt == cfg.PRO_EDGE_OPT.binary
+
+
+def _res_features(feature_opt:str) -> dict:
+    """node feature row for each amino acid"""
+    import torch
+    from src.data_prep.feature_extraction.protein import target_to_graph
+    # single node graph with an empty contact map gives the same features target_to_graph would
+    rows = {}
+    for AA in AMINO_ACIDS:
+        _, feat, _ = target_to_graph(AA, np.zeros((1, 1)), pro_feat=feature_opt)
+        rows[AA] = torch.Tensor(feat)[0]
+    return rows
+
+
+def fast_mutant(pro_wt, j:int, AA:str, res_features:dict):
+    """Copy of the wild-type graph with node `j` (0-indexed) and `pro_seq` patched to `AA`"""
+    pro = pro_wt.clone()
+    pro.x[j] = res_features[AA]
+    pro.pro_seq = pro_wt.pro_seq[:j] + AA + pro_wt.pro_seq[j+1:]
+    return pro
+
+
+def run_fast_saturation(model, lig, pro_wt, feature_opt:str, edge_opt:str, device, 
+                        batch_size:int=128) -> np.ndarray:
+    """
+    Scores the full [20, L] landscape by patching the wild-type graph instead of running Modeller.
+    Edge topology (and weights) are reused from the wild-type structure.
+
+    Parameters
+    ----------
+    `model` : BaseModel
+        Model to run inference with.
+    `lig` : torch_geometric.data.Data | list[torch_geometric.data.Data]
+        Ligand graph or list of ligand graphs.
+    `pro_wt` : torch_geometric.data.Data
+        Protein graph of the native structure.
+    `batch_size` : int, optional
+        Number of mutants per forward pass, by default 128
+
+    Returns
+    -------
+    np.ndarray
+        [20, L] (or [20, L, n_ligands]) matrix of predicted pkd values.
+    """
+    assert supports_fast_mode(feature_opt, edge_opt), \
+        f'Fast mode not supported for {feature_opt} features with {edge_opt} edges'
+    seq = pro_wt.pro_seq
+    res_features = _res_features(feature_opt)
+    predictor = MutantPredictor(model, lig, device)
+    
+    matrix = np.full((len(AMINO_ACIDS), len(seq)) + ((len(predictor.ligs),) if predictor.multi else ()), np.nan)
+    original_pkd = predictor([pro_wt])[0]
+    for j, a in enumerate(seq):
+        if a in AMINO_ACIDS: matrix[AMINO_ACIDS.index(a), j] = original_pkd
+    
+    cells = [(i, j) for j in range(len(seq)) for i in range(len(AMINO_ACIDS)) if seq[j] != AMINO_ACIDS[i]]
+    t0 = time.perf_counter()
+    for k in range(0, len(cells), batch_size):
+        chunk = cells[k:k+batch_size]
+        pkds = predictor([fast_mutant(pro_wt, j, AMINO_ACIDS[i], res_features) for i, j in chunk])
+        for (i, j), pkd in zip(chunk, pkds):
+            matrix[i, j] = pkd
+    logging.info(f'Fast saturation of {len(cells)} mutants done in {time.perf_counter()-t0:.2f}s')
+    return matrix
+
+
+def compare_fast_to_modeller(model, lig, pro_wt, pdb_file:str, feature_opt:str, edge_opt:str, device,
+                             fast_matrix:np.ndarray=None, n_positions:int=10, seed:int=0, 
+                             chain:str="A", n_attempts:int=5, num_workers:int=None, pool=None) -> dict:
+    """
+    Runs the Modeller path on `n_positions` randomly sampled positions and compares it against the 
+    fast mode predictions for the same cells.
+
+    Returns
+    -------
+    dict
+        Report with the sampled positions, error and correlation metrics and per-mutant timings.
+    """
+    from scipy.stats import pearsonr, spearmanr
+    assert not isinstance(lig, (list, tuple)), 'Comparison report only supports a single ligand'
+    seq = pro_wt.pro_seq
+    if fast_matrix is None:
+        fast_matrix = run_fast_saturation(model, lig, pro_wt, feature_opt, edge_opt, device)
+    
+    rng = np.random.default_rng(seed)
+    positions = sorted(rng.choice(len(seq), size=min(n_positions, len(seq)), replace=False).tolist())
+    cells = [(i, j) for j in positions for i in range(len(AMINO_ACIDS)) if seq[j] != AMINO_ACIDS[i]]
+    
+    predictor = MutantPredictor(model, lig, device)
+    t0 = time.perf_counter()
+    modeller, fast = [], []
+    for i, j, pro in _modeller_mutants(cells, pdb_file, feature_opt, edge_opt, chain, n_attempts, num_workers,
+                                       pool=pool):
+        if pro is None: continue
+        modeller.append(float(predictor([pro])[0]))
+        fast.append(float(fast_matrix[i, j]))
+    t_modeller = time.perf_counter() - t0
+    
+    modeller, fast = np.array(modeller), np.array(fast)
+    report = {'pdb_file': pdb_file, 'positions': [p+1 for p in positions], # 1-indexed as per PDB
+              'n_mutants': len(cells), 'n_modeller_failed': len(cells) - len(modeller),
+              'modeller_s_per_mutant': t_modeller / max(len(cells), 1)}
+    if len(modeller) > 0:
+        diff = np.abs(modeller - fast)
+        report.update(mae=float(diff.mean()), max_abs_diff=float(diff.max()))
+    if len(modeller) > 2:
+        report['pearson'] = float(pearsonr(modeller, fast)[0])
+        report['spearman'] = float(spearmanr(modeller, fast)[0])
+    return report
+
+
+##################################################
+### Combinatorial (multi-mutation) scan        ###
+##################################################
+def mutation_key(mutations:list[str]) -> str:
+    """Order independent key for a set of mutations in <native AA><index><mut AA> format"""
+    return '-'.join(sorted(mutations, key=lambda m: (int(m[1:-1]), m[-1])))
+
+def _init_combo_worker(pdb_file:str, feature_opt:str, edge_opt:str, chain:str, n_attempts:int, struct_dir:str):
+    from src.data_prep.quick_prep import IncrementalProteinFeatures
+    featurizer = None
+    if IncrementalProteinFeatures.supported(feature_opt, edge_opt):
+        featurizer = IncrementalProteinFeatures(pdb_file, feature_opt, edge_opt)
+    _WORKER.update(pdb_file=pdb_file, feature_opt=feature_opt, edge_opt=edge_opt, chain=chain,
+                   n_attempts=n_attempts, struct_dir=struct_dir, featurizer=featurizer)
+
+def _cached_structure(mutations:tuple[str]) -> str:
+    return os.path.join(_WORKER['struct_dir'], f'{mutation_key(mutations)}.pdb')
+
+def _build_and_featurize(task:tuple[tuple, tuple[str]]):
+    """
+    Returns (mutations, protein graph or None if modeller failed) for a (worker config, mutations) task. 
+    The structure is built on top of the largest already built subset of `mutations` so only the 
+    remaining mutations go through Modeller.
+    """
+    config, mutations = task
+    _setup_worker(_init_combo_worker, config)
+    try:
+        return mutations, _build_and_featurize_cell(mutations)
+    except _cell_errors() as e:
+        logging.warning(f'Mutations {mutation_key(mutations)} failed: {e.__class__.__name__}: {e}')
+        return mutations, None
+
+def _build_and_featurize_cell(mutations:tuple[str]):
+    from itertools import combinations
+    from src.utils.mutate_model import run_modeller_multiple
+    from src.data_prep.quick_prep import get_protein_features
+    out_fp = _cached_structure(mutations)
+    
+    if not os.path.isfile(out_fp):
+        base, remaining = _WORKER['pdb_file'], list(mutations)
+        for n in range(len(mutations)-1, 0, -1):
+            found = [c for c in combinations(mutations, n) if os.path.isfile(_cached_structure(c))]
+            if found:
+                base = _cached_structure(found[0])
+                remaining = [m for m in mutations if m not in found[0]]
+                break
+        
+        tmp_fp = out_fp.replace('.pdb', f'.{os.getpid()}.tmp.pdb')
+        run_modeller_multiple(base, remaining, chain=_WORKER['chain'], out_fp=tmp_fp,
+                              n_attempts=_WORKER['n_attempts'])
+        os.replace(tmp_fp, out_fp) # only complete structures are visible in the cache
+    
+    if _WORKER['featurizer'] is not None:
+        pro, _ = _WORKER['featurizer'](out_fp)
+    else:
+        pro, _ = get_protein_features(out_fp, _WORKER['feature_opt'], _WORKER['edge_opt'])
+    for m in mutations:
+        assert pro.pro_seq[int(m[1:-1])-1] == m[-1], f"ERROR in modeller, {m} not applied to {out_fp}"
+    return pro
+
+
+def run_combinatorial(model, lig, pro_wt, pdb_file:str, out_dir:str, feature_opt:str, edge_opt:str, device,
+                      max_order:int=2, top_k:int=10, positions:list[int]=None, rank_by:str='abs',
+                      chain:str="A", n_attempts:int=5, num_workers:int=None, 
+                      batch_size:int=len(AMINO_ACIDS)-1, pool=None) -> pd.DataFrame:
+    """
+    Combinatorial mutation scan with beam pruning. All single substitutions (of `positions`) are scored 
+    first, then each order n > 1 only extends the `top_k` combinations of order n-1 with the `top_k` 
+    singles at other positions.
+    
+    Mutant structures are kept in `{out_dir}/structures/` keyed by their mutation set, higher order 
+    mutants are built on top of them, and reruns reuse any structure that already exists.
+
+    Parameters
+    ----------
+    `out_dir` : str
+        Directory for the structure cache and the `combinatorial.csv` results.
+    `max_order` : int, optional
+        Maximum number of simultaneous mutations, by default 2
+    `top_k` : int, optional
+        Beam width, number of mutation sets that are expanded at each order, by default 10
+    `positions` : list[int], optional
+        1-indexed positions to mutate, by default all positions.
+    `rank_by` : str, optional
+        How to rank by ΔpKd; 'abs' for largest change, 'decrease' for loss of affinity (e.g.: resistance)
+        or 'increase', by default 'abs'
+    `pool` : multiprocessing.pool.Pool, optional
+        Worker pool from `start_pool`, by default a new pool of `num_workers` is forked.
+
+    Returns
+    -------
+    pd.DataFrame
+        mutations, order, pkd and delta_pkd for every scored mutation set.
+    """
+    assert rank_by in ['abs', 'decrease', 'increase'], f'Invalid rank_by option {rank_by}'
+    assert not isinstance(lig, (list, tuple)), 'Combinatorial scan only supports a single ligand'
+    seq = pro_wt.pro_seq
+    positions = positions or list(range(1, len(seq)+1))
+    struct_dir = os.path.join(out_dir, 'structures')
+    os.makedirs(struct_dir, exist_ok=True)
+    
+    predictor = MutantPredictor(model, lig, device)
+    wt_pkd = float(predictor([pro_wt])[0])
+    
+    def score(delta):
+        return {'abs': abs(delta), 'decrease': -delta, 'increase': delta}[rank_by]
+    
+    results = {} # key -> (mutations, pkd)
+    config = (pdb_file, feature_opt, edge_opt, chain, n_attempts, struct_dir)
+    own_pool = pool is None
+    pool = _start_own_pool(num_workers) if own_pool else pool
+    try:
+        singles = [(f'{seq[p-1]}{p}{AA}',) for p in positions for AA in AMINO_ACIDS if AA != seq[p-1]]
+        level = singles
+        for order in range(1, max_order+1):
+            logging.info(f'Order {order}: scoring {len(level)} mutation sets')
+            buffer = []
+            def flush_buffer():
+                if not buffer: return
+                for muts, pkd in zip([m for m, _ in buffer], predictor([p for _, p in buffer])):
+                    results[mutation_key(muts)] = (muts, float(pkd))
+                buffer.clear()
+            
+            for muts, pro in pool.imap_unordered(_build_and_featurize, [(config, m) for m in level]):
+                if pro is None:
+                    results[mutation_key(muts)] = (muts, np.nan)
+                    continue
+                buffer.append((muts, pro))
+                if len(buffer) >= batch_size:
+                    flush_buffer()
+            flush_buffer()
+            
+            if order == max_order: break
+            
+            # expand beam
+            scored = [results[mutation_key(m)] for m in level]
+            beam = sorted([s for s in scored if not np.isnan(s[1])],
+                          key=lambda s: score(s[1] - wt_pkd), reverse=True)[:top_k]
+            top_singles = beam if order == 1 else \
+                sorted([results[mutation_key(m)] for m in singles if not np.isnan(results[mutation_key(m)][1])],
+                       key=lambda s: score(s[1] - wt_pkd), reverse=True)[:top_k]
+            
+            level, seen = [], set()
+            for muts, _ in beam:
+                used = {int(m[1:-1]) for m in muts}
+                for (s,), _ in top_singles:
+                    key = mutation_key(muts + (s,))
+                    if int(s[1:-1]) in used or key in seen: continue
+                    seen.add(key)
+                    level.append(tuple(key.split('-')))
+    finally:
+        if own_pool:
+            pool.terminate()
+    
+    df = pd.DataFrame([{'mutations': mutation_key(muts), 'order': len(muts), 'pkd': pkd, 
+                        'delta_pkd': pkd - wt_pkd} for muts, pkd in results.values()])
+    df = df.sort_values(['order', 'delta_pkd']).reset_index(drop=True)
+    df.to_csv(os.path.join(out_dir, 'combinatorial.csv'), index=False)
+    logging.info(f'Scored {len(df)} mutation sets, model time {predictor.model_time:.2f}s')
+    return df
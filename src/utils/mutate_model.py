@@ -1,10 +1,11 @@
-import sys
 import os
+import json
+import shutil
+import hashlib
 import logging
-import numpy as np
 from tqdm import tqdm
+from src import cfg
 from src.utils.residue import ResInfo, Chain
-from src.data_prep.quick_prep import get_protein_features
 
 # try catch around modeller since it is only really needed for run_mutagenesis.py
 try:
@@ -15,6 +16,119 @@ except ImportError:
     logging.warning("Modeller failed to import - will not able to run mutagenesis scripts.")
 
 
+RAND_SEED = -49837 # base seed, attempt `n` uses RAND_SEED+n
+_DEFAULT_CACHE = None # see `MutantStructureCache.default`
+
+
+class MutantStructureCache:
+    """
+    Content addressed cache of mutant structures so that the same mutation on the same template is only 
+    refined by Modeller once, regardless of the ligand, model or fold it is used for.
+
+    Keys are the sha256 of (template file digest, chain, mutations, n_attempts, seed, method) and 
+    structures are stored as `{cache_dir}/{key[:2]}/{key}.pdb`. Hits refresh the file mtime and the least 
+    recently used structures are evicted once the cache grows past `max_gb`. The size of the cache is only 
+    measured (by scanning `cache_dir`) on the first write and on eviction, so lookups never scan the cache.
+    """
+    _digests = {} # (path, mtime, size) -> sha256 of template file
+    
+    def __init__(self, cache_dir:str=None, max_gb:float=None):
+        """
+        Parameters
+        ----------
+        `cache_dir` : str, optional
+            Where to store the structures, by default `cfg.MUTANT_CACHE_DIR` (env: MUTDTA_MUTANT_CACHE)
+        `max_gb` : float, optional
+            Size limit before evicting, by default `cfg.MUTANT_CACHE_MAX_GB` (env: MUTDTA_MUTANT_CACHE_GB)
+        """
+        self.cache_dir = cache_dir or cfg.MUTANT_CACHE_DIR
+        self.max_bytes = (max_gb or cfg.MUTANT_CACHE_MAX_GB) * 1024**3
+        os.makedirs(self.cache_dir, exist_ok=True)
+        self._size = None # bytes, unknown until the first `evict`
+        self.hits, self.misses = 0, 0
+    
+    @classmethod
+    def default(cls) -> 'MutantStructureCache':
+        """Shared cache at the configured location (created once per process) or None if it is disabled"""
+        global _DEFAULT_CACHE
+        if not cfg.MUTANT_CACHE_DIR:
+            return None
+        if _DEFAULT_CACHE is None:
+            _DEFAULT_CACHE = cls()
+        return _DEFAULT_CACHE
+    
+    @classmethod
+    def file_digest(cls, fp:str) -> str:
+        st = os.stat(fp)
+        k = (os.path.abspath(fp), st.st_mtime_ns, st.st_size)
+        if k not in cls._digests:
+            with open(fp, 'rb') as f:
+                cls._digests[k] = hashlib.sha256(f.read()).hexdigest()
+        return cls._digests[k]
+    
+    def key(self, template:str, chain:str, mutations:list[tuple[int,str]], n_attempts:int, 
+            seed:int=RAND_SEED, method:str='run_modeller') -> str:
+        """
+        `mutations` is a list of (1-indexed residue position, 3 letter residue name), `method` separates 
+        structures from `run_modeller` and `ModellerMutator` since the latter reuses the random state.
+        """
+        payload = {'template': self.file_digest(template), 'chain': chain, 
+                   'mutations': sorted([int(p), r] for p, r in mutations),
+                   'n_attempts': n_attempts, 'seed': seed, 'method': method}
+        return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+    
+    def path(self, key:str) -> str:
+        return os.path.join(self.cache_dir, key[:2], f'{key}.pdb')
+    
+    def get(self, key:str, out_fp:str) -> bool:
+        """Copies cached structure to `out_fp`, returns False on a miss"""
+        fp = self.path(key)
+        try:
+            shutil.copyfile(fp, out_fp)
+            os.utime(fp) # mark as recently used
+        except FileNotFoundError:
+            self.misses += 1
+            return False
+        self.hits += 1
+        return True
+    
+    def put(self, key:str, src_fp:str):
+        fp = self.path(key)
+        os.makedirs(os.path.dirname(fp), exist_ok=True)
+        tmp_fp = f'{fp}.{os.getpid()}.tmp'
+        shutil.copyfile(src_fp, tmp_fp)
+        os.replace(tmp_fp, fp) # atomic so concurrent workers never see partial files
+        if self._size is None or self._size + os.path.getsize(fp) > self.max_bytes:
+            self.evict() # also measures the size of the cache
+        else:
+            self._size += os.path.getsize(fp)
+    
+    def _entries(self) -> list[tuple[float,int,str]]:
+        entries = []
+        for d in os.scandir(self.cache_dir):
+            if not d.is_dir(): continue
+            for f in os.scandir(d.path):
+                if f.name.endswith('.pdb'):
+                    st = f.stat()
+                    entries.append((st.st_mtime, st.st_size, f.path))
+        return entries
+    
+    def evict(self):
+        """Removes least recently used structures until the cache is at 90% of its limit"""
+        entries = sorted(self._entries())
+        self._size = sum(size for _, size, _ in entries)
+        if self._size <= self.max_bytes:
+            return
+        for _, size, fp in entries:
+            if self._size <= 0.9 * self.max_bytes: break
+            try:
+                os.remove(fp)
+                self._size -= size
+            except FileNotFoundError: # evicted by another process
+                pass
+        logging.debug(f'Evicted mutant cache down to {self._size/1024**3:.2f}GB')
+
+
 def optimize(atmsel, sched):
     #conjugate gradient
     for step in sched:
@@ -53,12 +167,124 @@ def make_restraints(mdl1, aln):
                 spline_on_site=True)
 
 
+def _new_env(rand_seed:int) -> 'Environ':
+    env = Environ(rand_seed=rand_seed)
+
+    env.io.hetatm = True
+    #soft sphere potential
+    env.edat.dynamic_sphere=False
+    #lennard-jones potential (more accurate)
+    env.edat.dynamic_lennard=True
+    env.edat.contact_shell = 4.0
+    env.edat.update_dynamic = 0.39
+
+    # Read customized topology file with phosphoserines (or standard one)
+    env.libs.topology.read(file='$(LIB)/top_heav.lib')
+
+    # Read customized CHARMM parameter library with phosphoserines (or standard one)
+    env.libs.parameters.read(file='$(LIB)/par.lib')
+    return env
+
+
+def _mutate(env, modelname:str, respos:str, restyp:str, chain:str, tmp_fp:str, out_fp:str,
+            template=None) -> str:
+    """
+    Single mutate + optimize attempt. Raises OverflowError if optimization fails.
+    
+    `template` is an already loaded `Model` of `modelname` that is only read from (used for 
+    residue numbering), if None it is read from file.
+    """
+    # Read the original PDB file and copy its sequence to the alignment array:
+    mdl1 = Model(env, file=modelname)
+    ali = Alignment(env)
+    ali.append_model(mdl1, atom_files=modelname, align_codes=modelname)
+
+    #set up the mutate residue selection segment
+    s = Selection(mdl1.chains[chain].residues[respos])
+
+    #perform the mutate residue operation
+    s.mutate(residue_type=restyp)
+    #get two copies of the sequence.  A modeller trick to get things set up
+    ali.append_model(mdl1, align_codes=modelname)
+
+    # Generate molecular topology for mutant
+    mdl1.clear_topology()
+    mdl1.generate_topology(ali[-1])
+
+
+    # Transfer all the coordinates you can from the template native structure
+    # to the mutant (this works even if the order of atoms in the native PDB
+    # file is not standard):
+    #here we are generating the model by reading the template coordinates
+    mdl1.transfer_xyz(ali)
+
+    # Build the remaining unknown coordinates
+    mdl1.build(initialize_xyz=False, build_method='INTERNAL_COORDINATES')
+
+    #yes model2 is the same file as model1.  It's a modeller trick.
+    mdl2 = template if template is not None else Model(env, file=modelname)
+
+    #required to do a transfer_res_numb
+    #ali.append_model(mdl2, atom_files=modelname, align_codes=modelname)
+    #transfers from "model 2" to "model 1"
+    mdl1.res_num_from(mdl2,ali)
+
+    #It is usually necessary to write the mutated sequence out and read it in
+    #before proceeding, because not all sequence related information about MODEL
+    #is changed by this command (e.g., internal coordinates, charges, and atom
+    #types and radii are not updated).
+    mdl1.write(file=tmp_fp)
+    mdl1.read(file=tmp_fp)
+
+    #set up restraints before computing energy
+    #we do this a second time because the model has been written out and read in,
+    #clearing the previously set restraints
+    make_restraints(mdl1, ali)
+
+    #a non-bonded pair has to have at least as many selected atoms
+    mdl1.env.edat.nonbonded_sel_atoms=1
+
+    sched = autosched.loop.make_for_model(mdl1)
+
+    #only optimize the selected residue (in first pass, just atoms in selected
+    #residue, in second pass, include nonbonded neighboring atoms)
+    #set up the mutate residue selection segment
+    s = Selection(mdl1.chains[chain].residues[respos])
+
+    mdl1.restraints.unpick_all()
+    mdl1.restraints.pick(s)
+
+    s.energy()
+
+    s.randomize_xyz(deviation=4.0)
+
+    mdl1.env.edat.nonbonded_sel_atoms=2
+    try:
+        optimize(s, sched)
+    finally:
+        if os.path.isfile(tmp_fp): os.remove(tmp_fp)
+
+    #feels environment (energy computed on pairs that have at least one member
+    #in the selected)
+    mdl1.env.edat.nonbonded_sel_atoms=1
+    optimize(s, sched)
+
+    s.energy()
+
+    #give a proper name
+    mdl1.write(file=out_fp)
+    return out_fp
+
+
 def run_modeller(modelname:str, respos:int|str, restyp:str, chain:str, out_fp:str=None, overwrite=False, 
-                 n_attempts=5):
+                 n_attempts=5, cache:MutantStructureCache|bool=True):
     """
     Takes in the model path (excluding .pdb extension) and the residue index to 
     change and the new residue. Outputs to same dir as "{modelname}-{respos}_restype.pdb"
 
+    NOTE: this builds a new Modeller environment for every attempt, use `ModellerMutator` when 
+    running many mutations on the same structure.
+
     Args:
         modelname (str): Model file path.
         respos (int): Index position for target residue (1-indexed)
@@ -66,6 +292,8 @@ def run_modeller(modelname:str, respos:int|str, restyp:str, chain:str, out_fp:st
         chain (str): Single character chain identifier.
         out_path (str): output path for pdb file to override default of "{modelname}-{respos}_restype.pdb".
         n_attempts (int): number of attempts to try for aleviating steric clashes
+        cache (MutantStructureCache|bool): cache to reuse structures from, True for the default cache and 
+            False to always run Modeller.
     """
     modelname = modelname.split('.pdb')[0]
     if out_fp and modelname == out_fp.split('.pdb')[0]:
@@ -80,114 +308,119 @@ def run_modeller(modelname:str, respos:int|str, restyp:str, chain:str, out_fp:st
     TMP_FILE_PATH = f"{modelname}-{restyp}_{respos}.tmp"
     OUT_FILE_PATH = out_fp or f"{modelname}-{restyp}_{respos}.pdb"
     
+    cache = MutantStructureCache.default() if cache is True else (cache or None)
+    if cache is not None:
+        key = cache.key(f'{modelname}.pdb', chain, [(respos, restyp)], n_attempts)
+        if cache.get(key, OUT_FILE_PATH):
+            return OUT_FILE_PATH
+    
     # Set a different value for rand_seed to get a different final model
     while n_attempts > 0:
-        env = Environ(rand_seed=-49837+n_attempts)
-
-        env.io.hetatm = True
-        #soft sphere potential
-        env.edat.dynamic_sphere=False
-        #lennard-jones potential (more accurate)
-        env.edat.dynamic_lennard=True
-        env.edat.contact_shell = 4.0
-        env.edat.update_dynamic = 0.39
-
-        # Read customized topology file with phosphoserines (or standard one)
-        env.libs.topology.read(file='$(LIB)/top_heav.lib')
-
-        # Read customized CHARMM parameter library with phosphoserines (or standard one)
-        env.libs.parameters.read(file='$(LIB)/par.lib')
-
-
-        # Read the original PDB file and copy its sequence to the alignment array:
-        mdl1 = Model(env, file=modelname)
-        ali = Alignment(env)
-        ali.append_model(mdl1, atom_files=modelname, align_codes=modelname)
-
-        #set up the mutate residue selection segment
-        s = Selection(mdl1.chains[chain].residues[respos])
-
-        #perform the mutate residue operation
-        s.mutate(residue_type=restyp)
-        #get two copies of the sequence.  A modeller trick to get things set up
-        ali.append_model(mdl1, align_codes=modelname)
-
-        # Generate molecular topology for mutant
-        mdl1.clear_topology()
-        mdl1.generate_topology(ali[-1])
-
-
-        # Transfer all the coordinates you can from the template native structure
-        # to the mutant (this works even if the order of atoms in the native PDB
-        # file is not standard):
-        #here we are generating the model by reading the template coordinates
-        mdl1.transfer_xyz(ali)
-
-        # Build the remaining unknown coordinates
-        mdl1.build(initialize_xyz=False, build_method='INTERNAL_COORDINATES')
-
-        #yes model2 is the same file as model1.  It's a modeller trick.
-        mdl2 = Model(env, file=modelname)
-
-        #required to do a transfer_res_numb
-        #ali.append_model(mdl2, atom_files=modelname, align_codes=modelname)
-        #transfers from "model 2" to "model 1"
-        mdl1.res_num_from(mdl2,ali)
-
-        #It is usually necessary to write the mutated sequence out and read it in
-        #before proceeding, because not all sequence related information about MODEL
-        #is changed by this command (e.g., internal coordinates, charges, and atom
-        #types and radii are not updated).
-        mdl1.write(file=TMP_FILE_PATH)
-        mdl1.read(file=TMP_FILE_PATH)
-
-        #set up restraints before computing energy
-        #we do this a second time because the model has been written out and read in,
-        #clearing the previously set restraints
-        make_restraints(mdl1, ali)
-
-        #a non-bonded pair has to have at least as many selected atoms
-        mdl1.env.edat.nonbonded_sel_atoms=1
-
-        sched = autosched.loop.make_for_model(mdl1)
-
-        #only optimize the selected residue (in first pass, just atoms in selected
-        #residue, in second pass, include nonbonded neighboring atoms)
-        #set up the mutate residue selection segment
-        s = Selection(mdl1.chains[chain].residues[respos])
-
-        mdl1.restraints.unpick_all()
-        mdl1.restraints.pick(s)
-
-        s.energy()
-
-        s.randomize_xyz(deviation=4.0)
-
-        mdl1.env.edat.nonbonded_sel_atoms=2
+        env = _new_env(rand_seed=RAND_SEED+n_attempts)
         try:
-            optimize(s, sched)
+            _mutate(env, modelname, respos, restyp, chain, TMP_FILE_PATH, OUT_FILE_PATH)
+            if cache is not None: cache.put(key, OUT_FILE_PATH)
+            return OUT_FILE_PATH
         except OverflowError as e: # failed once
+            n_attempts -= 1
             if n_attempts == 0:
                 raise e
             print("Overflow error - trying again")
-            n_attempts -= 1
-            continue
 
-        #feels environment (energy computed on pairs that have at least one member
-        #in the selected)
-        mdl1.env.edat.nonbonded_sel_atoms=1
-        optimize(s, sched)
 
-        s.energy()
+class ModellerMutator:
+    """
+    Persistent version of `run_modeller` for running many single mutations on the same structure 
+    (e.g.: one per saturation mutagenesis worker).
 
-        #give a proper name
-        mdl1.write(file=OUT_FILE_PATH)
+    Modeller environments (with the topology and parameter libraries) are built once per retry seed
+    and the read-only native template model is parsed once per environment, instead of on every 
+    attempt of every mutation. The native structure is also copied to local memory (/dev/shm if 
+    available) so that the per-mutation template reads dont go through a shared filesystem.
+    
+    NOTE: since environments are reused the Modeller random state carries over between mutations, 
+    results are equally valid samples but not bit-identical to `run_modeller`.
+    """
+    def __init__(self, modelname:str, chain:str="A", n_attempts:int=5, tmp_dir:str=None,
+                 cache:MutantStructureCache|bool=True):
+        """
+        Args:
+            modelname (str): Native model file path.
+            chain (str): Single character chain identifier.
+            n_attempts (int): number of attempts (each with a different seed) to try for 
+                aleviating steric clashes.
+            tmp_dir (str): where to keep the in memory copy of the template and tmp files, 
+                defaults to /dev/shm if it exists.
+            cache (MutantStructureCache|bool): cache to reuse structures from, True for the default cache 
+                and False to always run Modeller.
+        """
+        import tempfile, shutil
+        log.none()
+        self.chain = chain
+        self.n_attempts = n_attempts
+        
+        tmp_dir = tmp_dir or ('/dev/shm' if os.path.isdir('/dev/shm') else None)
+        self.tmp_dir = tempfile.mkdtemp(prefix='modeller_', dir=tmp_dir)
+        self.name = os.path.basename(modelname).split('.pdb')[0]
+        self.modelname = os.path.join(self.tmp_dir, self.name)
+        shutil.copyfile(modelname.split('.pdb')[0] + '.pdb', self.modelname + '.pdb')
+        
+        self._envs = {}
+        self._templates = {}
+        self.cache = MutantStructureCache.default() if cache is True else (cache or None)
+        self._src = modelname.split('.pdb')[0] + '.pdb'
+        
+    def _get_env(self, rand_seed:int):
+        if rand_seed not in self._envs:
+            env = _new_env(rand_seed)
+            self._envs[rand_seed] = env
+            self._templates[rand_seed] = Model(env, file=self.modelname)
+        return self._envs[rand_seed], self._templates[rand_seed]
+        
+    def mutate(self, respos:int|str, restyp:str, out_fp:str) -> str:
+        """
+        Args:
+            respos (int): Index position for target residue (1-indexed)
+            restyp (str): 3 letter residue name for what to change into
+            out_fp (str): output path for pdb file.
+
+        Raises:
+            OverflowError: if all attempts fail to resolve steric clashes.
+        """
+        respos = str(respos)
+        tmp_fp = os.path.join(self.tmp_dir, f"{self.name}-{restyp}_{respos}.tmp")
+        
+        if self.cache is not None:
+            key = self.cache.key(self._src, self.chain, [(respos, restyp)], self.n_attempts, method='mutator')
+            if self.cache.get(key, out_fp):
+                return out_fp
+        
+        n_attempts = self.n_attempts
+        while n_attempts > 0:
+            env, template = self._get_env(rand_seed=RAND_SEED+n_attempts)
+            try:
+                _mutate(env, self.modelname, respos, restyp, self.chain, tmp_fp, out_fp, template=template)
+                if self.cache is not None: self.cache.put(key, out_fp)
+                return out_fp
+            except OverflowError as e:
+                n_attempts -= 1
+                if n_attempts == 0:
+                    raise e
+                logging.debug(f"Overflow error on {restyp}{respos} - trying again")
+    
+    def close(self):
+        import shutil
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+        
+    def __enter__(self):
+        return self
+    
+    def __exit__(self, *args):
+        self.close()
 
-        #delete the temporary file
-        os.remove(TMP_FILE_PATH)
-        return OUT_FILE_PATH
 
-def run_modeller_multiple(modelname, mutations, chain="A", out_fp=None, check_refmatch=True, **kwargs):
+def run_modeller_multiple(modelname, mutations, chain="A", out_fp=None, check_refmatch=True, 
+                          cache:MutantStructureCache|bool=True, **kwargs):
     """
     Runs Modeller on a PDB file multiple times to apply all specified mutations and output a final PDB file.
 
@@ -203,6 +436,8 @@ def run_modeller_multiple(modelname, mutations, chain="A", out_fp=None, check_re
         check_refmatch (bool, optional): If True, verifies that the reference amino acid in the mutation string matches 
             the residue in the original PDB sequence at the specified position. Raises KeyError if there is a mismatch.
             Default is True.
+        cache (MutantStructureCache|bool, optional): cache for the final structure (keyed by the full set of 
+            mutations on `modelname`), True for the default cache and False to always run Modeller.
 
     Returns:
         str: The file path of the final mutated PDB file.
@@ -220,6 +455,13 @@ def run_modeller_multiple(modelname, mutations, chain="A", out_fp=None, check_re
     out_fp = out_fp or f"{modelname.split('.pdb')[0]}_{'-'.join(mutations)}.pdb"
     native_seq = Chain(modelname).getSequence()
     
+    cache = MutantStructureCache.default() if cache is True else (cache or None)
+    if cache is not None:
+        key = cache.key(modelname, chain, [(int(m[1:-1]), ResInfo.code_to_pep[m[-1]]) for m in mutations], 
+                        kwargs.get('n_attempts', 5))
+        if cache.get(key, out_fp):
+            return out_fp
+    
     with tqdm(mutations, ncols=100, total=len(mutations), desc="Applying mutations") as muts:
         for rpm in muts:
             muts.set_postfix(mut=rpm)
@@ -235,6 +477,8 @@ def run_modeller_multiple(modelname, mutations, chain="A", out_fp=None, check_re
                         chain=chain, 
                         out_fp=out_fp,
                         overwrite=True,
+                        cache=len(mutations) == 1 and cache, # intermediate structures are not cached
                         **kwargs)
             modelname = out_fp
+    if cache is not None and len(mutations) > 1: cache.put(key, out_fp)
     return out_fp
\ No newline at end of file
@@ -85,6 +85,8 @@ def mask_graph(data, mask: list[bool]):
         -edge_index : torch.Tensor
             The edge connections in COO format only relating to 
             the pocket nodes of the protein sequence of dimension [2, num_pocket_edges]
+        Any precomputed `gcn_edge_index`/`gcn_edge_weight` is removed since it no longer
+        matches the masked graph.
     """
     # node map for updating edge indicies after mask
     node_map = np.cumsum(mask) - 1
@@ -107,6 +109,9 @@ def mask_graph(data, mask: list[bool]):
     data.edge_index = torch.tensor(edges).T # reshape to (2, E)
     if 'edge_weight' in  data:
         data.edge_weight = data.edge_weight[edge_mask]
+    # precomputed GCN normalization (see BaseDataset.add_gcn_norm) is for the full graph
+    for k in ['gcn_edge_index', 'gcn_edge_weight']:
+        if k in data: del data[k]
     return data
 
 
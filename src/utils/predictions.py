@@ -0,0 +1,163 @@
+"""
+Append-only output for prediction results (inference.py, run_platinum.py, predict_tuned.py).
+
+Two formats are supported:
+    - csv: rows are appended to a single file under an exclusive `fcntl` lock so that concurrent jobs
+      (e.g.: SLURM array tasks) writing to the same file never lose rows. The header is only written
+      when the file is empty and new rows are reordered to match the existing header.
+    - parquet: `path` is a dataset directory partitioned by `partition_cols` (hive style, e.g.:
+      `model=davis_DG/fold=1/`) and every write adds a new uniquely named file, so no locking is needed.
+
+In both cases a write only costs O(new rows). Use `compact` (or `python -m src.utils.predictions compact`)
+to merge the small parquet files of each partition into one, and `merge` to combine multiple outputs.
+"""
+import os, csv, uuid, fcntl, logging, argparse, importlib.util
+
+import pandas as pd
+
+
+def _has_pyarrow() -> bool:
+    return importlib.util.find_spec('pyarrow') is not None
+
+
+def _is_parquet(path:str) -> bool:
+    return not path.endswith('.csv')
+
+
+class PredictionWriter:
+    def __init__(self, path:str, fmt:str='auto', partition_cols:list[str]=('model', 'fold'), run_id:str=None):
+        """
+        Parameters
+        ----------
+        `path` : str
+            Output csv file or parquet dataset directory.
+        `fmt` : str, optional
+            'csv', 'parquet' or 'auto' to pick from `path` (.csv -> csv, otherwise parquet), by default 'auto'
+        `partition_cols` : list[str], optional
+            Columns to partition the parquet dataset by, by default ('model', 'fold')
+        `run_id` : str, optional
+            Prefix for parquet files from this writer (e.g.: SLURM job id), by default a random id.
+        """
+        if fmt == 'auto':
+            fmt = 'parquet' if _is_parquet(path) else 'csv'
+        assert fmt in ['csv', 'parquet'], f'Invalid prediction output format {fmt}'
+        if fmt == 'parquet' and not _has_pyarrow():
+            raise ImportError('pyarrow is required for parquet prediction output, use a .csv path instead.')
+
+        self.path = path
+        self.fmt = fmt
+        self.partition_cols = list(partition_cols or [])
+        self.run_id = run_id or os.environ.get('SLURM_JOB_ID') or uuid.uuid4().hex[:8]
+
+    def write(self, rows:list[dict]|pd.DataFrame, index:bool=False) -> str:
+        """Appends `rows` to the output, returns the path that was written to"""
+        df = rows if isinstance(rows, pd.DataFrame) else pd.DataFrame(rows)
+        if len(df) == 0:
+            return self.path
+        if index:
+            df = df.reset_index()
+
+        if self.fmt == 'csv':
+            return self._write_csv(df)
+        return self._write_parquet(df)
+
+    def _write_csv(self, df:pd.DataFrame) -> str:
+        os.makedirs(os.path.dirname(os.path.abspath(self.path)), exist_ok=True)
+        with open(self.path, 'a+') as f:
+            fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                f.seek(0)
+                # csv.reader so that quoted column names (e.g.: containing commas) are parsed like pandas
+                cols = next(csv.reader(f), [])
+                if cols:
+                    extra = [c for c in df.columns if c not in cols]
+                    if extra:
+                        logging.warning(f'Dropping columns {extra} not in existing header of {self.path}')
+                    df = df.reindex(columns=cols)
+                f.seek(0, os.SEEK_END)
+                df.to_csv(f, header=not cols, index=False)
+                f.flush()
+            finally:
+                fcntl.flock(f, fcntl.LOCK_UN)
+        return self.path
+
+    def _write_parquet(self, df:pd.DataFrame) -> str:
+        cols = [c for c in self.partition_cols if c in df.columns]
+        groups = df.groupby(cols, sort=False) if cols else [((), df)]
+        for keys, part in groups:
+            keys = keys if isinstance(keys, tuple) else (keys,)
+            part_dir = os.path.join(self.path, *[f'{c}={k}' for c, k in zip(cols, keys)])
+            os.makedirs(part_dir, exist_ok=True)
+            fp = os.path.join(part_dir, f'{self.run_id}-{uuid.uuid4().hex[:8]}.parquet')
+            # write to tmp name first so readers never see partial files
+            part.drop(columns=cols).to_parquet(fp + '.tmp', index=False)
+            os.replace(fp + '.tmp', fp)
+        return self.path
+
+
+def read_predictions(path:str) -> pd.DataFrame:
+    """Reads a csv or partitioned parquet prediction output into a single DataFrame"""
+    if not _is_parquet(path):
+        return pd.read_csv(path)
+    if os.path.isfile(path):
+        return pd.read_parquet(path)
+
+    dfs = []
+    for root, _, files in os.walk(path):
+        parts = [p for p in os.path.relpath(root, path).split(os.sep) if '=' in p]
+        for f in sorted(files):
+            if not f.endswith('.parquet'): continue
+            df = pd.read_parquet(os.path.join(root, f))
+            for p in parts:
+                c, v = p.split('=', 1)
+                df[c] = int(v) if v.lstrip('-').isdigit() else v
+            dfs.append(df)
+    return pd.concat(dfs, ignore_index=True) if dfs else pd.DataFrame()
+
+
+def compact(path:str) -> int:
+    """
+    Merges all parquet files in each partition of the dataset at `path` into a single file.
+
+    Returns
+    -------
+    int
+        Number of files removed.
+    """
+    assert _is_parquet(path) and os.path.isdir(path), f'{path} is not a parquet dataset directory'
+    n_removed = 0
+    for root, _, files in os.walk(path):
+        files = sorted(f for f in files if f.endswith('.parquet'))
+        if len(files) < 2: continue
+        df = pd.concat([pd.read_parquet(os.path.join(root, f)) for f in files], ignore_index=True)
+        out_fp = os.path.join(root, f'compacted-{uuid.uuid4().hex[:8]}.parquet')
+        df.to_parquet(out_fp + '.tmp', index=False)
+        os.replace(out_fp + '.tmp', out_fp)
+        for f in files:
+            os.remove(os.path.join(root, f))
+        n_removed += len(files) - 1
+    return n_removed
+
+
+def merge(srcs:list[str], dest:str, **writer_kwargs) -> str:
+    """Appends all rows from the csv/parquet outputs in `srcs` to `dest`"""
+    writer = PredictionWriter(dest, **writer_kwargs)
+    for src in srcs:
+        writer.write(read_predictions(src))
+    return dest
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Compacts or merges prediction outputs.')
+    subparsers = parser.add_subparsers(dest='cmd', required=True)
+    p = subparsers.add_parser('compact', help='Merge the files of each partition of a parquet dataset.')
+    p.add_argument('path', type=str)
+    p = subparsers.add_parser('merge', help='Combine csv/parquet outputs into one.')
+    p.add_argument('srcs', type=str, nargs='+')
+    p.add_argument('-o', '--out', type=str, required=True, help='Output csv file or parquet dataset directory.')
+    args = parser.parse_args()
+
+    if args.cmd == 'compact':
+        print(f'Removed {compact(args.path)} files from {args.path}')
+    else:
+        print(f'Merged {len(args.srcs)} outputs into {merge(args.srcs, args.out)}')
@@ -0,0 +1,327 @@
+"""
+Local inference server that keeps tuned models resident between requests.
+
+Every call to `inference.py` or `run_mutagenesis.py` pays for python startup, heavy imports
+(transformers, prody, rdkit, torch_geometric), `Loader.load_tuned_model` and featurization before
+a single prediction is made. The server below loads each requested `TUNED_MODEL_CONFIGS` model once,
+caches protein and ligand graphs, and coalesces concurrent requests into micro-batches that are
+bounded by a latency budget.
+
+Requests are sent as JSON over localhost HTTP:
+
+    POST /predict {"model_opt": "davis_DG", "fold": 1, "pdb_files": [...],
+                   "ligand_smiles": "...", "ligand_sdf": null}
+    GET  /health
+
+See `inference_server.py` for the CLI and `InferenceClient` for the thin client used by `inference.py`.
+"""
+import os, json, time, logging, threading, queue
+from collections import OrderedDict
+from concurrent.futures import Future
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib import request as urllib_request
+
+DEFAULT_HOST = '127.0.0.1'
+DEFAULT_PORT = 8765
+
+
+class LRUCache:
+    """Thread safe LRU cache for featurized graphs."""
+    def __init__(self, max_size:int=512):
+        self.max_size = max_size
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get_or_create(self, key, create_fn):
+        with self._lock:
+            if key in self._data:
+                self._data.move_to_end(key)
+                self.hits += 1
+                return self._data[key]
+            self.misses += 1
+
+        # created outside of lock so that slow featurization doesnt block other threads
+        value = create_fn()
+        with self._lock:
+            self._data[key] = value
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_size:
+                self._data.popitem(last=False)
+        return value
+
+    def __len__(self):
+        return len(self._data)
+
+
+class FeatureCache:
+    """
+    Caches protein and ligand graphs for the server. Protein graphs are keyed by the pdb path
+    and its modification time so that edited files are always re-featurized.
+    """
+    def __init__(self, max_proteins:int=512, max_ligands:int=512):
+        self.proteins = LRUCache(max_proteins)
+        self.ligands = LRUCache(max_ligands)
+
+    def get_protein(self, pdb_file:str, feature_opt:str, edge_opt:str):
+        from src.data_prep.quick_prep import get_protein_features
+        key = (os.path.abspath(pdb_file), os.path.getmtime(pdb_file), feature_opt, edge_opt)
+        return self.proteins.get_or_create(key,
+                    lambda: get_protein_features(pdb_file, feature_opt, edge_opt)[0])
+
+    def get_ligand(self, smiles:str, lig_feat:str, lig_edge:str, sdf:str=None):
+        from src.data_prep.quick_prep import get_ligand_features
+        key = (smiles, os.path.abspath(sdf) if sdf else None, lig_feat, lig_edge)
+        return self.ligands.get_or_create(key,
+                    lambda: get_ligand_features(smiles, lig_feat, lig_edge, sdf))
+
+    def stats(self) -> dict:
+        return {'protein_cache': {'size': len(self.proteins), 'hits': self.proteins.hits,
+                                  'misses': self.proteins.misses},
+                'ligand_cache':  {'size': len(self.ligands), 'hits': self.ligands.hits,
+                                  'misses': self.ligands.misses}}
+
+
+class _Job:
+    """Single (protein, ligand) pair waiting to be run through a model."""
+    def __init__(self, pdb_file:str, smiles:str, sdf:str=None):
+        self.pdb_file = pdb_file
+        self.smiles = smiles
+        self.sdf = sdf
+        self.future = Future()
+        self.t_submit = time.perf_counter()
+
+
+class MicroBatcher:
+    """
+    Owns a single resident model and coalesces submitted jobs into micro-batches.
+
+    A batch is flushed as soon as `max_batch_size` jobs are waiting or the oldest job has
+    waited `max_latency_ms`, whichever comes first.
+    """
+    def __init__(self, model_opt:str, fold:int, features:FeatureCache, device=None,
+                 max_batch_size:int=8, max_latency_ms:float=20.0):
+        import torch
+        from src import TUNED_MODEL_CONFIGS
+        from src.utils.loader import Loader
+
+        self.model_opt = model_opt
+        self.fold = fold
+        self.params = TUNED_MODEL_CONFIGS[model_opt]
+        self.features = features
+        self.device = device or torch.device("cuda:0" if torch.cuda.is_available() else "cpu")
+        self.max_batch_size = max_batch_size
+        self.max_latency = max_latency_ms / 1000
+
+        self.model, _ = Loader.load_tuned_model(model_opt, fold=fold, device=self.device)
+        self.model.eval()
+
+        self.n_batches = 0
+        self.n_samples = 0
+        self._queue = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True,
+                                        name=f'batcher-{model_opt}-{fold}')
+        self._thread.start()
+
+    def submit(self, pdb_file:str, smiles:str, sdf:str=None) -> Future:
+        job = _Job(pdb_file, smiles, sdf)
+        self._queue.put(job)
+        return job.future
+
+    def _collect(self) -> list[_Job]:
+        jobs = [self._queue.get()] # blocks until there is work
+        deadline = jobs[0].t_submit + self.max_latency
+        while len(jobs) < self.max_batch_size:
+            timeout = deadline - time.perf_counter()
+            if timeout <= 0: break
+            try:
+                jobs.append(self._queue.get(timeout=timeout))
+            except queue.Empty:
+                break
+        return jobs
+
+    def _run(self):
+        while True:
+            jobs = self._collect()
+            try:
+                self._run_batch(jobs)
+            except Exception as e:
+                logging.exception(f'Batch failed for {self.model_opt}-{self.fold}')
+                for j in jobs:
+                    if not j.future.done(): j.future.set_exception(e)
+
+    def _run_batch(self, jobs:list[_Job]):
+        import torch
+        from torch_geometric.data import Batch
+
+        pro_list, lig_list, ok_jobs = [], [], []
+        for j in jobs:
+            try:
+                pro_list.append(self.features.get_protein(j.pdb_file, self.params['feature_opt'],
+                                                          self.params['edge_opt']))
+                lig_list.append(self.features.get_ligand(j.smiles, self.params['lig_feat_opt'],
+                                                         self.params['lig_edge_opt'], j.sdf))
+                ok_jobs.append(j)
+            except Exception as e: # bad input only fails that request
+                j.future.set_exception(e)
+        if len(ok_jobs) == 0: return
+
+        pro_batch = Batch.from_data_list(pro_list).to(self.device)
+        lig_batch = Batch.from_data_list(lig_list).to(self.device)
+        with torch.no_grad():
+            pred = self.model(pro_batch, lig_batch).cpu().numpy().flatten()
+
+        self.n_batches += 1
+        self.n_samples += len(ok_jobs)
+        for j, pkd, sq in zip(ok_jobs, pred, pro_batch.pro_seq):
+            j.future.set_result({'pdb_file': j.pdb_file, 'pred_pkd': float(pkd), 'pro_seq': sq})
+
+
+class ModelRegistry:
+    """Keeps one `MicroBatcher` per (model_opt, fold), loading models on first use."""
+    def __init__(self, features:FeatureCache=None, **batcher_kwargs):
+        self.features = features or FeatureCache()
+        self.batcher_kwargs = batcher_kwargs
+        self._batchers = {}
+        self._lock = threading.Lock()
+
+    def get(self, model_opt:str, fold:int) -> MicroBatcher:
+        key = (model_opt, int(fold))
+        with self._lock:
+            if key not in self._batchers:
+                logging.info(f'Loading model {model_opt} fold {fold}')
+                self._batchers[key] = MicroBatcher(model_opt, int(fold), self.features,
+                                                   **self.batcher_kwargs)
+            return self._batchers[key]
+
+    def predict(self, model_opt:str, fold:int, pdb_files:list[str], smiles:str,
+                sdf:str=None, timeout:float=None) -> list[dict]:
+        batcher = self.get(model_opt, fold)
+        futures = [batcher.submit(p, smiles, sdf) for p in pdb_files]
+        return [f.result(timeout=timeout) for f in futures]
+
+    def stats(self) -> dict:
+        return {'models': {f'{m}-{f}': {'batches': b.n_batches, 'samples': b.n_samples}
+                           for (m, f), b in self._batchers.items()},
+                **self.features.stats()}
+
+
+def _make_handler(registry:ModelRegistry):
+    class Handler(BaseHTTPRequestHandler):
+        def _send(self, code:int, payload:dict):
+            body = json.dumps(payload).encode()
+            self.send_response(code)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def do_GET(self):
+            if self.path == '/health':
+                self._send(200, {'status': 'ok', **registry.stats()})
+            else:
+                self._send(404, {'error': f'unknown path {self.path}'})
+
+        def do_POST(self):
+            if self.path != '/predict':
+                return self._send(404, {'error': f'unknown path {self.path}'})
+            try:
+                req = json.loads(self.rfile.read(int(self.headers['Content-Length'])))
+                smiles = req.get('ligand_smiles')
+                sdf = req.get('ligand_sdf')
+                if smiles is None and sdf is not None:
+                    from rdkit import Chem
+                    smiles = Chem.MolToSmiles(Chem.MolFromMolFile(sdf))
+                results = registry.predict(req['model_opt'], req.get('fold', 1),
+                                           req['pdb_files'], smiles, sdf)
+                self._send(200, {'results': results, 'SMILES': smiles})
+            except Exception as e:
+                logging.exception('Request failed')
+                self._send(500, {'error': f'{type(e).__name__}: {e}'})
+
+        def log_message(self, format, *args):
+            logging.debug(format % args)
+    return Handler
+
+
+def serve(host:str=DEFAULT_HOST, port:int=DEFAULT_PORT, preload:list[tuple[str,int]]=(),
+          **batcher_kwargs):
+    """
+    Starts the server and blocks forever.
+
+    Parameters
+    ----------
+    `host` : str, optional
+        Interface to bind to, by default localhost only.
+    `port` : int, optional
+        Port to listen on, by default 8765
+    `preload` : list[tuple[str,int]], optional
+        (model_opt, fold) pairs to load before accepting requests, by default ()
+    `batcher_kwargs` :
+        Passed to `MicroBatcher` (e.g.: max_batch_size, max_latency_ms).
+    """
+    registry = ModelRegistry(**batcher_kwargs)
+    for model_opt, fold in preload:
+        registry.get(model_opt, fold)
+
+    httpd = ThreadingHTTPServer((host, port), _make_handler(registry))
+    httpd.daemon_threads = True
+    logging.info(f'Serving on http://{host}:{port}')
+    try:
+        httpd.serve_forever()
+    finally:
+        httpd.server_close()
+
+
+class InferenceClient:
+    """Thin client for the inference server, only depends on the standard library."""
+    def __init__(self, url:str=f'http://{DEFAULT_HOST}:{DEFAULT_PORT}', timeout:float=None):
+        self.url = url.rstrip('/')
+        self.timeout = timeout
+
+    def health(self) -> dict:
+        with urllib_request.urlopen(f'{self.url}/health', timeout=self.timeout) as r:
+            return json.loads(r.read())
+
+    def predict(self, model_opt:str, fold:int, pdb_files:list[str],
+                ligand_smiles:str=None, ligand_sdf:str=None) -> dict:
+        payload = {'model_opt': model_opt, 'fold': fold,
+                   'pdb_files': [os.path.abspath(p) for p in pdb_files],
+                   'ligand_smiles': ligand_smiles,
+                   'ligand_sdf': os.path.abspath(ligand_sdf) if ligand_sdf else None}
+        req = urllib_request.Request(f'{self.url}/predict', data=json.dumps(payload).encode(),
+                                     headers={'Content-Type': 'application/json'})
+        try:
+            with urllib_request.urlopen(req, timeout=self.timeout) as r:
+                return json.loads(r.read())
+        except urllib_request.HTTPError as e:
+            raise RuntimeError(f'Server error: {json.loads(e.read()).get("error")}') from e
+
+
+def benchmark_server(url:str, model_opt:str, fold:int, pdb_files:list[str], ligand_smiles:str=None,
+                     ligand_sdf:str=None, n_requests:int=64, concurrency:int=8) -> dict:
+    """
+    Fires `n_requests` single-pdb requests at the server from `concurrency` client threads and
+    reports latency percentiles and throughput.
+    """
+    import numpy as np
+    from concurrent.futures import ThreadPoolExecutor
+    client = InferenceClient(url)
+
+    def one(i):
+        t0 = time.perf_counter()
+        client.predict(model_opt, fold, [pdb_files[i % len(pdb_files)]], ligand_smiles, ligand_sdf)
+        return time.perf_counter() - t0
+
+    one(0) # warmup so that model loading is not counted
+    t0 = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as pool:
+        latencies = np.array(list(pool.map(one, range(n_requests))))
+    total = time.perf_counter() - t0
+
+    return {'n_requests': n_requests, 'concurrency': concurrency,
+            'throughput_rps': n_requests / total,
+            'latency_p50_ms': float(np.percentile(latencies, 50) * 1000),
+            'latency_p95_ms': float(np.percentile(latencies, 95) * 1000),
+            'latency_max_ms': float(latencies.max() * 1000)}
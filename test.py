@@ -59,19 +59,17 @@ subsets = ['test', 'val', 'train'] if args.save_pred_train else ['test', 'val']
 loaders = Loader.load_DataLoaders(DATA, FEATURE, EDGE,
                                   datasets=subsets,
                                   path=cfg.DATA_ROOT,
-                                  batch_train=1, # MUST BE 1 FOR test SET
+                                  batch_train=128, # codes are returned by test() so batching is fine
                                   protein_overlap=args.protein_overlap,
                                   training_fold=args.fold_selection,
                                   ligand_feature=LIG_FEATURE,
                                   ligand_edge=LIG_EDGE)
 
 #%% Run model on test set
-loss, pred, actual = test(model, loaders['test'], device)
+loss, pred, actual, ids = test(model, loaders['test'], device, return_ids=True)
 if args.save_pred_test:
     # saving as csv with columns code, pred, actual
-    # get codes from test loader
-    codes = [b['code'][0] for b in loaders['test']] # NOTE: batch size is 1
-    df = pd.DataFrame({'pred': pred, 'actual': actual}, index=codes)
+    df = pd.DataFrame({'pred': pred, 'actual': actual}, index=ids['code'])
     out_dir = f'{cfg.MEDIA_SAVE_DIR}/test_set_pred/'
     os.makedirs(out_dir, exist_ok=True)
     df.index.name = 'name'
@@ -99,12 +97,10 @@ get_save_metrics(actual, pred,
 
 #%% Run model on train set
 if args.save_pred_train:
-    loss, pred, actual = test(model, loaders['train'], device)
+    loss, pred, actual, ids = test(model, loaders['train'], device, return_ids=True)
     print(f'# Train loss: {loss}')
     # save as csv with columns code, pred, actual
-    # get codes from test loader
-    codes = [b['code'][0] for b in loaders['train']] # NOTE: batch size is 1
-    df = pd.DataFrame({'pred': pred, 'actual': actual}, index=codes)
+    df = pd.DataFrame({'pred': pred, 'actual': actual}, index=ids['code'])
     out_dir = f'{cfg.MEDIA_SAVE_DIR}/train_set_pred/'
     os.makedirs(out_dir, exist_ok=True)
     df.index.name = 'name'
@@ -1,5 +1,5 @@
 # %%
-from src.utils.arg_parse import parse_train_test_args
+from src.utils.arg_parse import parse_train_test_args, loader_kwargs
 
 args, unknown_args = parse_train_test_args(verbose=True,
                              jyp_args='--model_opt EDI \
@@ -24,7 +24,7 @@ FORCE_TRAINING = args.train
 DEBUG = args.debug
 
 # Model Hyperparameters
-BATCH_SIZE = args.batch_size
+BATCH_SIZE = args.batch_size # micro-batch size
 LEARNING_RATE = args.learning_rate
 DROPOUT = args.dropout
 NUM_EPOCHS = args.num_epochs
@@ -47,10 +47,13 @@ import matplotlib.pyplot as plt
 
 from src.utils import config as cfg # sets up env vars
 
-from src.train_test.training import train, test, CheckpointSaver
+from src.train_test.training import train, train_folds, test, CheckpointSaver, StateCheckpointer
 from src.train_test.utils import  print_device_info, debug
 from src.analysis import get_save_metrics
-from src.utils.loader import Loader
+from src.utils.loader import Loader, CachedBatchLoader
+
+# for model keys, token budget batches (--max_tokens) dont use BATCH_SIZE
+EFFECTIVE_BATCH_SIZE = Loader.batch_key(BATCH_SIZE, args.accum_steps, max_tokens=args.max_tokens)
 
 # %%
 device = torch.device('cuda:0' if torch.cuda.is_available() else 'cpu')
@@ -66,6 +69,93 @@ cp_saver = CheckpointSaver(model=None,
                             min_delta=0.2,
                             patience=100)
 
+# %% Cross-validation folds in a single process
+def run_all_folds(MODEL, DATA, FEATURE, EDGEW, ligand_feature, ligand_edge):
+    """Trains and evaluates all folds sharing a single loaded copy of the `full` dataset"""
+    folds = list(range(args.all_folds))
+    media_save_p = f'{cfg.MEDIA_SAVE_DIR}/{DATA}/'
+    os.makedirs(f'{media_save_p}/train_log/', exist_ok=True)
+    
+    # ==== LOAD DATA ====
+    loaders = Loader.load_fold_DataLoaders(data=DATA, pro_feature=FEATURE, edge_opt=EDGEW, 
+                                           folds=folds, path=cfg.DATA_ROOT,
+                                           protein_overlap=args.protein_overlap,
+                                           ligand_feature=ligand_feature, ligand_edge=ligand_edge,
+                                           batch_train=BATCH_SIZE, gcn_norm=args.gcn_norm, 
+                                           compact=args.compact, max_tokens=args.max_tokens,
+                                           **loader_kwargs(args))
+    if args.cache_eval:
+        loaders['test'] = CachedBatchLoader(loaders['test'], device)
+        for k in folds:
+            loaders[k]['val'] = CachedBatchLoader(loaders[k]['val'], device)
+    
+    # ==== LOAD MODELS ====
+    keys, models, savers, logs = {}, {}, {}, {}
+    for k in folds:
+        keys[k] = Loader.get_model_key(model=MODEL,data=DATA,pro_feature=FEATURE,edge=EDGEW,
+                                       ligand_feature=ligand_feature, ligand_edge=ligand_edge,
+                                       batch_size=EFFECTIVE_BATCH_SIZE,lr=LEARNING_RATE,dropout=DROPOUT,
+                                       n_epochs=NUM_EPOCHS, pro_overlap=args.protein_overlap, fold=k)
+        print(f'# {keys[k]}')
+        models[k] = Loader.init_model(model=MODEL, pro_feature=FEATURE, pro_edge=EDGEW, dropout=DROPOUT,
+                                      ligand_feature=ligand_feature, ligand_edge=ligand_edge,
+                                      **unknown_args).to(device)
+        savers[k] = CheckpointSaver(model=models[k], save_path=f'{cfg.MODEL_SAVE_DIR}/{keys[k]}.model',
+                                    train_all=False, patience=100,
+                                    min_delta=0.2 if DATA == cfg.DATA_OPT.PDBbind else 0.03)
+    
+    if DEBUG:
+        debug(models[folds[0]], loaders[folds[0]]['train'], device)
+        return
+    
+    # ==== TRAINING ====
+    to_train = {}
+    for k in folds:
+        logs_out_p = f'{media_save_p}/train_log/{keys[k]}.json'
+        logs[k] = None
+        if os.path.exists(savers[k].save_path):
+            print(f'# Fold {k} already trained')
+            models[k].safe_load_state_dict(torch.load(savers[k].save_path, map_location=device))
+            if os.path.exists(logs_out_p):
+                with open(logs_out_p, 'r') as f:
+                    logs[k] = json.load(f)
+        if not os.path.exists(savers[k].save_path) or FORCE_TRAINING:
+            to_train[k] = models[k]
+    
+    if to_train:
+        # single training state for all folds (resumes if the job was preempted)
+        run_key = Loader.get_model_key(model=MODEL,data=DATA,pro_feature=FEATURE,edge=EDGEW,
+                                       ligand_feature=ligand_feature, ligand_edge=ligand_edge,
+                                       batch_size=EFFECTIVE_BATCH_SIZE,lr=LEARNING_RATE,dropout=DROPOUT,
+                                       n_epochs=NUM_EPOCHS, pro_overlap=args.protein_overlap)
+        state_ckpt = StateCheckpointer(f'{cfg.MODEL_SAVE_DIR}/{run_key}_folds{"-".join(map(str, to_train))}.state',
+                                       every=args.state_every)
+        new_logs = train_folds(to_train, loaders, device, savers, 
+                               epochs=NUM_EPOCHS, lr_0=LEARNING_RATE, state_ckpt=state_ckpt,
+                               compile_model=args.torch_compile, bf16=args.bf16,
+                               accum_steps=args.accum_steps)
+        state_ckpt.remove()
+        for k in to_train:
+            savers[k].save()
+            models[k].load_state_dict(savers[k].best_model_dict)
+            logs[k] = new_logs[k]
+            with open(f'{media_save_p}/train_log/{keys[k]}.json', 'w') as f:
+                json.dump(logs[k], f, indent=4)
+    
+    # ==== EVALUATE ====
+    for k in folds:
+        loss, pred, actual = test(models[k], loaders['test'], device)
+        print(f'# Fold {k} test loss: {loss}')
+        get_save_metrics(actual, pred, save_figs=SAVE_FIGS, save_path=media_save_p,
+                         model_key=keys[k], csv_file=cfg.MODEL_STATS_CSV,
+                         show=SHOW_PLOTS, logs=logs[k])
+        plt.clf()
+        
+        loss, pred, actual = test(models[k], loaders[k]['val'], device)
+        print(f'# Fold {k} val loss: {loss}')
+        get_save_metrics(actual, pred, save_figs=SAVE_FIGS, save_path=media_save_p,
+                         model_key=keys[k], csv_file=cfg.MODEL_STATS_CSV_VAL, show=False)
+
 # %% Training loop
 metrics = {}
 for (MODEL, DATA, 
@@ -75,9 +165,13 @@ for (MODEL, DATA,
                                                     args.feature_opt, args.edge_opt, 
                                                     args.ligand_feature_opt, args.ligand_edge_opt):
     print(f'\n{"-"*40}\n({MODEL}, {DATA}, {FEATURE}, {EDGEW})')
+    if args.all_folds is not None:
+        run_all_folds(MODEL, DATA, FEATURE, EDGEW, ligand_feature, ligand_edge)
+        continue
+    
     MODEL_KEY = Loader.get_model_key(model=MODEL,data=DATA,pro_feature=FEATURE,edge=EDGEW,
                                      ligand_feature=ligand_feature, ligand_edge=ligand_edge,
-                                     batch_size=BATCH_SIZE,lr=LEARNING_RATE,dropout=DROPOUT,n_epochs=NUM_EPOCHS,
+                                     batch_size=EFFECTIVE_BATCH_SIZE,lr=LEARNING_RATE,dropout=DROPOUT,n_epochs=NUM_EPOCHS,
                                      pro_overlap=args.protein_overlap, fold=args.fold_selection)
     print(f'# {MODEL_KEY} \n')
     
@@ -97,7 +191,12 @@ for (MODEL, DATA,
                                         batch_train=BATCH_SIZE,
                                         datasets=['train', 'test', 'val'],
                                         training_fold=args.fold_selection, # default is None from arg_parse
-                                        protein_overlap=args.protein_overlap)
+                                        protein_overlap=args.protein_overlap,
+                                        gcn_norm=args.gcn_norm, compact=args.compact,
+                                        max_tokens=args.max_tokens, **loader_kwargs(args))
+    if args.cache_eval: # val set is rerun every epoch, only collate it once
+        for d in ['val', 'test']:
+            loaders[d] = CachedBatchLoader(loaders[d], device)
 
 
     # ==== LOAD MODEL ====
@@ -119,18 +218,22 @@ for (MODEL, DATA,
     if os.path.exists(cp_saver.save_path):
         print('# Model already trained')
         # load ckpnt
-        model.load_state_dict(torch.load(cp_saver.save_path, 
-                                         map_location=device))
+        model.safe_load_state_dict(torch.load(cp_saver.save_path, 
+                                              map_location=device))
         # loading logs for plotting
         if os.path.exists(logs_out_p):
             with open(logs_out_p, 'r') as f:
                 logs = json.load(f)
     
     if not os.path.exists(cp_saver.save_path) or FORCE_TRAINING:
-        # training
+        # training (resumes from the last training state if the job was preempted)
+        state_ckpt = StateCheckpointer(f'{model_save_p}.state', every=args.state_every)
         logs = train(model, loaders['train'], loaders['val'], device, 
-                    epochs=NUM_EPOCHS, lr_0=LEARNING_RATE, saver=cp_saver)
+                    epochs=NUM_EPOCHS, lr_0=LEARNING_RATE, saver=cp_saver,
+                    state_ckpt=state_ckpt, compile_model=args.torch_compile, bf16=args.bf16,
+                    accum_steps=args.accum_steps)
         cp_saver.save()
+        state_ckpt.remove()
         # load best model for testing
         model.load_state_dict(cp_saver.best_model_dict) 
         # save training logs for plotting later
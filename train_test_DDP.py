@@ -5,6 +5,7 @@ import submitit
 from src.utils import config as cfg  # sets up env vars
 from src.utils.arg_parse import parse_train_test_args
 from src.train_test import dtrain
+from src.utils.loader import Loader
 
 args, unknown_args = parse_train_test_args(verbose=True, distributed=True,
                              jyp_args=' -odir ./slurm_out_DDP/%j' +
@@ -18,7 +19,7 @@ os.makedirs(os.path.dirname(args.output_dir), exist_ok=True)
 
 # Model name and dataset cannot be added since we can provide a list of them
 args.output_dir += f'_{"-".join(args.model_opt)}_{"-".join(args.data_opt)}{args.fold_selection or ""}_'+\
-                   f'{"-".join(args.edge_opt)}_{args.learning_rate}_{args.batch_size*args.slurm_nnodes*args.slurm_ngpus}'
+                   f'{"-".join(args.edge_opt)}_{args.learning_rate}_{Loader.batch_key(args.batch_size, args.accum_steps, args.slurm_nnodes*args.slurm_ngpus, args.max_tokens)}'
 print("out_dir:", args.output_dir)
 
 # %% SETUP SLURM EXECUTOR
@@ -0,0 +1,13 @@
+# %%
+from src.utils import config as cfg  # noqa: F401 - imported for its side effect of setting up env vars
+from src.utils.arg_parse import parse_train_test_args
+from src.train_test.distributed import launch_cpu
+
+# cpu only data-parallel training over local processes (gloo), same checkpoints and metrics as train_test_DDP.py
+#   e.g.: python train_test_local_DDP.py -m DG -d davis -f nomsa -e binary -bs 32 --train -np 4
+args, unknown_args = parse_train_test_args(verbose=True, local=True,
+                             jyp_args=' -m DG -d davis -f nomsa -e binary' +
+                             ' -lr 0.0001 -bs 32 -do 0.2 --train -np 4')
+
+if __name__ == '__main__':
+    launch_cpu(args, unknown_args)